@@ -6,17 +6,12 @@ import os.path as osp
 
 from c3vg.core.utils import boxsegiou, imshow_box_mask
 from c3vg.models.heads.uni_head import compute_boxiou
-from c3vg.utils import load_checkpoint, get_root_logger
+from c3vg.utils import load_checkpoint, get_root_logger, get_precision, autocast
 from c3vg.core import imshow_expr_bbox, imshow_expr_mask
 from c3vg.models import build_model, ExponentialMovingAverage
 from c3vg.datasets import extract_data, build_dataset, build_dataloader
 # from pytorch_grad_cam import GradCAM, HiResCAM, ScoreCAM, GradCAMPlusPlus, AblationCAM, XGradCAM, EigenCAM, FullGrad
 
-try:
-    import apex
-except:
-    pass
-
 
 def inference_model(cfg):
     datasets_cfg = [cfg.data.train]
@@ -28,11 +23,7 @@ def inference_model(cfg):
 
     model = build_model(cfg.model, word_emb=datasets[0].word_emb, num_token=datasets[0].num_token)
     model = model.cuda()
-    if cfg.use_fp16:
-        model = apex.amp.initialize(model, opt_level="O1")
-        for m in model.modules():
-            if hasattr(m, "fp16_enabled"):
-                m.fp16_enabled = True
+    precision = get_precision(cfg)
     if cfg.ema:
         model_ema = ExponentialMovingAverage(model, cfg.ema_factor)
     else:
@@ -65,7 +56,8 @@ def inference_model(cfg):
                 img_metas = inputs["img_metas"]
                 batch_size = len(img_metas)
 
-                predictions = model(**inputs, return_loss=False, rescale=True, with_bbox=with_bbox, with_mask=with_mask)
+                with autocast(precision, "cuda"):
+                    predictions = model(**inputs, return_loss=False, rescale=True, with_bbox=with_bbox, with_mask=with_mask)
 
                 pred_bboxes = [None for _ in range(batch_size)]
                 if with_bbox:
@@ -3,9 +3,10 @@ import torch
 import numpy
 
 import pycocotools.mask as maskUtils
-from c3vg.datasets import extract_data
-from c3vg.utils import get_root_logger, reduce_mean, is_main
+from c3vg.datasets import DevicePrefetcher
+from c3vg.utils import get_root_logger, is_main, MetricAccumulator, get_precision, autocast
 from torchvision.ops.boxes import box_area
+from torch.nn.utils.rnn import pad_sequence
 from mmdet.core.bbox.iou_calculators.iou2d_calculator import bbox_overlaps
 from collections import defaultdict
 from mmdet.core import BitmapMasks
@@ -51,14 +52,39 @@ def mask_overlaps_withIU_RLE(gt_masks, pred_masks, is_crowds):
     return iou, intersection, union
 
 
-def mask_overlaps_withIU(gt_masks, pred_masks, is_crowd):
-    # decode the mask
-    pred_mask = torch.concat([torch.from_numpy(maskUtils.decode(pred_rle)[None]) for pred_rle in pred_masks], dim=0)
-    gt_mask = torch.concat([torch.from_numpy(maskUtils.decode(gt_rle)[None]) for gt_rle in gt_masks], dim=0)
-    # pred_mask = pred_mask.argmax(1)
-    intersection = torch.sum(torch.mul(pred_mask, gt_mask).reshape(pred_mask.shape[0], -1), dim=-1).cuda()
-    union = torch.sum(torch.add(pred_mask, gt_mask).reshape(pred_mask.shape[0], -1), dim=1).cuda() - intersection
-    iou = torch.tensor([i / u if u >= 1 else 0 for i, u in zip(intersection, union)]).cuda()
+def _mask_tensor(masks, device):
+    """Binary masks flattened to a [B, H*W] bool tensor on device, RLEs are
+    decoded with a single pycocotools call for the whole batch. Masks of
+    different sizes (rescaled to their own image) are zero padded, which
+    leaves their areas and intersections with same-sized masks unchanged."""
+    if hasattr(masks, "ragged"):  # LazyMasks
+        masks = masks.masks
+    if isinstance(masks, torch.Tensor):
+        return masks.to(device).bool().flatten(1)
+    if not isinstance(masks[0], torch.Tensor):
+        if len(set(tuple(rle["size"]) for rle in masks)) == 1:
+            return torch.from_numpy(maskUtils.decode(list(masks))).to(device).permute(2, 0, 1).bool().flatten(1)
+        masks = [torch.from_numpy(maskUtils.decode(rle)) for rle in masks]
+    return pad_sequence([mask.to(device).flatten().to(torch.uint8) for mask in masks], batch_first=True).bool()
+
+
+def mask_overlaps_withIU(gt_masks, pred_masks, is_crowd=None, device="cuda:0"):
+    """Args:
+    gt_masks (list[RLE] | tensor): ground truth masks.
+    pred_masks (list[RLE] | tensor | LazyMasks): binarized predictions, [B, H, W].
+    is_crowd (list[int], optional): as in pycocotools, the union of a crowd
+        ground truth is the predicted area. Ignored when None.
+
+    Returns the iou, intersection and union, [B] tensors on device.
+    """
+    pred_mask = _mask_tensor(pred_masks, device)
+    gt_mask = _mask_tensor(gt_masks, device)
+    pred_area = pred_mask.sum(-1)
+    intersection = (pred_mask & gt_mask).sum(-1)
+    union = pred_area + gt_mask.sum(-1) - intersection
+    if is_crowd is not None:
+        union = torch.where(torch.as_tensor(is_crowd, device=union.device).bool(), pred_area, union)
+    iou = torch.where(union >= 1, intersection / union.clamp(min=1), torch.zeros_like(intersection, dtype=torch.float))
     return iou, intersection, union
 
 
@@ -105,6 +131,7 @@ def generalized_box_iou(boxes1, boxes2):
 def accuracy(pred_bboxes, gt_bbox, pred_masks, gt_mask, is_crowd=None, device="cuda:0"):
     eval_det = pred_bboxes is not None
     eval_mask = pred_masks is not None
+    iou_thrs = torch.tensor([0.5, 0.6, 0.7, 0.8, 0.9], device=device)
 
     det_acc = torch.tensor([0.0], device=device)
     bbox_iou = torch.tensor([0.0], device=device)
@@ -114,8 +141,7 @@ def accuracy(pred_bboxes, gt_bbox, pred_masks, gt_mask, is_crowd=None, device="c
         if isinstance(pred_bboxes, list):
             pred_bboxes = torch.stack(pred_bboxes)
         bbox_iou = bbox_overlaps(gt_bbox, pred_bboxes, is_aligned=True)
-        for i, iou_thr in enumerate([0.5, 0.6, 0.7, 0.8, 0.9]):
-            det_acc_at_thrs[i] = (bbox_iou >= iou_thr).float().mean()
+        det_acc_at_thrs = (bbox_iou[:, None] >= iou_thrs).float().mean(0)
         det_acc = (bbox_iou >= 0.5).float().mean()
 
     mask_iou = torch.tensor([0.0], device=device)
@@ -123,9 +149,8 @@ def accuracy(pred_bboxes, gt_bbox, pred_masks, gt_mask, is_crowd=None, device="c
     I, U = torch.tensor([0.0], device=device), torch.tensor([0.0], device=device)
     if eval_mask:
         # mask_iou = mask_overlaps(gt_mask, pred_masks, is_crowd).to(device)
-        mask_iou, I, U = mask_overlaps_withIU(gt_mask, pred_masks, is_crowd)
-        for i, iou_thr in enumerate([0.5, 0.6, 0.7, 0.8, 0.9]):
-            mask_acc_at_thrs[i] = (mask_iou >= iou_thr).float().mean()
+        mask_iou, I, U = mask_overlaps_withIU(gt_mask, pred_masks, device=device)
+        mask_acc_at_thrs = (mask_iou[:, None] >= iou_thrs).float().mean(0)
 
     return det_acc * 100.0, mask_iou * 100.0, mask_acc_at_thrs * 100.0, I * 1.0, U * 1.0, det_acc_at_thrs * 100.0
 
@@ -209,44 +234,30 @@ def evaluate_model(epoch, cfg, model, loader):
     model.eval()
 
     device = list(model.parameters())[0].device
+    precision = get_precision(cfg)
 
-    batches = len(loader)
+    prefetcher = DevicePrefetcher(loader, device, distributed=cfg.distributed)
+    batches = len(prefetcher)
     end = time.time()
 
     with_bbox, with_mask = False, False
-    det_acc_list, det_accs_list, mask_iou_list, mask_acc_list, mask_I_list, mask_U_list = [], [], [], [], [], []
-    det_acc_list_fs, mask_iou_list_fs, mask_acc_list_fs, mask_I_list_fs, mask_U_list_fs = [], [], [], [], []
+    metrics = MetricAccumulator()
     with torch.no_grad():
-        for batch, inputs in enumerate(loader):
-            gt_bbox, gt_mask, is_crowd = None, None, None
-
-            if "gt_bbox" in inputs:
-                with_bbox = True
-                if isinstance(inputs["gt_bbox"], torch.Tensor):
-                    inputs["gt_bbox"] = [inputs["gt_bbox"][ind] for ind in range(inputs["gt_bbox"].shape[0])]
-                    gt_bbox = copy.deepcopy(inputs["gt_bbox"])
-                else:
-                    gt_bbox = copy.deepcopy(inputs["gt_bbox"].data[0])
-
-            if "gt_mask_rle" in inputs:
-                with_mask = True
-                gt_mask = inputs.pop("gt_mask_rle").data[0]
-            if "is_crowd" in inputs:
-                is_crowd = inputs.pop("is_crowd").data[0]
-
-            img_metas = inputs["img_metas"].data[0]
-
-            if not cfg.distributed:
-                inputs = extract_data(inputs)
-
-            predictions = model(
-                **inputs,
-                return_loss=False,
-                gt_mask=gt_mask,
-                rescale=False,
-                with_bbox=with_bbox,
-                with_mask=with_mask,
-            )
+        for batch, (inputs, targets) in enumerate(prefetcher):
+            gt_bbox, gt_mask, is_crowd = targets["gt_bbox"], targets["gt_mask"], targets["is_crowd"]
+            img_metas = targets["img_metas"]
+            with_bbox = with_bbox or gt_bbox is not None
+            with_mask = with_mask or gt_mask is not None
+
+            with autocast(precision, device):
+                predictions = model(
+                    **inputs,
+                    return_loss=False,
+                    gt_mask=gt_mask,
+                    rescale=False,
+                    with_bbox=with_bbox,
+                    with_mask=with_mask,
+                )
 
             pred_bboxes = predictions.pop("pred_bboxes")
             pred_masks = predictions.pop("pred_masks")
@@ -260,54 +271,27 @@ def evaluate_model(epoch, cfg, model, loader):
                 batch_det_acc_fs, batch_mask_iou_fs, batch_mask_acc_at_thrs_fs, batch_mask_I_fs, batch_mask_U_fs, batch_det_acc_at_thrs_fs = accuracy(
                     pred_bboxes_firststage, gt_bbox, pred_masks_firststage, gt_mask, is_crowd=is_crowd, device=device
                 )
-            if cfg.distributed:
-                batch_det_acc = reduce_mean(batch_det_acc)
-                batch_mask_iou = reduce_mean(batch_mask_iou)
-                batch_mask_I = reduce_mean(batch_mask_I)
-                batch_mask_U = reduce_mean(batch_mask_U)
-                batch_mask_acc_at_thrs = reduce_mean(batch_mask_acc_at_thrs)
-                batch_det_acc_at_thrs = reduce_mean(batch_det_acc_at_thrs)
-                if pred_bboxes_firststage is not None and len(pred_bboxes_firststage) > 0:
-                    batch_det_acc_fs = reduce_mean(batch_det_acc_fs)
-                    batch_mask_iou_fs = reduce_mean(batch_mask_iou_fs)
-                    batch_mask_I_fs = reduce_mean(batch_mask_I_fs)
-                    batch_mask_U_fs = reduce_mean(batch_mask_U_fs)
-                    batch_mask_acc_at_thrs_fs = reduce_mean(batch_mask_acc_at_thrs_fs)
-
-            det_acc_list.append(batch_det_acc.item())
-            mask_iou_list.append(batch_mask_iou)
-            mask_I_list.append(batch_mask_I)
-            mask_U_list.append(batch_mask_U)
-            mask_acc_list.append(batch_mask_acc_at_thrs)
-            det_accs_list.append(batch_det_acc_at_thrs)
-            det_acc = sum(det_acc_list) / len(det_acc_list)
-            mask_miou = torch.cat(mask_iou_list).mean().item()
-            mask_I = torch.cat(mask_I_list).mean().item()
-            mask_U = torch.cat(mask_U_list).mean().item()
-            mask_oiou = 100.0 * mask_I / mask_U
-            mask_acc = torch.vstack(mask_acc_list).mean(dim=0).tolist()
-            det_accs = torch.vstack(det_accs_list).mean(dim=0).tolist()
-
-            det_acc_fs, mask_miou_fs, mask_oiou_fs, mask_acc_fs = 0, 0, 0, [0, 0, 0, 0, 0]
+            metrics.update(det_acc=batch_det_acc, mask_acc=batch_mask_acc_at_thrs, det_accs=batch_det_acc_at_thrs)
+            metrics.update(per_sample=True, mask_iou=batch_mask_iou, mask_I=batch_mask_I, mask_U=batch_mask_U)
             if pred_bboxes_firststage is not None and len(pred_bboxes_firststage) > 0:
-                det_acc_list_fs.append(batch_det_acc_fs.item())
-                mask_iou_list_fs.append(batch_mask_iou_fs)
-                mask_acc_list_fs.append(batch_mask_acc_at_thrs_fs)
-                mask_I_list_fs.append(batch_mask_I_fs)
-                mask_U_list_fs.append(batch_mask_U_fs)
-                det_acc_fs = sum(det_acc_list_fs) / len(det_acc_list_fs)
-                mask_miou_fs = torch.cat(mask_iou_list_fs).mean().item()
-                mask_I_fs = torch.cat(mask_I_list_fs).mean().item()
-                mask_U_fs = torch.cat(mask_U_list_fs).mean().item()
-                mask_oiou_fs = 100.0 * mask_I_fs / mask_U_fs
-                mask_acc_fs = torch.vstack(mask_acc_list_fs).mean(dim=0).tolist()
-
-            if is_main():
-                if (batch + 1) % cfg.log_interval == 0 or batch + 1 == batches:
+                metrics.update(det_acc_fs=batch_det_acc_fs, mask_acc_fs=batch_mask_acc_at_thrs_fs)
+                metrics.update(per_sample=True, mask_iou_fs=batch_mask_iou_fs, mask_I_fs=batch_mask_I_fs, mask_U_fs=batch_mask_U_fs)
+
+            if (batch + 1) % cfg.log_interval == 0 or batch + 1 == batches:
+                # collective, summarized on every rank
+                summary = metrics.summarize()
+                det_acc, mask_miou, mask_acc, det_accs = summary["det_acc"], summary["mask_iou"], summary["mask_acc"], summary["det_accs"]
+                mask_oiou = 100.0 * summary["mask_I"] / summary["mask_U"]
+                det_acc_fs, mask_miou_fs, mask_oiou_fs, mask_acc_fs = 0, 0, 0, [0, 0, 0, 0, 0]
+                if "det_acc_fs" in summary:
+                    det_acc_fs, mask_miou_fs, mask_acc_fs = summary["det_acc_fs"], summary["mask_iou_fs"], summary["mask_acc_fs"]
+                    mask_oiou_fs = 100.0 * summary["mask_I_fs"] / summary["mask_U_fs"]
+
+                if is_main():
                     logger = get_root_logger()
                     logger.info(
                         f"validate - epoch [{epoch+1}]-[{batch+1}/{batches}] "
-                        + f"time: {(time.time() - end):.2f}, "
+                        + f"time: {(time.time() - end):.2f}, data_time: {prefetcher.wait_time:.2f}, "
                         + f"DetACC: {det_acc:.2f}, "
                         + f"mIoU: {mask_miou:.2f}, "
                         + f"oIoU: {mask_oiou:.2f}, "
@@ -321,4 +305,7 @@ def evaluate_model(epoch, cfg, model, loader):
 
             end = time.time()
 
+    if is_main():
+        get_root_logger().info(f"validate - epoch [{epoch+1}] data wait: {prefetcher.total_wait_time:.2f}s")
+
     return det_acc, mask_acc[0], mask_miou, mask_oiou
@@ -1,4 +1,7 @@
 from .utils import extract_data
 from .builder import DATASETS, PIPELINES, build_dataset, build_dataloader
+from .annotation_store import MmapAnnotationStore, convert_annotations
+from .device_augment import DeviceAugment
+from .prefetcher import DevicePrefetcher
 from .base import RefCOCOUNC, RefCOCOGoogle, RefCOCOgUMD, RefCOCOgGoogle, RefCOCOPlusUNC, Mixed, MixedSeg
 from .pipelines import LoadImageAnnotationsFromFile, Resize, Normalize, Pad, DefaultFormatBundle, CollectData, Compose
\ No newline at end of file
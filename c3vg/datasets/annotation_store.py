@@ -0,0 +1,214 @@
+import json
+import numpy
+import os.path as osp
+
+import mmcv
+
+# fixed-width columns, stored only when every record of a split matches the shape
+FIXED_COLUMNS = {
+    "image_id": ("int64", ()),
+    "bbox": ("float64", (4,)),
+    "width": ("int32", ()),
+    "height": ("int32", ()),
+    "category_id": ("int32", ()),
+}
+# variable-length columns, stored as json blobs indexed by an offsets array
+BLOB_COLUMNS = ("expressions", "mask")
+# every key that is not a column above ends up here
+EXTRA_COLUMN = "extra"
+STORE_VERSION = 1
+
+
+def default_store_dir(annsfile):
+    """data/annotations/mixed-seg/instances.json -> data/annotations/mixed-seg/instances_mmap"""
+    return osp.splitext(annsfile)[0] + "_mmap"
+
+
+def _fits(value, shape):
+    def is_number(x):
+        return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+    if shape == ():
+        return is_number(value)
+    return isinstance(value, (list, tuple)) and len(value) == shape[0] and all(map(is_number, value))
+
+
+def _write_split(anns, filepath):
+    num = len(anns)
+    columns, chunks = {}, []
+    offset = 0
+
+    def append(name, array, kind, **info):
+        nonlocal offset
+        pad = (-offset) % 8
+        if pad:
+            chunks.append(bytes(pad))
+            offset += pad
+        array = numpy.ascontiguousarray(array)
+        columns[name] = dict(kind=kind, offset=offset, dtype=array.dtype.str, shape=list(array.shape), **info)
+        chunks.append(array.tobytes())
+        offset += array.nbytes
+
+    stored_keys = set()
+    for key, (dtype, shape) in FIXED_COLUMNS.items():
+        if num > 0 and all(_fits(ann.get(key, None), shape) for ann in anns):
+            append(key, numpy.array([ann[key] for ann in anns], dtype=dtype), "fixed")
+            stored_keys.add(key)
+
+    if num > 0 and all(isinstance(ann.get("data_source", None), str) for ann in anns):
+        vocab = sorted(set(ann["data_source"] for ann in anns))
+        lookup = {source: ind for ind, source in enumerate(vocab)}
+        append("data_source", numpy.array([lookup[ann["data_source"]] for ann in anns], dtype=numpy.int16), "category", vocab=vocab)
+        stored_keys.add("data_source")
+
+    for key in BLOB_COLUMNS + (EXTRA_COLUMN,):
+        blobs = []
+        for ann in anns:
+            if key == EXTRA_COLUMN:
+                extra = {k: v for k, v in ann.items() if k not in stored_keys and k not in BLOB_COLUMNS}
+                blob = json.dumps(extra).encode("utf-8") if len(extra) > 0 else b""
+            else:
+                # an empty blob marks a missing key
+                blob = json.dumps(ann[key]).encode("utf-8") if key in ann else b""
+            blobs.append(blob)
+        offsets = numpy.zeros(num + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([len(blob) for blob in blobs])
+        append(key + ".offsets", offsets, "offsets")
+        append(key, numpy.frombuffer(b"".join(blobs), dtype=numpy.uint8), "blob")
+
+    with open(filepath, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+    return dict(num=num, filename=osp.basename(filepath), columns=columns)
+
+
+def convert_annotations(annsfile, store_dir=None, splits=None):
+    """Convert a multi-split instances.json into a :class:`MmapAnnotationStore`.
+
+    Args:
+        annsfile (str): path to the json annotation file, a dict of
+            which_set -> list of annotations.
+        store_dir (str, optional): output directory, defaults to
+            :func:`default_store_dir`.
+        splits (list[str], optional): only convert these splits.
+
+    Returns:
+        str: the store directory.
+    """
+    store_dir = store_dir or default_store_dir(annsfile)
+    mmcv.mkdir_or_exist(store_dir)
+    anns_all = json.load(open(annsfile, "r"))
+    meta = {"version": STORE_VERSION, "annsfile": osp.basename(annsfile), "splits": {}}
+    for which_set, anns in anns_all.items():
+        if splits is not None and which_set not in splits:
+            continue
+        meta["splits"][which_set] = _write_split(anns, osp.join(store_dir, f"{which_set}.bin"))
+    with open(osp.join(store_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return store_dir
+
+
+class MmapAnnotationStore(object):
+    """Read-only, memory-mapped view over one split of a converted annotation file.
+
+    Fixed-width fields (image_id, bbox, width, height, category_id, data_source)
+    are numpy columns, expressions / masks / any other keys are json blobs
+    indexed by offsets. All columns of a split live in a single file which is
+    mapped lazily, so construction only parses the small meta.json and the
+    pages are shared by every DataLoader worker through the page cache.
+
+    Indexing returns the same dict as the original json record.
+
+    Args:
+        store_dir (str): directory written by :func:`convert_annotations`.
+        which_set (str): split to open.
+        indices (numpy.ndarray, optional): subset of records to expose.
+    """
+
+    def __init__(self, store_dir, which_set, indices=None):
+        meta_file = osp.join(store_dir, "meta.json")
+        if not osp.exists(meta_file):
+            raise FileNotFoundError(f"{meta_file} does not exist, convert the annotations with tools/data_process/convert_mmap_annotations.py first")
+        with open(meta_file, "r") as f:
+            meta = json.load(f)
+        if meta["version"] != STORE_VERSION:
+            raise ValueError(f"unsupported annotation store version {meta['version']}")
+        if which_set not in meta["splits"]:
+            raise KeyError(f"split {which_set} not found in {store_dir}")
+        split = meta["splits"][which_set]
+        self.store_dir = store_dir
+        self.which_set = which_set
+        self.filepath = osp.join(store_dir, split["filename"])
+        self.columns = split["columns"]
+        self.num = split["num"]
+        self.indices = None if indices is None else numpy.asarray(indices, dtype=numpy.int64)
+        self._buffer = None
+        self._views = {}
+
+    def __getstate__(self):
+        # memmaps are re-opened in each worker instead of being pickled as copies
+        state = self.__dict__.copy()
+        state["_buffer"] = None
+        state["_views"] = {}
+        return state
+
+    def _view(self, name):
+        if name not in self._views:
+            if self._buffer is None:
+                self._buffer = numpy.memmap(self.filepath, dtype=numpy.uint8, mode="r")
+            info = self.columns[name]
+            dtype = numpy.dtype(info["dtype"])
+            nbytes = int(numpy.prod(info["shape"])) * dtype.itemsize
+            view = self._buffer[info["offset"] : info["offset"] + nbytes].view(dtype)
+            self._views[name] = view.reshape(info["shape"])
+        return self._views[name]
+
+    def has_column(self, name):
+        return name in self.columns and self.columns[name]["kind"] in ("fixed", "category")
+
+    def column(self, name):
+        """Vectorized access to a fixed-width column, restricted to ``indices``."""
+        assert self.has_column(name), f"{name} is not a fixed-width column"
+        values = self._view(name)
+        if self.indices is not None:
+            values = values[self.indices]
+        if self.columns[name]["kind"] == "category":
+            values = numpy.asarray(self.columns[name]["vocab"])[values]
+        return numpy.asarray(values)
+
+    def select(self, indices):
+        """Returns a store exposing ``self[indices]`` without copying any record."""
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return MmapAnnotationStore(self.store_dir, self.which_set, indices=indices)
+
+    def __len__(self):
+        return self.num if self.indices is None else len(self.indices)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(f"index {index} out of range for {len(self)} annotations")
+        ind = index if self.indices is None else int(self.indices[index])
+
+        ann = {}
+        for name, info in self.columns.items():
+            kind = info["kind"]
+            if kind == "fixed":
+                ann[name] = self._view(name)[ind].tolist()
+            elif kind == "category":
+                ann[name] = info["vocab"][int(self._view(name)[ind])]
+            elif kind == "blob":
+                offsets = self._view(name + ".offsets")
+                start, end = int(offsets[ind]), int(offsets[ind + 1])
+                if end == start:
+                    continue
+                value = json.loads(self._view(name)[start:end].tobytes())
+                if name == EXTRA_COLUMN:
+                    ann.update(value)
+                else:
+                    ann[name] = value
+        return ann
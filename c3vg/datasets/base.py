@@ -3,6 +3,9 @@ import numpy
 from .utils import tokenize
 from .builder import DATASETS
 from .pipelines import Compose
+from .annotation_store import MmapAnnotationStore, default_store_dir
+from .token_cache import load_token_cache
+from .mask_cache import load_mask_cache
 
 # from pydantic import ListMinLengthError
 from torch.utils.data.dataset import Dataset
@@ -85,7 +88,7 @@ class BaseDataset_Ori(Dataset):
 
 
 class BaseDataset(Dataset):
-    def __init__(self, imgsfile, annsfile, pipeline, which_set="train", img_source=["coco"], word_emb_cfg=None):
+    def __init__(self, imgsfile, annsfile, pipeline, which_set="train", img_source=["coco"], word_emb_cfg=None, ann_backend="json", device_augment=False):
         super(BaseDataset, self).__init__()
         assert isinstance(which_set, str) and which_set in [
             "train",
@@ -116,15 +119,38 @@ class BaseDataset(Dataset):
         else:
             raise TypeError("None")
 
-        self.anns_all = json.load(open(annsfile, "r"))[which_set]
-
-        self.token2idx, self.idx2token, self.word_emb = tokenize(annsfile, self.anns_all, word_emb_cfg)
+        assert ann_backend in ["json", "mmap"]
+        if ann_backend == "mmap":
+            # only meta.json is parsed, records are decoded on demand in __getitem__
+            self.anns_all = MmapAnnotationStore(default_store_dir(annsfile), which_set)
+            self.token2idx, self.idx2token, self.word_emb = tokenize(annsfile, {which_set: self.anns_all}, word_emb_cfg)
+        else:
+            self.anns_all = json.load(open(annsfile, "r"))[which_set]
+            self.token2idx, self.idx2token, self.word_emb = tokenize(annsfile, self.anns_all, word_emb_cfg)
 
+        self.pipeline = Compose(pipeline)
+        # LargeScaleJitter/Resize/Normalize/Pad are left to DeviceAugment
+        self.device_augment = device_augment
+
+        # caches are built on the whole split, so it is indexed by the position in the annotation file
+        self.token_cache = None
+        if getattr(self.pipeline.transforms[0], "use_token_cache", False):
+            self.token_cache = load_token_cache(annsfile, which_set, self.anns_all, self.pipeline.transforms[0])
+        self.mask_cache = None
+        if getattr(self.pipeline.transforms[0], "use_mask_cache", False):
+            self.mask_cache = load_mask_cache(annsfile, which_set, self.anns_all)
+
+        self.ann_indices = None
         if which_set == "train":
-            if self.anns_all[0].get("data_source", None) is not None:
-                self.anns_all = [ann for ann in self.anns_all if ann["data_source"] in img_source]
+            if isinstance(self.anns_all, MmapAnnotationStore):
+                if self.anns_all.has_column("data_source"):
+                    keep = numpy.isin(self.anns_all.column("data_source"), img_source)
+                    self.anns_all = self.anns_all.select(numpy.nonzero(keep)[0])
+                    self.ann_indices = self.anns_all.indices
+            elif self.anns_all[0].get("data_source", None) is not None:
+                self.ann_indices = [i for i, ann in enumerate(self.anns_all) if ann["data_source"] in img_source]
+                self.anns_all = [self.anns_all[i] for i in self.ann_indices]
             self._set_group_flag()
-        self.pipeline = Compose(pipeline)
 
         if self.pipeline.transforms[0].use_token_type == "copus":
             self.num_token = len(self.pipeline.transforms[0].copus)
@@ -134,6 +160,9 @@ class BaseDataset(Dataset):
             self.num_token = len(self.token2idx)
 
     def _set_group_flag(self):
+        if isinstance(self.anns_all, MmapAnnotationStore) and self.anns_all.has_column("width") and self.anns_all.has_column("height"):
+            self.flag = (self.anns_all.column("width") / self.anns_all.column("height") > 1).astype(numpy.uint8)
+            return
         self.flag = numpy.zeros(len(self), dtype=numpy.uint8)
         for i in range(len(self)):
             ann = self.anns_all[i]
@@ -142,6 +171,13 @@ class BaseDataset(Dataset):
 
     def __getitem__(self, index):
         results = {"ann": self.anns_all[index], "which_set": self.which_set, "token2idx": self.token2idx, "imgsfile": self.imgsfile}
+        ann_index = index if self.ann_indices is None else int(self.ann_indices[index])
+        if self.token_cache is not None:
+            results["expr_tokens"] = self.token_cache[ann_index]
+        if self.mask_cache is not None:
+            results["mask_rle"] = self.mask_cache[ann_index]
+        if self.device_augment:
+            results["device_augment"] = True
 
         results = self.pipeline(results)
 
@@ -1,10 +1,10 @@
 import numpy
+import torch
 import random
 
 from functools import partial
-from .utils import collate_fn
+from .utils import collate_fn, fixed_size_collate
 from mmcv.utils import Registry
-from mmcv.parallel import collate
 from torch.utils.data import DataLoader
 from mmdet.datasets import GroupSampler, DistributedGroupSampler, DistributedSampler
 
@@ -53,9 +53,10 @@ def build_dataloader(cfg,
                       shuffle=False,
                       batch_sampler=None,
                       num_workers=cfg.data.workers_per_gpu,
-                      pin_memory=False,
+                      # batches are written into page-locked memory, so that .cuda(non_blocking=True) is asynchronous
+                      pin_memory=torch.cuda.is_available(),
                       collate_fn=partial(
-                          collate, samples_per_gpu=cfg.data.samples_per_gpu),
+                          fixed_size_collate, samples_per_gpu=cfg.data.samples_per_gpu),
                       worker_init_fn=init_fn,
                       drop_last=False,
                       persistent_workers=cfg.distributed)
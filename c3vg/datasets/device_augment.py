@@ -0,0 +1,185 @@
+import mmcv
+import math
+import numpy
+import torch
+import random
+import torch.nn.functional as F
+import pycocotools.mask as maskUtils
+from mmdet.core import BitmapMasks
+from mmcv.parallel import DataContainer
+from .pipelines import LargeScaleJitter
+
+
+class DeviceAugment(object):
+    """LargeScaleJitter + Resize (keep_ratio=False) + Normalize + Pad applied on a
+    whole batch with torch ops on the training device.
+
+    Scale jitter, crop and the final resize compose into one rectangle of the
+    original image per sample, so the batch is resampled by a single
+    grid_sample. Only the crop search, which works on boxes, and the RLE
+    decoding / encoding stay on the host. The datasets have to be built with
+    ``device_augment=True`` so that the per-sample transforms pass the uint8
+    images through untouched; the images are then collated at their original
+    size (zero padded).
+
+    gt_bbox are returned in the output frame, gt_mask_seg stacked on the device
+    and gt_mask_rle re-encoded at the padded resolution, like the per-sample
+    chain: images are sampled bilinearly, masks with nearest neighbour. Any
+    device works, the CPU included.
+
+    Args:
+        img_scale (tuple): (w, h) of the output images, as in :class:`Resize`.
+        mean (sequence): as in :class:`Normalize`.
+        std (sequence): as in :class:`Normalize`.
+        to_rgb (bool): as in :class:`Normalize`.
+        size_divisor (int, optional): as in :class:`Pad`.
+        pad_val (float): as in :class:`Pad`.
+        large_scale_jitter (bool): whether to apply :class:`LargeScaleJitter` first,
+            the remaining kwargs are passed to it.
+    """
+
+    def __init__(self, img_scale, mean, std, to_rgb=True, size_divisor=None, pad_val=0, large_scale_jitter=True, **jitter_cfg):
+        self.img_scale = img_scale
+        self.mean = numpy.array(mean, dtype=numpy.float32)
+        self.std = numpy.array(std, dtype=numpy.float32)
+        self.to_rgb = to_rgb
+        self.size_divisor = size_divisor
+        self.pad_val = pad_val
+        self.jitter = LargeScaleJitter(**jitter_cfg) if large_scale_jitter else None
+
+    def _sample_region(self, h, w, gt_bbox, gt_mask):
+        """Returns the region of the original image that ends up in the output,
+        the (w, h) it has right before the final resize and gt_bbox in that frame.
+        """
+        region = numpy.array([0.0, 0.0, w, h])
+        if self.jitter is None:
+            return region, (w, h), gt_bbox
+
+        rand_scale = self.jitter.jitter_min + random.random() * (self.jitter.jitter_max - self.jitter.jitter_min)
+        scale = rand_scale * self.jitter.out_max_size / max(h, w)
+        new_w, new_h = mmcv.rescale_size((w, h), scale)
+        factor = numpy.array([new_w / w, new_h / h, new_w / w, new_h / h])
+        bbox = None if gt_bbox is None else gt_bbox * factor
+
+        if rand_scale > 1.0:
+            w_out, h_out = mmcv.rescale_size((w, h), mmcv.utils.to_2tuple(self.jitter.out_max_size))
+            if bbox is not None:
+                crop_bbox = self.jitter._search_crop(new_w, new_h, w_out, h_out, lambda crop_bboxes: self.jitter._bbox_overlaps(crop_bboxes, bbox))
+            else:
+                # the overlap ratio is scale invariant, score on the original mask
+                crop_bbox = self.jitter._search_crop(
+                    new_w, new_h, w_out, h_out, lambda crop_bboxes: self.jitter._mask_overlaps((crop_bboxes / factor).astype(numpy.uint32), gt_mask)
+                )
+            # escape, the original image is resized as is
+            if crop_bbox is None:
+                return region, (w, h), gt_bbox
+            offset = crop_bbox[:2]
+            region = crop_bbox.astype(numpy.uint32) / factor
+            new_w, new_h = w_out, h_out
+            if bbox is not None:
+                bbox = bbox - numpy.array([offset[0], offset[1], offset[0], offset[1]])
+
+        if bbox is not None:
+            bbox[0::2] = numpy.clip(bbox[0::2], 0, new_w - 1)
+            bbox[1::2] = numpy.clip(bbox[1::2], 0, new_h - 1)
+        return region, (new_w, new_h), bbox
+
+    def _resample(self, data, regions, ori_wh, mode="bilinear"):
+        """Samples ``regions`` ([B, 4], x1y1x2y2 in pixels) of the zero padded
+        batch ``data`` to img_scale with grid_sample ``mode``, replicating the
+        image borders."""
+        B, _, H, W = data.shape
+        out_w, out_h = self.img_scale
+        u = torch.arange(out_w, dtype=torch.float32, device=data.device) + 0.5
+        v = torch.arange(out_h, dtype=torch.float32, device=data.device) + 0.5
+        xs = regions[:, 0:1] + u[None] * (regions[:, 2:3] - regions[:, 0:1]) / out_w - 0.5
+        ys = regions[:, 1:2] + v[None] * (regions[:, 3:4] - regions[:, 1:2]) / out_h - 0.5
+        xs = torch.minimum(xs.clamp(min=0), ori_wh[:, 0:1] - 1)
+        ys = torch.minimum(ys.clamp(min=0), ori_wh[:, 1:2] - 1)
+        grid = torch.stack(
+            [((xs + 0.5) * 2 / W - 1)[:, None, :].expand(B, out_h, out_w), ((ys + 0.5) * 2 / H - 1)[:, :, None].expand(B, out_h, out_w)], dim=-1
+        )
+        return F.grid_sample(data, grid, mode=mode, padding_mode="border", align_corners=False)
+
+    def _pad(self, data, pad_val):
+        if self.size_divisor is None:
+            return data
+        h, w = data.shape[-2:]
+        pad_h = int(math.ceil(h / self.size_divisor)) * self.size_divisor
+        pad_w = int(math.ceil(w / self.size_divisor)) * self.size_divisor
+        return F.pad(data, (0, pad_w - w, 0, pad_h - h), value=pad_val)
+
+    def __call__(self, inputs, device):
+        """Args:
+            inputs (dict): a collated batch of DataContainer, as yielded by the
+                dataloader.
+            device (torch.device): where to run.
+
+        Returns:
+            dict: the same batch with img, gt_bbox, gt_mask_seg, gt_mask_rle and
+                img_metas augmented, img and gt_mask_seg already on ``device``.
+        """
+        img = inputs["img"].data[0].to(device, non_blocking=True).float()
+        img_metas = inputs["img_metas"].data[0]
+        B, _, H, W = img.shape
+        gt_bbox = [bbox.numpy().astype(numpy.float64) for bbox in inputs["gt_bbox"].data[0]] if "gt_bbox" in inputs else [None] * B
+        gt_mask = None
+        if "gt_mask_seg" in inputs or "gt_mask_rle" in inputs:
+            gt_mask = torch.zeros((B, 1, H, W), dtype=torch.uint8)
+            if "gt_mask_seg" in inputs:
+                # already decoded by the loader workers
+                masks = [mask.numpy() for mask in inputs["gt_mask_seg"].data[0]]
+            else:
+                masks = [maskUtils.decode(rle) for rle in inputs["gt_mask_rle"].data[0]]
+            for ind, mask in enumerate(masks):
+                gt_mask[ind, 0, : mask.shape[0], : mask.shape[1]] = torch.from_numpy(mask)
+
+        out_w, out_h = self.img_scale
+        regions, ori_wh, new_bbox, new_metas = [], [], [], []
+        for ind, img_meta in enumerate(img_metas):
+            h, w = img_meta["img_shape"][:2]
+            mask = None
+            if gt_mask is not None and gt_bbox[ind] is None:
+                mask = BitmapMasks(masks[ind][None], h, w)
+            region, (new_w, new_h), bbox = self._sample_region(h, w, gt_bbox[ind], mask)
+            scale_factor = numpy.array([out_w / new_w, out_h / new_h, out_w / new_w, out_h / new_h], dtype=numpy.float32)
+            regions.append(region)
+            ori_wh.append([w, h])
+            if bbox is not None:
+                new_bbox.append(torch.from_numpy(bbox * scale_factor))
+            new_metas.append(dict(img_meta, img_shape=(out_h, out_w, 3), scale_factor=scale_factor, keep_ratio=False))
+        regions = torch.as_tensor(numpy.stack(regions), dtype=torch.float32, device=device)
+        ori_wh = torch.as_tensor(ori_wh, dtype=torch.float32, device=device)
+
+        img = self._resample(img, regions, ori_wh)
+        if self.to_rgb:
+            img = img[:, [2, 1, 0]]
+        mean = torch.as_tensor(self.mean, device=device)[None, :, None, None]
+        std = torch.as_tensor(self.std, device=device)[None, :, None, None]
+        img = self._pad((img - mean) / std, self.pad_val)
+        for img_meta in new_metas:
+            img_meta["pad_shape"] = (img.shape[2], img.shape[3], 3)
+
+        inputs["img"] = DataContainer([img], stack=True)
+        inputs["img_metas"] = DataContainer([new_metas], cpu_only=True)
+        if len(new_bbox) > 0:
+            inputs["gt_bbox"] = DataContainer([new_bbox])
+        if gt_mask is not None:
+            # nearest, as BitmapMasks.rescale / resize in the per-sample chain
+            gt_mask = self._resample(gt_mask.to(device, non_blocking=True).float(), regions, ori_wh, mode="nearest") > 0
+            gt_mask = self._pad(gt_mask.to(torch.uint8), 0)
+            if "gt_mask_seg" in inputs:
+                inputs["gt_mask_seg"] = DataContainer([gt_mask[:, 0]], stack=True)
+            if "gt_mask_rle" in inputs:
+                # kept for the metrics
+                gt_mask = gt_mask.cpu().numpy()
+                inputs["gt_mask_rle"] = DataContainer([[maskUtils.encode(numpy.asfortranarray(mask[0])) for mask in gt_mask]], cpu_only=True)
+        return inputs
+
+    def __repr__(self):
+        repr_str = self.__class__.__name__
+        repr_str += f"(img_scale={self.img_scale}, "
+        repr_str += f"mean={self.mean}, std={self.std}, to_rgb={self.to_rgb}, "
+        repr_str += f"size_divisor={self.size_divisor}, "
+        repr_str += f"large_scale_jitter={self.jitter is not None})"
+        return repr_str
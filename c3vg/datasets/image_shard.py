@@ -0,0 +1,134 @@
+import os
+import cv2
+import json
+import mmcv
+import numpy
+import os.path as osp
+
+# index.npy (int64, [num_img, 7]) holds shard_id, offset, length, height,
+# width, original height and original width of each image
+SHARD_VERSION = 1
+
+
+class ImageShardWriter(object):
+    """Packs images, downscaled so that the longer side is at most ``max_side``,
+    into large sequential shard files.
+
+    Images are stored either re-encoded as jpg or as raw uint8 BGR arrays
+    (no decode at all at load time, at the cost of more disk). The original
+    image size is recorded for every image so that the loader can rescale
+    bboxes and masks exactly.
+
+    Args:
+        shard_dir (str): output directory.
+        max_side (int): longer side of the stored images, images that are
+            already smaller are not upscaled.
+        encoding (str): 'jpg' or 'raw'.
+        quality (int): jpg quality.
+        shard_size (int): bytes per shard file.
+    """
+
+    def __init__(self, shard_dir, max_side=448, encoding="jpg", quality=95, shard_size=1 << 30):
+        assert encoding in ["jpg", "raw"]
+        self.shard_dir = shard_dir
+        self.max_side = max_side
+        self.encoding = encoding
+        self.quality = quality
+        self.shard_size = shard_size
+        self.names, self.index = [], []
+        self.shard_id, self.shard_file, self.offset = -1, None, 0
+        mmcv.mkdir_or_exist(shard_dir)
+
+    def _next_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        self.shard_id += 1
+        self.offset = 0
+        self.shard_file = open(osp.join(self.shard_dir, f"shard-{self.shard_id:05d}.bin"), "wb")
+
+    def write(self, name, img):
+        ori_h, ori_w = img.shape[:2]
+        if max(ori_h, ori_w) > self.max_side:
+            img = mmcv.imrescale(img, self.max_side / max(ori_h, ori_w), interpolation="area")
+        h, w = img.shape[:2]
+        if self.encoding == "jpg":
+            flag, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            assert flag, f"failed to encode {name}"
+            data = buf.tobytes()
+        else:
+            data = numpy.ascontiguousarray(img, dtype=numpy.uint8).tobytes()
+        if self.shard_file is None or self.offset + len(data) > self.shard_size:
+            self._next_shard()
+        self.shard_file.write(data)
+        self.names.append(name)
+        self.index.append([self.shard_id, self.offset, len(data), h, w, ori_h, ori_w])
+        self.offset += len(data)
+
+    def close(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        numpy.save(osp.join(self.shard_dir, "index.npy"), numpy.array(self.index, dtype=numpy.int64).reshape(-1, 7))
+        meta = {"version": SHARD_VERSION, "max_side": self.max_side, "encoding": self.encoding, "num_shards": self.shard_id + 1, "names": self.names}
+        with open(osp.join(self.shard_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+
+class ImageShardReader(object):
+    """Reads images written by :class:`ImageShardWriter`, shards are memory-mapped
+    lazily in each worker process.
+
+    Images are looked up by the basename of the path the loader would have read
+    from disk.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(osp.join(shard_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta["version"] != SHARD_VERSION:
+            raise ValueError(f"unsupported image shard version {meta['version']}")
+        self.encoding = meta["encoding"]
+        self.max_side = meta["max_side"]
+        self.num_shards = meta["num_shards"]
+        self.name2idx = {name: ind for ind, name in enumerate(meta["names"])}
+        self.index = numpy.load(osp.join(shard_dir, "index.npy"))
+        self._shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def _shard(self, shard_id):
+        if shard_id not in self._shards:
+            self._shards[shard_id] = numpy.memmap(osp.join(self.shard_dir, f"shard-{shard_id:05d}.bin"), dtype=numpy.uint8, mode="r")
+        return self._shards[shard_id]
+
+    def get(self, filepath, color_type="color", backend=None):
+        """Returns:
+        tuple(numpy.ndarray, tuple): the stored (downscaled) image and the
+            (h, w) of the original image.
+        """
+        name = osp.basename(filepath)
+        if name not in self.name2idx:
+            raise KeyError(f"{name} is not in the image shards at {self.shard_dir}")
+        shard_id, offset, length, h, w, ori_h, ori_w = self.index[self.name2idx[name]].tolist()
+        data = self._shard(shard_id)[offset : offset + length]
+        if self.encoding == "jpg":
+            img = mmcv.imfrombytes(data.tobytes(), flag=color_type, backend=backend)
+        else:
+            img = numpy.array(data).reshape(h, w, -1)
+        return img, (ori_h, ori_w)
+
+
+def write_image_shards(img_dir, shard_dir, names=None, **kwargs):
+    """Packs ``names`` (all .jpg files of ``img_dir`` by default) into shards."""
+    if names is None:
+        names = sorted(name for name in os.listdir(img_dir) if name.endswith(".jpg"))
+    writer = ImageShardWriter(shard_dir, **kwargs)
+    prog_bar = mmcv.ProgressBar(len(names))
+    for name in names:
+        writer.write(name, mmcv.imread(osp.join(img_dir, name), flag="color"))
+        prog_bar.update()
+    writer.close()
+    return shard_dir
@@ -0,0 +1,115 @@
+import os
+import numpy
+import os.path as osp
+
+import mmcv
+import pycocotools.mask as maskUtils
+from c3vg.utils import get_root_logger, is_main
+from .token_cache import annsfile_hash
+
+
+def canonical_rle(mask, h, w):
+    """Merges a polygon / RLE annotation into one compressed RLE.
+
+    Returns:
+        tuple(dict, int): the RLE and is_crowd, which is 1 when the
+            polygon consists of several segments.
+    """
+    is_crowd = 0
+    if isinstance(mask, list):  # polygon
+        rles = maskUtils.frPyObjects(mask, h, w)
+        if len(rles) > 1:
+            is_crowd = 1
+        # sometimes there are multiple binary map (corresponding to multiple segs)
+        rle = maskUtils.merge(rles)
+    else:
+        rle = mask
+        if isinstance(rle["counts"], list):
+            rle = maskUtils.frPyObjects(rle, *rle["size"])
+    return rle, is_crowd
+
+
+class MaskCache(object):
+    """Canonical merged RLE of every annotation of one split.
+
+    counts (uint8) is the concatenation of all compressed RLE strings, index
+    (int64, [num_ann, 5]) holds start, end, height, width and is_crowd of each
+    annotation. Both arrays are memory-mapped.
+    """
+
+    def __init__(self, counts_file, index_file):
+        self.counts_file = counts_file
+        self.index_file = index_file
+        self._counts, self._index = None, None
+
+    def __getstate__(self):
+        # memmaps are re-opened in each worker instead of being pickled as copies
+        state = self.__dict__.copy()
+        state["_counts"], state["_index"] = None, None
+        return state
+
+    @property
+    def counts(self):
+        if self._counts is None:
+            self._counts = numpy.load(self.counts_file, mmap_mode="r")
+        return self._counts
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = numpy.load(self.index_file, mmap_mode="r")
+        return self._index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, ann_index):
+        start, end, h, w, is_crowd = self.index[ann_index].tolist()
+        rle = {"size": [h, w], "counts": self.counts[start:end].tobytes()}
+        return rle, is_crowd
+
+
+def mask_cache_files(annsfile, which_set):
+    prefix = osp.join(
+        osp.dirname(annsfile),
+        "mask_cache",
+        f"{osp.splitext(osp.basename(annsfile))[0]}_{which_set}_{annsfile_hash(annsfile)}",
+    )
+    return prefix + "_counts.npy", prefix + "_index.npy"
+
+
+def build_mask_cache(annsfile, which_set, anns):
+    counts_file, index_file = mask_cache_files(annsfile, which_set)
+    index = numpy.zeros((len(anns), 5), dtype=numpy.int64)
+    counts = []
+    start = 0
+    for ind, ann in enumerate(anns):
+        rle, is_crowd = canonical_rle(ann["mask"], ann["height"], ann["width"])
+        rle_counts = rle["counts"]
+        if isinstance(rle_counts, str):
+            rle_counts = rle_counts.encode("utf-8")
+        h, w = rle["size"]
+        index[ind] = [start, start + len(rle_counts), h, w, is_crowd]
+        counts.append(rle_counts)
+        start += len(rle_counts)
+    counts = numpy.frombuffer(b"".join(counts), dtype=numpy.uint8)
+
+    mmcv.mkdir_or_exist(osp.dirname(counts_file))
+    # write then rename so that concurrent readers never see a partial file
+    for filepath, array in [(counts_file, counts), (index_file, index)]:
+        tmp_file = filepath + f".{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            numpy.save(f, array)
+        os.replace(tmp_file, filepath)
+    return counts_file, index_file
+
+
+def load_mask_cache(annsfile, which_set, anns):
+    """Loads the mask cache of ``which_set``, building it on first use."""
+    counts_file, index_file = mask_cache_files(annsfile, which_set)
+    if not (osp.exists(counts_file) and osp.exists(index_file)):
+        build_mask_cache(annsfile, which_set, anns)
+        if is_main():
+            logger = get_root_logger()
+            logger.info(f"saved mask cache of {which_set} at {counts_file}")
+    return MaskCache(counts_file, index_file)
@@ -2,4 +2,4 @@ from .compose import Compose
 from .mask import SampleMaskVertices
 from .loading import LoadImageAnnotationsFromFile
 from .formatting import CollectData, DefaultFormatBundle
-from .transforms import Resize, Normalize, Pad, LargeScaleJitter
+from .transforms import Resize, Normalize, Pad, ResizeNormalizePad, LargeScaleJitter, MaskDownsample
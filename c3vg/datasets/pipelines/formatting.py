@@ -34,6 +34,9 @@ class DefaultFormatBundle:
     - ref_expr_inds: (1)to tensor, (2) to DataContainer (stack=True)
     - gt_bbox: (1)to tensor, (2)to DataContainer
     - gt_mask: (1)to tensor, (2)to DataContainer (cpu_only=True)
+    - gt_mask_down: (1)to tensor, (2)to DataContainer (stack=True)
+    - gt_mask_seg: uint8 gt mask at the padded resolution, (1)to tensor,
+      (2)to DataContainer (stack=True, cpu_only=True before DeviceAugment)
     """
 
     def _add_default_meta_keys(self, results):
@@ -73,9 +76,11 @@ class DefaultFormatBundle:
             img = results["img"]
             # add default meta keys
             results = self._add_default_meta_keys(results)
-            if len(img.shape) < 3:
-                img = numpy.expand_dims(img, -1)
-            img = numpy.ascontiguousarray(img.transpose(2, 0, 1))
+            # ResizeNormalizePad already writes a contiguous CHW image
+            if not results.get("img_chw", False):
+                if len(img.shape) < 3:
+                    img = numpy.expand_dims(img, -1)
+                img = numpy.ascontiguousarray(img.transpose(2, 0, 1))
             results["img"] = DataContainer(to_tensor(img), stack=True)
 
         if "ref_expr_inds" in results:
@@ -89,6 +94,13 @@ class DefaultFormatBundle:
             # results['target'] = DataContainer(results['target'])
 
         if results["with_mask"]:
+            # the uint8 gt mask at the padded resolution, decoded by the loader workers
+            gt_mask_seg = to_tensor(results.get("gt_mask_seg", results["gt_mask"].masks[0]))
+            if results.get("device_augment", False):
+                # not resized yet, DeviceAugment stacks it after the resampling
+                results["gt_mask_seg"] = DataContainer(gt_mask_seg, cpu_only=True)
+            else:
+                results["gt_mask_seg"] = DataContainer(gt_mask_seg, stack=True, pad_dims=None)
             results["gt_mask"] = DataContainer(results["gt_mask"], cpu_only=True)
             if "gt_mask_rle" in results:
                 results["gt_mask_rle"] = DataContainer(results["gt_mask_rle"], cpu_only=True, pad_dims=None)
@@ -98,7 +110,7 @@ class DefaultFormatBundle:
                 results["gt_mask_vertices"] = DataContainer(to_tensor(results["gt_mask_vertices"]), stack=True, pad_dims=None)
             if "mass_center" in results:
                 results["mass_center"] = DataContainer(to_tensor(results["mass_center"]), stack=True, pad_dims=None)
-            if "gt_mask_seg" in results:
-                results["gt_mask_seg"] = DataContainer(to_tensor(results["gt_mask_seg"]), stack=True, pad_dims=None)
+            if "gt_mask_down" in results:
+                results["gt_mask_down"] = DataContainer(to_tensor(results["gt_mask_down"]), stack=True, pad_dims=None)
 
         return results
@@ -9,6 +9,8 @@ import pycocotools.mask as maskUtils
 from transformers import BertTokenizer
 import numpy as np
 from ..builder import PIPELINES
+from ..mask_cache import canonical_rle
+from ..image_shard import ImageShardReader
 from transformers import XLMRobertaTokenizer
 import cv2
 from copy import deepcopy
@@ -37,7 +39,11 @@ class LoadImageAnnotationsFromFile(object):
             Defaults to 'color'.
         file_client_args (dict): Arguments to instantiate a FileClient.
             See :class:`mmcv.fileio.FileClient` for details.
-            Defaults to ``dict(backend='disk')``.
+            Defaults to ``dict(backend='disk')``. ``dict(backend='shard',
+            shard_dir=...)`` reads pre-downscaled images written by
+            tools/data_process/build_image_shards.py, shard_dir is a dict
+            keyed by data_source for the Mixed dataset. "ori_shape" is then
+            the shard resolution and bboxes / masks are rescaled onto it.
     """
 
     def __init__(
@@ -50,6 +56,8 @@ class LoadImageAnnotationsFromFile(object):
         with_bbox=False,
         with_mask=False,
         use_token_type="default",  # bert, copus
+        use_token_cache=False,
+        use_mask_cache=False,
     ):
         self.color_type = color_type
         self.backend = backend
@@ -73,6 +81,10 @@ class LoadImageAnnotationsFromFile(object):
         ]
         self.dataset = dataset
         self.use_token_type = use_token_type
+        # the dataset fills results["expr_tokens"] from a pre-tokenized cache
+        self.use_token_cache = use_token_cache and use_token_type in ["bert", "beit3"]
+        # the dataset fills results["mask_rle"] from the pre-merged mask cache
+        self.use_mask_cache = use_mask_cache and with_mask
         if use_token_type == "bert":
             self.tokenizer = BertTokenizer.from_pretrained(
                 "bert-base-uncased", do_lower_case="uncased"
@@ -83,10 +95,18 @@ class LoadImageAnnotationsFromFile(object):
             self.eos_token_id = self.tokenizer.eos_token_id
             self.pad_token_id = self.tokenizer.pad_token_id
 
-    def _load_img(self, results):
+    def _shard_reader(self, results):
         if self.file_client is None:
-            self.file_client = mmcv.FileClient(**self.file_client_cfg)
+            shard_dir = self.file_client_cfg["shard_dir"]
+            if isinstance(shard_dir, dict):
+                self.file_client = {source: ImageShardReader(d) for source, d in shard_dir.items()}
+            else:
+                self.file_client = ImageShardReader(shard_dir)
+        if isinstance(self.file_client, dict):
+            return self.file_client[results["ann"]["data_source"]]
+        return self.file_client
 
+    def _load_img(self, results):
         if "ReferItGame" in self.dataset or "Flickr30k" in self.dataset:
             filepath = osp.join(
                 results["imgsfile"], "%d.jpg" % results["ann"]["image_id"]
@@ -101,8 +121,18 @@ class LoadImageAnnotationsFromFile(object):
             img_name = "COCO_train2014_%012d.jpg" if "coco" in data_source else "%d.jpg"
             img_name = img_name % results["ann"]["image_id"]
             filepath = osp.join(results["imgsfile"][data_source], img_name)
-        img_bytes = self.file_client.get(filepath)
-        img = mmcv.imfrombytes(img_bytes, flag=self.color_type, backend=self.backend)
+
+        if self.file_client_cfg["backend"] == "shard":
+            # pre-downscaled image, annotations are mapped onto it in _load_bbox/_load_mask
+            img, (ori_h, ori_w) = self._shard_reader(results).get(filepath, self.color_type, self.backend)
+            h, w = img.shape[:2]
+            if (h, w) != (ori_h, ori_w):
+                results["img_rescale_factor"] = numpy.array([w / ori_w, h / ori_h, w / ori_w, h / ori_h], dtype=numpy.float64)
+        else:
+            if self.file_client is None:
+                self.file_client = mmcv.FileClient(**self.file_client_cfg)
+            img_bytes = self.file_client.get(filepath)
+            img = mmcv.imfrombytes(img_bytes, flag=self.color_type, backend=self.backend)
 
         results["filename"] = filepath
         results["img"] = img
@@ -161,14 +191,8 @@ class LoadImageAnnotationsFromFile(object):
         results["expression"] = expression
         results["max_token"] = self.max_token
         return results
-    
-    def _load_expression_tokenize_beit3(self, results):
-        expressions = results["ann"]["expressions"]
-        # choice always the same if 'val'/'test'/'testA'/'testB'
-        self.random_ind = np.random.choice(list(range(len(expressions))))
-        expression = expressions[self.random_ind]
-        expression = clean_string(expression)
-        
+
+    def _tokenize_beit3(self, expression):
         tokens = self.tokenizer.tokenize(expression)
         tokens = self.tokenizer.convert_tokens_to_ids(tokens)
 
@@ -180,9 +204,53 @@ class LoadImageAnnotationsFromFile(object):
 
         tokens = [self.bos_token_id] + tokens[:] + [self.eos_token_id]
         num_tokens = len(tokens)
-        padding_mask = [0] * num_tokens + [1] * (self.max_token - num_tokens)
         ref_expr_inds = tokens + [self.pad_token_id] * (self.max_token - num_tokens)
-    
+        return ref_expr_inds, num_tokens
+
+    def encode_expression(self, expression):
+        """Returns the padded token ids of a cleaned expression and the number
+        of non-padding tokens, used to build the token cache."""
+        if self.use_token_type == "beit3":
+            return self._tokenize_beit3(expression)
+        elif self.use_token_type == "bert":
+            encodding = self.tokenizer(expression, padding="max_length", truncation=True, max_length=self.max_token)
+            return encodding.data["input_ids"], sum(encodding.data["attention_mask"])
+        raise TypeError(f"token cache is not supported for use_token_type={self.use_token_type}")
+
+    def _load_expression_from_cache(self, results):
+        expressions = results["ann"]["expressions"]
+        # choice always the same if 'val'/'test'/'testA'/'testB'
+        self.random_ind = np.random.choice(list(range(len(expressions))))
+        # cleaned when the cache was built
+        ids, lengths, cleaned = results.pop("expr_tokens")
+        expression = cleaned[self.random_ind]
+        num_tokens = int(lengths[self.random_ind])
+        if num_tokens == 0:
+            raise RuntimeError("The text segment should contains at least one tokens!")
+        positions = np.arange(self.max_token)
+        if self.use_token_type == "beit3":
+            # padding mask, 1 means ignored
+            text_attention_mask = (positions >= num_tokens).astype(int)
+        else:
+            # attention mask, 1 means valid
+            text_attention_mask = (positions < num_tokens).astype(int)
+
+        results["ref_expr_inds"] = ids[self.random_ind].astype(int)
+        results["text_attention_mask"] = text_attention_mask
+        results["expression"] = expression
+        results["max_token"] = self.max_token
+        return results
+
+    def _load_expression_tokenize_beit3(self, results):
+        expressions = results["ann"]["expressions"]
+        # choice always the same if 'val'/'test'/'testA'/'testB'
+        self.random_ind = np.random.choice(list(range(len(expressions))))
+        expression = expressions[self.random_ind]
+        expression = clean_string(expression)
+
+        ref_expr_inds, num_tokens = self._tokenize_beit3(expression)
+        padding_mask = [0] * num_tokens + [1] * (self.max_token - num_tokens)
+
         results["ref_expr_inds"] = np.array(ref_expr_inds, dtype=int)
         results["text_attention_mask"] = np.array(padding_mask, dtype=int)
         results["expression"] = expression
@@ -222,13 +290,15 @@ class LoadImageAnnotationsFromFile(object):
             gt_bbox[2] = gt_bbox[0] + gt_bbox[2]
             gt_bbox[3] = gt_bbox[1] + gt_bbox[3]
             gt_bbox = numpy.array(gt_bbox, dtype=numpy.float64)  # x1, y1, x2, y2
+            if "img_rescale_factor" in results:
+                gt_bbox = gt_bbox * results["img_rescale_factor"]
             h, w = results["ori_shape"][:2]
             gt_bbox[0::2] = numpy.clip(gt_bbox[0::2], 0, w - 1)
             gt_bbox[1::2] = numpy.clip(gt_bbox[1::2], 0, h - 1)
             results["gt_bbox"] = gt_bbox
         results["with_bbox"] = self.with_bbox
         return results
-    
+
     def _load_bboxes(self, results):
         if self.with_bbox:
             gt_bboxes = copy.deepcopy(results["ann"]["bbox"][self.random_ind])
@@ -237,6 +307,8 @@ class LoadImageAnnotationsFromFile(object):
                 gt_bbox[2] = gt_bbox[0] + gt_bbox[2]
                 gt_bbox[3] = gt_bbox[1] + gt_bbox[3]
                 gt_bbox = numpy.array(gt_bbox, dtype=numpy.float64)  # x1, y1, x2, y2
+                if "img_rescale_factor" in results:
+                    gt_bbox = gt_bbox * results["img_rescale_factor"]
                 h, w = results["ori_shape"][:2]
                 gt_bbox[0::2] = numpy.clip(gt_bbox[0::2], 0, w - 1)
                 gt_bbox[1::2] = numpy.clip(gt_bbox[1::2], 0, h - 1)
@@ -251,18 +323,25 @@ class LoadImageAnnotationsFromFile(object):
             mask = results["ann"]["mask"]
             h, w = results["ori_shape"][:2]
 
-            is_crowd = 0
-            if isinstance(mask, list):  # polygon
-                rles = maskUtils.frPyObjects(mask, h, w)
-                if len(rles) > 1:
-                    is_crowd = 1
-                # sometimes there are multiple binary map (corresponding to multiple segs)
-                rle = maskUtils.merge(rles)
+            cached = results.pop("mask_rle", None)
+            if cached is not None and list(cached[0]["size"]) == [h, w]:
+                # already merged offline and built fresh for this sample, no copy needed
+                rle, is_crowd = cached
+                gt_ori_mask = dict(rle)
             else:
-                rle = mask
+                if "img_rescale_factor" in results and isinstance(mask, list):
+                    # polygons are rasterized directly at the shard resolution
+                    w_scale, h_scale = results["img_rescale_factor"][:2]
+                    mask = [[coord * (w_scale if i % 2 == 0 else h_scale) for i, coord in enumerate(poly)] for poly in mask]
+                rle, is_crowd = canonical_rle(mask, h, w)
+                if list(rle["size"]) != [h, w]:
+                    # rle annotated at the original resolution
+                    resized = BitmapMasks(maskUtils.decode(rle)[None], *rle["size"]).resize((h, w)).masks[0]
+                    rle = maskUtils.encode(numpy.asfortranarray(resized))
+                gt_ori_mask = deepcopy(rle)
             mask = maskUtils.decode(rle)
             mask = BitmapMasks(mask[None], h, w)
-            results["gt_ori_mask"] = deepcopy(rle)
+            results["gt_ori_mask"] = gt_ori_mask
             results["gt_mask"] = mask
             results["gt_mask_rle"] = rle  # {'size':, 'counts'}
             results["is_crowd"] = is_crowd
@@ -272,7 +351,9 @@ class LoadImageAnnotationsFromFile(object):
 
     def __call__(self, results):
         results = self._load_img(results)
-        if self.use_token_type=="bert":
+        if "expr_tokens" in results:
+            results = self._load_expression_from_cache(results)
+        elif self.use_token_type=="bert":
             results = self._load_expression_tokenize(results)
         elif self.use_token_type=="default":
             results = self._load_expression(results)
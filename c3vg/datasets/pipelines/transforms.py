@@ -108,6 +108,9 @@ class Resize(object):
             dict: Resized results, 'img_shape', 'pad_shape', 'scale_factor', \
                 'keep_ratio' keys are added into result dict.
         """
+        if results.get("device_augment", False):
+            # done batched on the training device by DeviceAugment
+            return results
         self._random_scale(results)
         self._resize_img(results)
         self._resize_bbox(results)
@@ -146,6 +149,9 @@ class Normalize:
             dict: Normalized results, 'img_norm_cfg' key is added into
                 result dict.
         """
+        if results.get("device_augment", False):
+            # done batched on the training device by DeviceAugment
+            return results
         results["img"] = mmcv.imnormalize(results["img"], self.mean, self.std, self.to_rgb)
         results["img_norm_cfg"] = dict(mean=self.mean, std=self.std, to_rgb=self.to_rgb)
         return results
@@ -210,6 +216,9 @@ class Pad:
         Returns:
             dict: Updated result dict.
         """
+        if results.get("device_augment", False):
+            # done batched on the training device by DeviceAugment
+            return results
         self._pad_img(results)
         self._pad_masks(results)
         return results
@@ -223,6 +232,83 @@ class Pad:
         return repr_str
 
 
+@PIPELINES.register_module()
+class ResizeNormalizePad(object):
+    """Resize (keep_ratio=False), Normalize and Pad fused into one pass.
+
+    The resized uint8 image is mapped through a per-channel lookup table of
+    the normalized values straight into a padded CHW float32 buffer, which
+    :class:`DefaultFormatBundle` wraps without another transpose. The table is
+    built with :func:`mmcv.imnormalize` itself, so the output is bit-identical
+    to Resize -> Normalize -> Pad -> DefaultFormatBundle.
+
+    Args:
+        img_scale (tuple or list[tuple]): as in :class:`Resize`.
+        mean (sequence): as in :class:`Normalize`.
+        std (sequence): as in :class:`Normalize`.
+        to_rgb (bool): as in :class:`Normalize`.
+        size (tuple, optional): as in :class:`Pad`.
+        size_divisor (int, optional): as in :class:`Pad`.
+        pad_val (float): as in :class:`Pad`.
+    """
+
+    def __init__(self, img_scale, mean, std, to_rgb=True, size=None, size_divisor=None, pad_val=0, interpolation="bilinear", backend="cv2"):
+        self.resize = Resize(img_scale=img_scale, keep_ratio=False, interpolation=interpolation, backend=backend)
+        self.normalize = Normalize(mean, std, to_rgb=to_rgb)
+        self.pad = Pad(size=size, size_divisor=size_divisor, pad_val=pad_val)
+        ramp = numpy.repeat(numpy.arange(256, dtype=numpy.uint8)[None, :, None], 3, axis=2)
+        # [3, 256], normalized value of every uint8 input of each output channel
+        self.lut = numpy.ascontiguousarray(mmcv.imnormalize(ramp, self.normalize.mean, self.normalize.std, to_rgb)[0].T)
+        self.channel_order = [2, 1, 0] if to_rgb else [0, 1, 2]
+
+    def _pad_shape(self, h, w):
+        if self.pad.size is not None:
+            return self.pad.size[0], self.pad.size[1]
+        divisor = self.pad.size_divisor
+        return int(numpy.ceil(h / divisor)) * divisor, int(numpy.ceil(w / divisor)) * divisor
+
+    def __call__(self, results):
+        if results.get("device_augment", False):
+            # done batched on the training device by DeviceAugment
+            return results
+        self.resize._random_scale(results)
+        img, w_scale, h_scale = mmcv.imresize(
+            results["img"], results["scale"], return_scale=True, interpolation=self.resize.interpolation, backend=self.resize.backend
+        )
+        h, w = img.shape[:2]
+        pad_h, pad_w = self._pad_shape(h, w)
+        assert pad_h >= h and pad_w >= w
+        out = numpy.full((len(self.channel_order), pad_h, pad_w), self.pad.pad_val, dtype=numpy.float32)
+        for c, src_c in enumerate(self.channel_order):
+            numpy.take(self.lut[c], img[..., src_c], out=out[c, :h, :w], mode="clip")
+
+        results["img"] = out
+        results["img_chw"] = True
+        results["img_shape"] = img.shape
+        results["pad_shape"] = (pad_h, pad_w, img.shape[2])
+        results["scale_factor"] = numpy.array([w_scale, h_scale, w_scale, h_scale], dtype=numpy.float32)
+        results["keep_ratio"] = False
+        results["img_norm_cfg"] = dict(mean=self.normalize.mean, std=self.normalize.std, to_rgb=self.normalize.to_rgb)
+        results["pad_fixed_size"] = self.pad.size
+        results["pad_size_divisor"] = self.pad.size_divisor
+
+        self.resize._resize_bbox(results)
+        if results["with_mask"]:
+            # encoded once, at the padded resolution
+            results["gt_mask"] = results["gt_mask"].resize((h, w)).pad((pad_h, pad_w), pad_val=self.pad.pad_val)
+            results["gt_mask_rle"] = maskUtils.encode(numpy.asfortranarray(results["gt_mask"].masks[0]))
+        return results
+
+    def __repr__(self):
+        repr_str = self.__class__.__name__
+        repr_str += f"(img_scale={self.resize.img_scale}, "
+        repr_str += f"mean={self.normalize.mean}, std={self.normalize.std}, to_rgb={self.normalize.to_rgb}, "
+        repr_str += f"size={self.pad.size}, "
+        repr_str += f"size_divisor={self.pad.size_divisor}, "
+        repr_str += f"pad_val={self.pad.pad_val})"
+        return repr_str
+
+
 @PIPELINES.register_module()
 class LargeScaleJitter:
     # placed right after loading the image from disk
@@ -235,22 +321,63 @@ class LargeScaleJitter:
         self.min_iou_thr = min_iou_thr
         self.jitter_times = 100
 
-    def _bbox_overlaps(self, crop_bbox, gt_bbox):
-        lt = numpy.maximum(crop_bbox[:2], gt_bbox[:2])
-        rb = numpy.minimum(crop_bbox[2:], gt_bbox[2:])
+    def _bbox_overlaps(self, crop_bboxes, gt_bbox):
+        """Overlap of every crop in crop_bboxes ([..., 4]) with gt_bbox, over the gt_bbox area."""
+        lt = numpy.maximum(crop_bboxes[..., :2], gt_bbox[:2])
+        rb = numpy.minimum(crop_bboxes[..., 2:], gt_bbox[2:])
         wh = rb - lt
-        overlap = wh[0] * wh[1]
+        overlap = wh[..., 0] * wh[..., 1]
         area_gt_bbox = (gt_bbox[2] - gt_bbox[0]) * (gt_bbox[3] - gt_bbox[1])
         return overlap / area_gt_bbox
 
-    def _mask_overlaps(self, crop_bbox, gt_mask):
+    def _mask_overlaps(self, crop_bboxes, gt_mask):
+        """Overlap of every crop in crop_bboxes ([..., 4], integer) with gt_mask, over the mask area.
+
+        Uses a summed-area table with a zero first row / column, so that each
+        crop costs four lookups instead of a full-size crop mask.
+        """
         h, w = gt_mask.height, gt_mask.width
-        crop_mask = numpy.zeros((h, w), dtype=numpy.uint8)
-        crop_mask[crop_bbox[1] : crop_bbox[3], crop_bbox[0] : crop_bbox[2]] = 1
-        overlap = numpy.logical_and(crop_mask, gt_mask.masks[0])
-        return numpy.sum(overlap) / gt_mask.areas
+        sat = numpy.zeros((h + 1, w + 1), dtype=numpy.int64)
+        sat[1:, 1:] = gt_mask.masks[0].cumsum(0, dtype=numpy.int64).cumsum(1)
+        crop_bboxes = crop_bboxes.astype(numpy.int64)
+        x1, x2 = numpy.clip(crop_bboxes[..., 0], 0, w), numpy.clip(crop_bboxes[..., 2], 0, w)
+        y1, y2 = numpy.clip(crop_bboxes[..., 1], 0, h), numpy.clip(crop_bboxes[..., 3], 0, h)
+        overlap = sat[y2, x2] - sat[y1, x2] - sat[y2, x1] + sat[y1, x1]
+        return overlap / gt_mask.areas[0]
+
+    def _search_crop(self, new_w, new_h, w_out, h_out, overlaps):
+        """Samples every crop proposal of the threshold cascade at once.
+
+        Args:
+            overlaps (callable): maps crop proposals [..., 4] to their overlaps.
+
+        Returns:
+            numpy.ndarray | None: the first proposal passing the highest reached
+                threshold, else the best proposal, None if it is below min_iou_thr.
+        """
+        crop_iou_thr = numpy.array(self.crop_iou_thr[::-1])
+        # [num_thr, jitter_times, 4]
+        offsets = numpy.random.random((len(crop_iou_thr), self.jitter_times, 2)) * numpy.array([new_w - w_out, new_h - h_out])
+        crop_bboxes = numpy.concatenate([offsets, offsets + numpy.array([w_out, h_out])], axis=-1)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            ious = overlaps(crop_bboxes)
+        # nan neither passes a threshold nor becomes the best proposal
+        ious = numpy.where(numpy.isnan(ious), -numpy.inf, ious)
+        hits = ious >= crop_iou_thr[:, None]
+        if hits.any():
+            i = hits.any(axis=1).argmax()
+            return crop_bboxes[i, hits[i].argmax()]
+        best_iou = max(ious.max(), 0)
+        if best_iou < self.min_iou_thr:
+            return None
+        # the first best proposal, or the last one if none overlaps
+        best_idx = ious.argmax() if best_iou > 0 else -1
+        return crop_bboxes.reshape(-1, 4)[best_idx]
 
     def __call__(self, results):
+        if results.get("device_augment", False):
+            # done batched on the training device by DeviceAugment
+            return results
         img = results["img"]
         h, w = results["ori_shape"][:2]
         with_bbox, with_mask = results["with_bbox"], results["with_mask"]
@@ -279,35 +406,20 @@ class LargeScaleJitter:
         # only crop here, pad will do the job when rand_scale < 1
         if rand_scale > 1.0:
             w_out, h_out = mmcv.rescale_size((w, h), mmcv.utils.to_2tuple(self.out_max_size))
-            flag, best_idx, best_iou, history = False, -1, 0, []
-            for i, iou_thr in enumerate(self.crop_iou_thr[::-1]):
-                if not flag:
-                    for iter in range(self.jitter_times):
-                        offset = (random.random() * (new_w - w_out), random.random() * (new_h - h_out))
-                        crop_bbox = numpy.array([offset[0], offset[1], offset[0] + w_out, offset[1] + h_out])
-                        if with_bbox:  # rec & res default to rec
-                            iou = self._bbox_overlaps(crop_bbox, gt_bbox)
-                        elif with_mask:
-                            iou = self._mask_overlaps(crop_bbox.astype(numpy.uint32), gt_mask)
-                        history.append(crop_bbox)
-                        if iou > best_iou:
-                            best_iou = iou
-                            best_idx = i * self.jitter_times + iter
-                        if iou >= iou_thr:
-                            flag = True
-                            break
-            if not flag:
-                # escape, do nothing
-                if best_iou < self.min_iou_thr:
-                    # do nothing
-                    results["img_shape"] = img.shape
-                    # in case that there is no padding
-                    results["pad_shape"] = img.shape
-                    results["scale_factor"] = numpy.array([1.0, 1.0, 1.0, 1.0])
-                    results["keep_ratio"] = True
-                    return results
-
-                crop_bbox = history[best_idx]
+            if with_bbox:  # rec & res default to rec
+                crop_bbox = self._search_crop(new_w, new_h, w_out, h_out, lambda crop_bboxes: self._bbox_overlaps(crop_bboxes, gt_bbox))
+            elif with_mask:
+                crop_bbox = self._search_crop(new_w, new_h, w_out, h_out, lambda crop_bboxes: self._mask_overlaps(crop_bboxes.astype(numpy.uint32), gt_mask))
+            # escape, do nothing
+            if crop_bbox is None:
+                # do nothing
+                results["img_shape"] = img.shape
+                # in case that there is no padding
+                results["pad_shape"] = img.shape
+                results["scale_factor"] = numpy.array([1.0, 1.0, 1.0, 1.0])
+                results["keep_ratio"] = True
+                return results
+            offset = crop_bbox[:2]
 
             crop_bbox = crop_bbox.astype(numpy.uint32)
             img = img[crop_bbox[1] : crop_bbox[3], crop_bbox[0] : crop_bbox[2]]
@@ -340,3 +452,32 @@ class LargeScaleJitter:
         results["keep_ratio"] = True
 
         return results
+
+
+@PIPELINES.register_module()
+class MaskDownsample(object):
+    """Area-downsample the padded gt_mask by `stride` into `gt_mask_down`.
+
+    The float32 `gt_mask_down` holds the fraction of every feature cell covered
+    by the mask, the target of the first-stage mask loss when the head computes
+    it at feature stride (`first_stage_loss_at_stride`). Must come after the
+    resize and pad transforms.
+
+    Args:
+        stride (int): the patch size of the visual encoder.
+    """
+
+    def __init__(self, stride=16):
+        self.stride = stride
+
+    def __call__(self, results):
+        assert not results.get("device_augment", False), "with device_augment the head pools the augmented mask on the device, drop MaskDownsample"
+        if results["with_mask"]:
+            mask = results["gt_mask"].masks[0].astype(numpy.float32)
+            h, w = mask.shape
+            assert h % self.stride == 0 and w % self.stride == 0, f"padded mask {(h, w)} is not divisible by stride {self.stride}"
+            results["gt_mask_down"] = mmcv.imresize(mask, (w // self.stride, h // self.stride), interpolation="area")
+        return results
+
+    def __repr__(self):
+        return self.__class__.__name__ + f"(stride={self.stride})"
@@ -0,0 +1,152 @@
+import time
+import torch
+import threading
+import contextlib
+from queue import Queue, Empty, Full
+from mmcv.parallel import DataContainer
+
+
+class DevicePrefetcher(object):
+    """Wraps a DataLoader so that the next batches are fetched, augmented and
+    copied to ``device`` by a background thread, on a side CUDA stream, while
+    the current batch is computed.
+
+    Yields ``(inputs, targets)``. inputs are the kwargs of the model, on the
+    device as :func:`extract_data` would return them (still DataContainers
+    when distributed, for MMDistributedDataParallel to scatter). targets hold
+    the CPU-side gt_bbox, gt_mask (RLE), is_crowd and img_metas used by the
+    metrics. With a CPU device no stream is used.
+
+    ``wait_time`` is how long the main loop waited for the last batch,
+    ``total_wait_time`` the sum over the current pass.
+
+    Args:
+        loader (DataLoader): yields collated DataContainer dicts.
+        device (torch.device): where the model lives.
+        distributed (bool): keep the inputs wrapped in DataContainer.
+        device_augment (DeviceAugment, optional): applied while staging.
+        num_prefetch (int): number of batches staged ahead.
+    """
+
+    def __init__(self, loader, device, distributed=False, device_augment=None, num_prefetch=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.distributed = distributed
+        self.device_augment = device_augment
+        self.num_prefetch = num_prefetch
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.wait_time, self.total_wait_time = 0.0, 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, data):
+        if isinstance(data, torch.Tensor):
+            return data.to(self.device, non_blocking=True)
+        elif isinstance(data, list):
+            return [self._to_device(item) for item in data]
+        return data
+
+    def _record_stream(self, data, stream):
+        # tensors allocated on the side stream must not be reused before the main stream is done with them
+        if isinstance(data, torch.Tensor):
+            if data.is_cuda:
+                data.record_stream(stream)
+        elif isinstance(data, DataContainer):
+            self._record_stream(data.data, stream)
+        elif isinstance(data, (list, tuple)):
+            for item in data:
+                self._record_stream(item, stream)
+        elif isinstance(data, dict):
+            for item in data.values():
+                self._record_stream(item, stream)
+
+    def _split(self, inputs):
+        if self.device_augment is not None:
+            inputs = self.device_augment(inputs, self.device)
+
+        targets = dict(gt_bbox=None, gt_mask=None, is_crowd=None)
+        if "gt_bbox" in inputs:
+            if isinstance(inputs["gt_bbox"], torch.Tensor):
+                inputs["gt_bbox"] = DataContainer([[inputs["gt_bbox"][ind] for ind in range(inputs["gt_bbox"].shape[0])]])
+            # the model only gets the device copy, no need to deepcopy
+            targets["gt_bbox"] = inputs["gt_bbox"].data[0]
+        if "gt_mask_rle" in inputs:
+            targets["gt_mask"] = inputs.pop("gt_mask_rle").data[0]
+        if "is_crowd" in inputs:
+            targets["is_crowd"] = inputs.pop("is_crowd").data[0]
+        targets["img_metas"] = inputs["img_metas"].data[0]
+
+        for key, value in inputs.items():
+            if self.distributed:
+                if not value.cpu_only:
+                    inputs[key] = DataContainer(self._to_device(value.data), value.stack, value.padding_value, pad_dims=value.pad_dims)
+            else:
+                inputs[key] = value.data[0] if value.cpu_only else self._to_device(value.data[0])
+        return inputs, targets
+
+    def _put(self, queue, item, stop):
+        """queue.put that gives up once the consumer has stopped."""
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _produce(self, queue, stop):
+        try:
+            if self.stream is not None:
+                torch.cuda.set_device(self.device)
+            with torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext():
+                for inputs in self.loader:
+                    batch = self._split(inputs)
+                    event = None
+                    if self.stream is not None:
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                    if not self._put(queue, (batch, event), stop):
+                        # dropping the loader iterator shuts its workers down
+                        return
+        except Exception as e:
+            self._put(queue, e, stop)
+            return
+        self._put(queue, None, stop)
+
+    def __iter__(self):
+        queue, stop = Queue(maxsize=self.num_prefetch), threading.Event()
+        thread = threading.Thread(target=self._produce, args=(queue, stop), daemon=True)
+        thread.start()
+        self.total_wait_time = 0.0
+        try:
+            while True:
+                start = time.time()
+                item = queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    self._record_stream(batch[0], current_stream)
+                self.wait_time = time.time() - start
+                self.total_wait_time += self.wait_time
+                yield batch
+        finally:
+            # also reached when the consumer stops early (break, exception)
+            stop.set()
+            while thread.is_alive():
+                self._drain(queue)
+                thread.join(timeout=0.1)
+            self._drain(queue)
+
+    @staticmethod
+    def _drain(queue):
+        while True:
+            try:
+                queue.get_nowait()
+            except Empty:
+                return
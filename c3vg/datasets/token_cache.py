@@ -0,0 +1,111 @@
+import os
+import numpy
+import hashlib
+import os.path as osp
+from functools import lru_cache
+
+import mmcv
+from c3vg.utils import get_root_logger, is_main
+
+
+@lru_cache(maxsize=None)
+def _file_md5(filepath, size, mtime_ns):
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 24), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def annsfile_hash(annsfile):
+    """md5 of the annotation file, computed once per process for all splits."""
+    stat = os.stat(annsfile)
+    return _file_md5(osp.abspath(annsfile), stat.st_size, stat.st_mtime_ns)[:16]
+
+
+class TokenCache(object):
+    """Packed token ids of every expression of one split.
+
+    ids (int32, [num_expr, max_token]) are already padded, lengths (int32,
+    [num_expr]) hold the number of non-padding tokens (0 if the expression
+    could not be tokenized), offsets (int64, [num_ann + 1]) map an annotation
+    index to its rows. text (uint8) packs the cleaned expressions as utf-8,
+    expression i being text[text_offsets[i]:text_offsets[i + 1]].
+    """
+
+    def __init__(self, ids, lengths, offsets, text, text_offsets):
+        self.ids = ids
+        self.lengths = lengths
+        self.offsets = offsets
+        self.text = text
+        self.text_offsets = text_offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ann_index):
+        start, end = self.offsets[ann_index], self.offsets[ann_index + 1]
+        expressions = [self.text[self.text_offsets[i] : self.text_offsets[i + 1]].tobytes().decode("utf-8") for i in range(start, end)]
+        return self.ids[start:end], self.lengths[start:end], expressions
+
+
+def build_token_cache(anns, loader):
+    """Tokenizes every expression of ``anns`` once with the tokenizer of ``loader``."""
+    from .pipelines.loading import clean_string
+
+    offsets = numpy.zeros(len(anns) + 1, dtype=numpy.int64)
+    ids, lengths, texts = [], [], []
+    for ind, ann in enumerate(anns):
+        for expression in ann["expressions"]:
+            expression = clean_string(expression)
+            try:
+                ref_expr_inds, num_tokens = loader.encode_expression(expression)
+            except RuntimeError:
+                ref_expr_inds, num_tokens = [0] * loader.max_token, 0
+            ids.append(ref_expr_inds)
+            lengths.append(num_tokens)
+            texts.append(expression.encode("utf-8"))
+        offsets[ind + 1] = len(ids)
+    ids = numpy.array(ids, dtype=numpy.int32).reshape(-1, loader.max_token)
+    lengths = numpy.array(lengths, dtype=numpy.int32)
+    text = numpy.frombuffer(b"".join(texts), dtype=numpy.uint8)
+    text_offsets = numpy.zeros(len(texts) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(t) for t in texts], out=text_offsets[1:])
+    return TokenCache(ids, lengths, offsets, text, text_offsets)
+
+
+def load_token_cache(annsfile, which_set, anns, loader):
+    """Loads the token cache of ``which_set``, building it on first use.
+
+    The cache is keyed by tokenizer type, max_token and the annotation file hash,
+    so a stale cache is never picked up after the annotations change.
+    """
+    cache_file = osp.join(
+        osp.dirname(annsfile),
+        "token_cache",
+        f"{osp.splitext(osp.basename(annsfile))[0]}_{which_set}_{loader.use_token_type}_{loader.max_token}_{annsfile_hash(annsfile)}.npz",
+    )
+    if osp.exists(cache_file):
+        npz = numpy.load(cache_file)
+        # caches written before the cleaned expressions were stored are rebuilt
+        if "text" in npz.files:
+            return TokenCache(npz["ids"], npz["lengths"], npz["offsets"], npz["text"], npz["text_offsets"])
+
+    token_cache = build_token_cache(anns, loader)
+    mmcv.mkdir_or_exist(osp.dirname(cache_file))
+    # write then rename so that concurrent readers never see a partial file
+    tmp_file = cache_file + f".{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        numpy.savez(
+            f,
+            ids=token_cache.ids,
+            lengths=token_cache.lengths,
+            offsets=token_cache.offsets,
+            text=token_cache.text,
+            text_offsets=token_cache.text_offsets,
+        )
+    os.replace(tmp_file, cache_file)
+    if is_main():
+        logger = get_root_logger()
+        logger.info(f"saved token cache of {which_set} at {cache_file}")
+    return token_cache
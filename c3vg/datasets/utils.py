@@ -4,7 +4,7 @@ import numpy
 import pickle
 import os.path as osp
 from typing import Sequence, Mapping
-from mmcv.parallel import DataContainer
+from mmcv.parallel import DataContainer, collate
 from torch.utils.data.dataloader import default_collate
 
 
@@ -48,6 +48,9 @@ def extract_data(inputs):
             device = get_device(data)
             if device == -1:
                 data = cpu_to_gpu(data[0], torch.cuda.current_device())
+            else:
+                # e.g. img from DeviceAugment
+                data = data[0]
             new_inputs[key] = data
     return new_inputs
 
@@ -117,6 +120,55 @@ def collate_fn(batch):
         return default_collate(batch)
 
 
+def _pin(data):
+    if isinstance(data, torch.Tensor):
+        return data.pin_memory()
+    elif isinstance(data, list):
+        return [_pin(item) for item in data]
+    return data
+
+
+class PinnedDataContainer(DataContainer):
+    """A collated DataContainer that DataLoader(pin_memory=True) pins, the plain
+    DataContainer is left as is by the pin memory thread."""
+
+    def pin_memory(self):
+        if self.cpu_only:
+            return self
+        return PinnedDataContainer(_pin(self.data), self.stack, self.padding_value, cpu_only=False, pad_dims=self.pad_dims)
+
+
+def fixed_size_collate(batch, samples_per_gpu=1):
+    """Collate that stacks same-shape samples (img, ref_expr_inds,
+    text_attention_mask) with a single copy straight into the batch tensor, in
+    shared memory when run by a worker.
+
+    Ragged keys (img_metas, gt_mask_rle, is_crowd, gt_bbox) stay per-sample
+    lists, images of different shapes fall back to the padding of
+    :func:`mmcv.parallel.collate`. The output has the same layout as
+    :func:`mmcv.parallel.collate` and can be pinned by the DataLoader.
+    """
+    if not isinstance(batch, Sequence):
+        raise TypeError(f"{batch.dtype} is not supported.")
+    assert isinstance(batch[0], Mapping)
+
+    collated = {}
+    for key in batch[0]:
+        samples = [sample[key] for sample in batch]
+        if not isinstance(samples[0], DataContainer):
+            collated[key] = collate(samples, samples_per_gpu=samples_per_gpu)
+            continue
+        chunks = [samples[i : i + samples_per_gpu] for i in range(0, len(samples), samples_per_gpu)]
+        if samples[0].cpu_only or not samples[0].stack:
+            data = [[sample.data for sample in chunk] for chunk in chunks]
+        elif all(sample.data.shape == samples[0].data.shape for sample in samples):
+            data = [default_collate([sample.data for sample in chunk]) for chunk in chunks]
+        else:
+            data = collate(samples, samples_per_gpu=samples_per_gpu).data
+        collated[key] = PinnedDataContainer(data, samples[0].stack, samples[0].padding_value, cpu_only=samples[0].cpu_only, pad_dims=samples[0].pad_dims)
+    return collated
+
+
 def build_word_emb_loader(cfg):
     word_emb_loader = None
     if cfg is not None:
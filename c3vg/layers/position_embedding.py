@@ -71,6 +71,19 @@ class PositionEmbeddingSine(nn.Module):
         self.scale = scale
         self.eps = eps
         self.offset = offset
+        self._unmasked_cache = {}
+
+    def forward_unmasked(self, batch_size: int, size, device) -> torch.Tensor:
+        """Position embedding of an all-valid mask of `size` `(h, w)`.
+
+        It only depends on the shape, so it is computed once per size and
+        device and returned as an expanded view of shape
+        `(bs, num_pos_feats * 2, h, w)`.
+        """
+        key = (tuple(size), torch.device(device))
+        if key not in self._unmasked_cache:
+            self._unmasked_cache[key] = self.forward(torch.zeros((1, *size), dtype=torch.bool, device=device))
+        return self._unmasked_cache[key].expand(batch_size, -1, -1, -1)
 
     def forward(self, mask: torch.Tensor, **kwargs) -> torch.Tensor:
         """Forward function for `PositionEmbeddingSine`.
@@ -132,17 +145,29 @@ class PositionEmbeddingSine1D(nn.Module):
         self.scale = scale
         self.eps = eps
         self.offset = offset
+        self._table_cache = {}
 
     def forward(self, text: torch.Tensor) -> torch.Tensor:
         """Forward function for `PositionEmbeddingSine1D`.
 
+        The table only depends on (seq_len, emb_dim), it is built once per
+        shape, device and dtype and cached.
+
         Args:
             text (torch.Tensor): Input text tensor. Shape as `(bs, seq_len, emb_dim)`.
 
         Returns:
-            torch.Tensor: Returned position embedding with shape `(bs, seq_len, num_pos_feats * 2)`.
+            torch.Tensor: Returned position embedding with shape `(seq_len, emb_dim)`,
+            on the device and with the dtype of `text`.
         """
         pos_len, dim = text.shape[1:]
+        key = (pos_len, dim, text.device, text.dtype)
+        if key not in self._table_cache:
+            self._table_cache[key] = self._build_table(pos_len, dim).to(device=text.device, dtype=text.dtype)
+        return self._table_cache[key]
+
+    @staticmethod
+    def _build_table(pos_len, dim):
         assert dim % 2 == 0, "wrong dimension!"
         position_emb = torch.zeros(pos_len, dim, dtype=torch.float)
         # i矩阵
@@ -8,7 +8,7 @@ import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from c3vg.utils import is_main
 import os
-from ..utils import xywh_to_x1y1x2y2
+from ..utils import xywh_to_x1y1x2y2, LazyMasks
 from ..heads.uni_head import get_maskouterbox
 import cv2
 
@@ -116,6 +116,8 @@ class MIXUniModel(OneStageModel):
         gt_mask_vertices=None,
         mass_center=None,
         gt_mask=None,
+        gt_mask_seg=None,
+        gt_mask_down=None,
         rescale=False,
         epoch=None,
         visual=True,
@@ -137,6 +139,15 @@ class MIXUniModel(OneStageModel):
         gt_mask_vertices (list[tensor]): [batch_size, 2, num_ray], padded values are -1,
             the coordinates are in 'pad_shape' scale.
 
+        gt_mask (list[dict]): gt masks as RLE at `pad_shape`, for the metrics
+            and the visualization.
+
+        gt_mask_seg (tensor): [batch_size, h_batch, w_batch], uint8 gt masks
+            decoded by the data pipeline. The head decodes gt_mask when absent.
+
+        gt_mask_down (tensor): [batch_size, h_batch // patch_size, w_batch // patch_size],
+            area-downsampled gt masks from `MaskDownsample`, optional.
+
         rescale (bool): whether to rescale predictions from `img_shape`/`pad_shape`
             back to `ori_shape`.
 
@@ -145,15 +156,16 @@ class MIXUniModel(OneStageModel):
         img_feat, text_feat, cls_feat = self.extract_visual_language(img, ref_expr_inds, text_attention_mask)
         img_feat = img_feat.transpose(-1, -2).reshape(B, -1, H // self.patch_size, W // self.patch_size)  # (B, C, H, W)
 
-        targets = {"mask": gt_mask, "bbox": gt_bbox, "img_metas": img_metas, "epoch": epoch}
+        targets = {"mask": gt_mask, "mask_seg": gt_mask_seg, "mask_down": gt_mask_down, "bbox": gt_bbox, "img_metas": img_metas, "epoch": epoch}
 
-        losses_dict, pred_dict, extra_dict = self.head.forward_train(img_feat, targets, cls_feat, text_feat, text_attention_mask, img)
+        self.iter += 1
+        visual = is_main() and self.iter % 3 == 0 and self.visualize and visual
+        losses_dict, pred_dict, extra_dict = self.head.forward_train(img_feat, targets, cls_feat, text_feat, text_attention_mask, img, with_extra=visual)
 
         with torch.no_grad():
             predictions = self.get_predictions(pred_dict, img_metas, rescale=rescale, threshold=self.threshold)
 
-        self.iter += 1
-        if is_main() and self.iter % 3 == 0 and self.visualize and visual:
+        if visual:
             self.visualiation(pred_dict, img_metas, targets, self.train_mask_save_target_dir, extra_dict)
 
         return losses_dict, predictions
@@ -165,8 +177,8 @@ class MIXUniModel(OneStageModel):
             pred_dict["pred_bbox"][0],
             # maskouterbbox.int().cpu().detach().numpy(),
             pred_dict["pred_mask"][0],
-            pred_dict["pred_bbox_first"][0],
-            pred_dict["pred_mask_first"][0],
+            pred_dict.get("pred_bbox_first", pred_dict["pred_bbox"])[0],
+            pred_dict.get("pred_mask_first", pred_dict["pred_mask"])[0],
             save_filename=save_filename,
             img_metas=img_metas[0],
             text=None,
@@ -230,16 +242,25 @@ class MIXUniModel(OneStageModel):
 
         targets = {"mask": gt_mask, "bbox": gt_bbox, "img_metas": img_metas}
 
-        pred_dict, extra_dict = self.head.forward_test(img_feat, cls_feat, text_feat, text_attention_mask, img)
+        self.iter += 1
+        visual = is_main() and self.iter % 3 == 0 and self.visualize and visual
+        pred_dict, extra_dict = self.head.forward_test(img_feat, cls_feat, text_feat, text_attention_mask, img, with_extra=visual)
 
         predictions = self.get_predictions(pred_dict, img_metas, rescale=rescale, threshold=self.threshold)
 
-        self.iter += 1
-        if is_main() and self.iter % 3 == 0 and self.visualize and visual:
+        if visual:
             self.visualiation(pred_dict, img_metas, targets, self.val_mask_save_target_dir, extra_dict)
 
         return predictions
 
+    def _binarize_masks(self, mask_seg, img_metas, rescale, threshold):
+        """Thresholds the mask logits at `pad_shape` into :class:`LazyMasks`,
+        resized to `ori_shape` if rescale."""
+        mask_binary = mask_seg.sigmoid().squeeze(1) >= threshold
+        if rescale:
+            return LazyMasks.rescale(mask_binary, [tuple(img_meta["ori_shape"][:2]) for img_meta in img_metas])
+        return LazyMasks(mask_binary)
+
     def get_predictions(self, pred, img_metas, rescale=False, threshold=0.5):
         """Args:
         seq_out_dict (dict[tensor]): [batch_size, 4/2*num_ray+1].
@@ -282,37 +303,9 @@ class MIXUniModel(OneStageModel):
                 pred_bboxes_first.append(output_bbox)
 
         if mask_seg is not None:
-            mask_binary = mask_seg.sigmoid().squeeze(1)
-            mask_binary[mask_binary < threshold] = 0.0
-            mask_binary[mask_binary >= threshold] = 1.0
-            for mask, img_meta in zip(mask_binary, img_metas):
-                h_pad, w_pad = img_meta["pad_shape"][:2]
-                # h, w = img_meta['img_shape'][:2]
-                pred_rle = maskUtils.encode(numpy.asfortranarray(mask.cpu().numpy().astype(np.uint8)))
-                if rescale:
-                    h_img, w_img = img_meta["ori_shape"][:2]
-                    pred_mask = BitmapMasks(maskUtils.decode(pred_rle)[None], h_pad, w_pad)
-                    pred_mask = pred_mask.resize((h_img, w_img))
-                    pred_mask = pred_mask.masks[0]
-                    pred_mask = numpy.asfortranarray(pred_mask)
-                    pred_rle = maskUtils.encode(pred_mask)  # dict
-                pred_masks.append(pred_rle)
+            pred_masks = self._binarize_masks(mask_seg, img_metas, rescale, threshold)
 
         if mask_seg_first_stage is not None:
-            mask_binary = mask_seg_first_stage.sigmoid().squeeze(1)
-            mask_binary[mask_binary < threshold] = 0.0
-            mask_binary[mask_binary >= threshold] = 1.0
-            for mask, img_meta in zip(mask_binary, img_metas):
-                h_pad, w_pad = img_meta["pad_shape"][:2]
-                # h, w = img_meta['img_shape'][:2]
-                pred_rle = maskUtils.encode(numpy.asfortranarray(mask.cpu().numpy().astype(np.uint8)))
-                if rescale:
-                    h_img, w_img = img_meta["ori_shape"][:2]
-                    pred_mask = BitmapMasks(maskUtils.decode(pred_rle)[None], h_pad, w_pad)
-                    pred_mask = pred_mask.resize((h_img, w_img))
-                    pred_mask = pred_mask.masks[0]
-                    pred_mask = numpy.asfortranarray(pred_mask)
-                    pred_rle = maskUtils.encode(pred_mask)  # dict
-                pred_masks_first.append(pred_rle)
+            pred_masks_first = self._binarize_masks(mask_seg_first_stage, img_metas, rescale, threshold)
 
         return dict(pred_bboxes=pred_bboxes, pred_masks=pred_masks, pred_bboxes_first=pred_bboxes_first, pred_masks_first=pred_masks_first)
@@ -85,22 +85,16 @@ class QueryAugment(nn.Module):
         self.query_embed = nn.Embedding(num_queries, hidden_channels)
 
     def x_mask_pos_enc(self, x, img_shape):
-        batch_size = x.size(0)
-        input_img_h, input_img_w = img_shape
-        x_mask = x.new_ones((batch_size, input_img_h, input_img_w))
-        for img_id in range(batch_size):
-            img_h, img_w = img_shape
-            x_mask[img_id, :img_h, :img_w] = 0
-
-        x_mask = F.interpolate(x_mask.unsqueeze(1), size=x.size()[-2:]).to(torch.bool).squeeze(1)
-        x_pos_embeds = self.position_embedding(x_mask)
+        # the features are not padded, the mask is all valid and the embedding only depends on the feature shape
+        x_mask = x.new_zeros((x.size(0), *x.shape[-2:]), dtype=torch.bool)
+        x_pos_embeds = self.position_embedding.forward_unmasked(x.size(0), x.shape[-2:], x.device)
         return x_mask, x_pos_embeds
 
     def forward(self, box_feat, img_feat, lan_feat, lan_mask):
         # ! query 2 text cross attention
         query_embed_input = self.query_embed.weight.unsqueeze(0).repeat(lan_feat.shape[0], 1, 1).transpose(0, 1)
         query_embed_input = box_feat + query_embed_input
-        text_pos_embed = self.position_embedding_1d(lan_feat).unsqueeze(0).repeat(lan_feat.shape[0], 1, 1).permute(1, 0, 2).cuda()
+        text_pos_embed = self.position_embedding_1d(lan_feat).unsqueeze(1)  # (L,1,C), broadcast over the batch
         text_feat_input = lan_feat.transpose(0, 1)
         query_embed = self.query2text_crossattn(
             query=torch.zeros_like(query_embed_input),
@@ -140,9 +134,10 @@ class BoxSegPooler(nn.Module):
         # ROI Align
         # bbox_feat = self.box_align(img_feat, [bbox_x1y1x2y2])
         # ROI Pooling
-        batch_indices = torch.arange(B).unsqueeze(1).cuda()
+        batch_indices = torch.arange(B, device=bbox.device, dtype=bbox_x1y1x2y2.dtype).unsqueeze(1)
         rois = torch.cat([batch_indices, bbox_x1y1x2y2], dim=1).float()
-        bbox_feat = roi_pool(img_feat, rois, output_size=(1, 1))
+        # roi_pool in fp32, as torchvision's CUDA autocast would do, on any device
+        bbox_feat = roi_pool(img_feat.float(), rois, output_size=(1, 1))
         # avg pooling
         bbox_feat = self.box_pooler(bbox_feat).reshape(B, C)
         # * seg pooling
@@ -265,15 +260,9 @@ class BoxSegAttention(nn.Module):
         self.seg_query_embed = nn.Embedding(int(H * W / 16 / 16), input_channels)
 
     def x_mask_pos_enc(self, x, img_shape):
-        batch_size = x.size(0)
-        input_img_h, input_img_w = img_shape
-        x_mask = x.new_ones((batch_size, input_img_h, input_img_w))
-        for img_id in range(batch_size):
-            img_h, img_w = img_shape
-            x_mask[img_id, :img_h, :img_w] = 0
-
-        x_mask = F.interpolate(x_mask.unsqueeze(1), size=x.size()[-2:]).to(torch.bool).squeeze(1)
-        x_pos_embeds = self.position_embedding(x_mask)
+        # the features are not padded, the mask is all valid and the embedding only depends on the feature shape
+        x_mask = x.new_zeros((x.size(0), *x.shape[-2:]), dtype=torch.bool)
+        x_pos_embeds = self.position_embedding.forward_unmasked(x.size(0), x.shape[-2:], x.device)
         return x_mask, x_pos_embeds
 
     def forward(self, box_feat, seg_feat, img_feat, lan_feat=None, lan_mask=None):
@@ -315,8 +304,15 @@ class BoxSegAttention(nn.Module):
 
 
 class UnifiedInteractionModule(nn.Module):
-    def __init__(self, input_channels=256, box_weights=[0.1, 1.0], weighted_compose="none", enable_box_coorinate_embed=False):
+    """
+        prune_unused: skip seg2text_crossattn, whose output is overwritten by
+            the self attention. True, False, or "eval" to keep running it in
+            training only, which keeps the dropout random stream of former runs.
+    """
+
+    def __init__(self, input_channels=256, box_weights=[0.1, 1.0], weighted_compose="none", enable_box_coorinate_embed=False, prune_unused="eval"):
         super(UnifiedInteractionModule, self).__init__()
+        self.prune_unused = prune_unused
         self.box2text_crossattn = DetrTransformerDecoder(
             embed_dim=input_channels,
             num_heads=8,
@@ -405,33 +401,24 @@ class UnifiedInteractionModule(nn.Module):
         self.weighted_compose = weighted_compose
 
     def x_mask_pos_enc(self, x, img_shape):
-        batch_size = x.size(0)
-        input_img_h, input_img_w = img_shape
-        x_mask = x.new_ones((batch_size, input_img_h, input_img_w))
-        for img_id in range(batch_size):
-            img_h, img_w = img_shape
-            x_mask[img_id, :img_h, :img_w] = 0
-
-        x_mask = F.interpolate(x_mask.unsqueeze(1), size=x.size()[-2:]).to(torch.bool).squeeze(1)
-        x_pos_embeds = self.position_embedding(x_mask)
+        # the features are not padded, the mask is all valid and the embedding only depends on the feature shape
+        x_mask = x.new_zeros((x.size(0), *x.shape[-2:]), dtype=torch.bool)
+        x_pos_embeds = self.position_embedding.forward_unmasked(x.size(0), x.shape[-2:], x.device)
         return x_mask, x_pos_embeds
 
     def generate_box_mask(self, box, image_feat, weights=[0.1, 1.0]):
-        bs = box.size(0)
         input_img_h, input_img_w = image_feat.shape[-2:]
-        box_mask = image_feat.new_ones((bs, input_img_h, input_img_w)) * weights[0]
-        for idx in range(bs):
-            bbox = xywh_to_x1y1x2y2(box[idx])
-            x1, y1, x2, y2 = bbox * torch.tensor([input_img_w, input_img_h, input_img_w, input_img_h]).cuda()
-            x1, y1, x2, y2 = x1.floor().int(), y1.floor().int(), x2.ceil().int(), y2.ceil().int()
-            x1.clamp_(0, input_img_w)
-            y1.clamp_(0, input_img_h)
-            x2.clamp_(0, input_img_w)
-            y2.clamp_(0, input_img_h)
-            box_mask[idx, y1:y2, x1:x2] = weights[1]
-        return box_mask
-
-    def forward(self, pred_box, pred_mask, img_feat, lan_feat=None, lan_mask=None):
+        bbox = xywh_to_x1y1x2y2(box) * box.new_tensor([input_img_w, input_img_h, input_img_w, input_img_h])
+        x1, y1 = bbox[:, 0].floor().clamp(0, input_img_w), bbox[:, 1].floor().clamp(0, input_img_h)
+        x2, y2 = bbox[:, 2].ceil().clamp(0, input_img_w), bbox[:, 3].ceil().clamp(0, input_img_h)
+        ys = torch.arange(input_img_h, device=box.device, dtype=bbox.dtype).view(1, -1, 1)
+        xs = torch.arange(input_img_w, device=box.device, dtype=bbox.dtype).view(1, 1, -1)
+        inside = (ys >= y1.view(-1, 1, 1)) & (ys < y2.view(-1, 1, 1)) & (xs >= x1.view(-1, 1, 1)) & (xs < x2.view(-1, 1, 1))
+        box_mask = image_feat.new_full((box.size(0), input_img_h, input_img_w), weights[0])
+        return box_mask.masked_fill_(inside, weights[1])
+
+    def forward(self, pred_box, pred_mask, img_feat, lan_feat=None, lan_mask=None, with_extra=False):
+        """with_extra: also return the normalized heatmaps used by the visualizer."""
         B, _, H, W = img_feat.shape
         img_feat = self.img_embedding(img_feat)
 
@@ -448,29 +435,19 @@ class UnifiedInteractionModule(nn.Module):
 
         # ! type 3 add text interaction concat SA
         box_embed = box_feat.unsqueeze(1).transpose(0, 1)
-        heatmap_mean = torch.mean(img_feat, dim=1, keepdim=True)
-        # heatmap_mean = img_feat[:, 0:1]
-        min_vals = heatmap_mean.amin(dim=(2, 3), keepdim=True)  # 在 H 和 W 维度上取最小值
-        max_vals = heatmap_mean.amax(dim=(2, 3), keepdim=True)  # 在 H 和 W 维度上取最大值
-        img_feat_norm = (heatmap_mean - min_vals) / (max_vals-min_vals+1e-8)
         if self.weighted_compose == "none":
             seg_embed = img_feat.flatten(2).transpose(1, 2)  # (B,Ni,C)
             unified_img_feat = img_feat
-            unified_heatmap = img_feat_norm
         else:
             if self.weighted_compose == "box":
                 box_mask = self.generate_box_mask(pred_box, img_feat, weights=self.box_weights)  # (N,H,W)
                 box_feat = img_feat * box_mask.unsqueeze(1)
                 unified_img_feat = img_feat * box_mask.unsqueeze(1)
-                box_heatmap = img_feat_norm * box_mask.unsqueeze(1)
-                unified_heatmap = img_feat_norm * box_mask.unsqueeze(1)
                 seg_embed = torch.cat((unified_img_feat, img_feat), dim=1)  # (B,2C,H, W)
             elif self.weighted_compose == "mask":
                 pred_mask = pred_mask.sigmoid()
                 seg_feat = img_feat * pred_mask
                 unified_img_feat = img_feat * pred_mask
-                seg_heatmap = img_feat_norm * pred_mask
-                unified_heatmap = img_feat_norm * pred_mask
                 seg_embed = torch.cat((unified_img_feat, img_feat), dim=1)  # (B,2C,H, W)
             elif self.weighted_compose == "boxmask":
                 box_mask = self.generate_box_mask(pred_box, img_feat, weights=self.box_weights)  # (N,H,W)
@@ -478,9 +455,6 @@ class UnifiedInteractionModule(nn.Module):
                 seg_feat = img_feat * pred_mask
                 box_feat = img_feat * box_mask.unsqueeze(1)
                 unified_img_feat = seg_feat * box_mask.unsqueeze(1)
-                seg_heatmap = img_feat_norm * pred_mask
-                box_heatmap = img_feat_norm * box_mask.unsqueeze(1)
-                unified_heatmap = img_feat_norm * pred_mask * box_mask.unsqueeze(1)
                 seg_embed = torch.cat((seg_feat, box_feat, unified_img_feat, img_feat), dim=1)  # (B,2C,H, W)
             else:
                 raise TypeError()
@@ -497,14 +471,15 @@ class UnifiedInteractionModule(nn.Module):
         )[-1]
         # B2I
         box_hs = self.box2img_crossattn(query=box_hs, key=seg_embed, value=seg_embed, key_pos=seg_pos_embed)[-1]
-        # S2T
-        seg_hs = self.seg2text_crossattn(
-            query=seg_embed,
-            key=lan_embed,
-            value=lan_embed,
-            # key_pos=seg_pos_embed,
-            key_padding_mask=lan_mask.bool(),
-        )[-1]
+        # S2T, the result is overwritten by SA
+        if not (self.prune_unused is True or (self.prune_unused == "eval" and not self.training)):
+            seg_hs = self.seg2text_crossattn(
+                query=seg_embed,
+                key=lan_embed,
+                value=lan_embed,
+                # key_pos=seg_pos_embed,
+                key_padding_mask=lan_mask.bool(),
+            )[-1]
         # SA
         seg_hs = self.sa(
             query=seg_embed,
@@ -515,11 +490,25 @@ class UnifiedInteractionModule(nn.Module):
 
         second_seg_mask = seg_hs.permute(1, 2, 0).reshape(B, -1, H, W)
         second_bbox = box_hs.transpose(0, 1).reshape(B, -1)
-        
-        extra = {"unified_img_feat": unified_heatmap,
-                 "img_feat": img_feat_norm}
-        if "mask" in self.weighted_compose:
-            extra["seg_feat"] = seg_heatmap
+
+        extra = self.heatmaps(img_feat, pred_box, pred_mask) if with_extra else {}
+        return second_bbox, second_seg_mask, extra
+
+    @torch.no_grad()
+    def heatmaps(self, img_feat, pred_box, pred_mask):
+        """Min-max normalized channel mean of img_feat, weighted as in forward,
+        pred_mask is already a probability when the composition uses it."""
+        heatmap_mean = torch.mean(img_feat, dim=1, keepdim=True)
+        # heatmap_mean = img_feat[:, 0:1]
+        min_vals = heatmap_mean.amin(dim=(2, 3), keepdim=True)  # 在 H 和 W 维度上取最小值
+        max_vals = heatmap_mean.amax(dim=(2, 3), keepdim=True)  # 在 H 和 W 维度上取最大值
+        img_feat_norm = (heatmap_mean - min_vals) / (max_vals-min_vals+1e-8)
+        extra = {"unified_img_feat": img_feat_norm, "img_feat": img_feat_norm}
         if "box" in self.weighted_compose:
-            extra["box_feat"] = box_heatmap
-        return second_bbox, second_seg_mask, extra
\ No newline at end of file
+            box_mask = self.generate_box_mask(pred_box, img_feat, weights=self.box_weights).unsqueeze(1)
+            extra["box_feat"] = img_feat_norm * box_mask
+            extra["unified_img_feat"] = extra["unified_img_feat"] * box_mask
+        if "mask" in self.weighted_compose:
+            extra["seg_feat"] = img_feat_norm * pred_mask
+            extra["unified_img_feat"] = extra["unified_img_feat"] * pred_mask
+        return extra
\ No newline at end of file
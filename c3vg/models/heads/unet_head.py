@@ -7,6 +7,7 @@ from mmcv.cnn import ConvModule, build_norm_layer
 from mmengine.model import BaseModule
 from torch import Tensor
 import pycocotools.mask as maskUtils
+from ..utils import masked_pool
 import numpy as np
 from mmcv.cnn.bricks.registry import NORM_LAYERS
 from .projection import Projector
@@ -59,7 +60,7 @@ class PredictHead(nn.Module):
 
     def forward(self, x, lan_feature=None, lan_mask=None):
         if self.name == "CRIS":
-            lan_feature = torch.cat(list(map(lambda feat, mask: torch.max(feat[mask, :], dim=0, keepdim=True)[0], lan_feature, ~lan_mask)))
+            lan_feature = masked_pool(lan_feature, lan_mask, mode="max")
             x = self.prediction_head(x, lan_feature)
         elif self.name == "CGFormer":
             x = self.prediction_head(x, lan_feature.transpose(-1, -2), ~lan_mask.unsqueeze(-1))
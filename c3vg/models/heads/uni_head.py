@@ -1,3 +1,4 @@
+import time
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -10,7 +11,7 @@ from .unet_head import *
 from c3vg.models.losses.boxloss import BoxLoss
 from .modules import BoxSegAttention, BoxSegPooler, QueryAugment, SegBranch, BoxBranch, UnifiedInteractionModule
 from .unet_head import SimpleFPN
-from ..utils import xywh_to_x1y1x2y2, x1y1x2y2_to_xywh
+from ..utils import xywh_to_x1y1x2y2, x1y1x2y2_to_xywh, masked_pool
 from ..losses.clip_loss import ClipLoss, get_rank, get_world_size
 from .projection import Projector
 
@@ -27,8 +28,34 @@ class UniHeadCoarseToFine(nn.Module):
         start_epoch=0,
         decoder_upsample_type="none",
         uim={"enable": False, "weighted_compose": "none", "enable_box_coorinate_embed": False, "box_weights": [0.1, 1.0]},
+        test_stages=2,
+        return_first_stage=True,
+        profile_stages=False,
+        first_stage_loss_at_stride=False,
     ):
+        """Args:
+        test_stages (int): 2 runs the full coarse-to-fine head at inference,
+            1 returns the first-stage box/mask and skips UIM and the decoder.
+
+        return_first_stage (bool): also return the first-stage predictions
+            at inference, needed for the first-stage metrics.
+
+        profile_stages (bool): record the per-stage latency (ms) of the last
+            forward in `self.stage_times`, synchronizing the device after
+            every stage.
+
+        first_stage_loss_at_stride (bool): compute the first-stage mask and
+            consistency losses on the feature-resolution logits, against the
+            area-downsampled `gt_mask_down` of `MaskDownsample`, or the gt mask
+            pooled on the device when the pipeline does not provide it.
+        """
         super(UniHeadCoarseToFine, self).__init__()
+        assert test_stages in (1, 2), "test_stages must be 1 or 2"
+        self.test_stages = test_stages
+        self.return_first_stage = return_first_stage
+        self.profile_stages = profile_stages
+        self.first_stage_loss_at_stride = first_stage_loss_at_stride
+        self.stage_times = {}
         self.seg_branch_first = SegBranch(hidden_channels, upsample_rate=1)
         self.box_branch_first = BoxBranch(hidden_channels)
         self.decoder_upsample_type = decoder_upsample_type
@@ -75,15 +102,39 @@ class UniHeadCoarseToFine(nn.Module):
                 box_weights=uim["box_weights"],
                 weighted_compose=uim["weighted_compose"],
                 enable_box_coorinate_embed=uim["enable_box_coorinate_embed"],
+                prune_unused=uim.get("prune_unused", "eval"),
             )
 
     def text_pooler(self, lan_feat, lan_mask):
-        lan_feat_pooler = torch.cat(list(map(lambda feat, mask: torch.max(feat[mask, :], dim=0, keepdim=True)[0], lan_feat, ~lan_mask)))
-        return lan_feat_pooler
-
-    def forward_train(self, x, targets, cls_feat=None, lan_feat=None, lan_mask=None, img=None):
-        device = x.device
-        target_mask = torch.from_numpy(np.concatenate([maskUtils.decode(target)[None] for target in targets["mask"]])).to(device)
+        return masked_pool(lan_feat, lan_mask, mode="max")
+
+    def _stage_timer(self, x):
+        """Returns `tic(name)`, which records the milliseconds since the last
+        call into `self.stage_times` when `profile_stages`, else a no-op."""
+        if not self.profile_stages:
+            return lambda name: None
+        sync = (lambda: torch.cuda.synchronize(x.device)) if x.is_cuda else (lambda: None)
+        self.stage_times = {}
+        sync()
+        last = [time.perf_counter()]
+
+        def tic(name):
+            sync()
+            now = time.perf_counter()
+            self.stage_times[name] = (now - last[0]) * 1000
+            last[0] = now
+
+        return tic
+
+    def _upsample(self, feat, img):
+        return F.interpolate(feat, size=img.shape[-2:], mode="bilinear", align_corners=True)
+
+    def _forward_stages(self, x, cls_feat, lan_feat, lan_mask, num_stages=2, with_extra=False, tic=lambda name: None):
+        """Runs the head up to `num_stages` (1 or 2).
+
+        Returns the predictions with the mask logits at feature resolution,
+        the callers upsample only what they consume, and the UIM extras.
+        """
         # all feats embedding to hidden_channels
         img_feat = self.img_embedding(x)
         query_feat = self.query_embedding(cls_feat)
@@ -92,42 +143,26 @@ class UniHeadCoarseToFine(nn.Module):
         # ! query augment
         if self.query_augment_module is not None:
             query_feat = self.query_augment_module(query_feat, img_feat, lan_feat, lan_mask)
+        tic("embedding")
         # ! stage 1
         pred_bbox = self.box_branch_first(query_feat)
         if self.loss_weight["clip"]["pixel"]:
             pred_mask = self.proj_pixel_level_cons(img_feat, lan_pool)
         else:
             pred_mask = self.seg_branch_first(img_feat)
-        pred_mask_first = F.interpolate(pred_mask, size=img.shape[-2:], mode="bilinear", align_corners=True)
-        pred_bbox_first = pred_bbox
-        target_mask_first = target_mask
-
-        # # * first stage -- box seg pooling -> box_feat(B,C) seg_feat(B,C)
-        # # ! box seg pooling
-        # box_feat_first, [seg_feat_pos_first, seg_feat_neg_first] = self.boxsegpooler(
-        #     pred_bbox,
-        #     pred_mask,
-        #     img_feat,
-        #     gt=False,
-        #     img_pool=False,
-        # )
+        outputs = {"pred_bbox_first": pred_bbox, "pred_mask_first": pred_mask}
+        tic("first_stage")
+        if num_stages == 1:
+            return outputs, {}
 
         # ! stage 2
         # ! unified interaction
-        extra_dict = {}
+        extra = {}
         if self.unified_interaction_module:
-            # pred_bbox_2_tmp, pred_mask_2_tmp = self.boxsegattn(box_feat_first, seg_feat_pos_first, img_feat, lan_feat, lan_mask)
-            pred_bbox_2_tmp, pred_mask_2_tmp, extra = self.UIM(pred_bbox, pred_mask, img_feat, lan_feat, lan_mask)
-            if "unified_img_feat" in extra:
-                extra_dict["unified_img_feat"] = F.interpolate(extra["unified_img_feat"], size=img.shape[-2:], mode="bilinear", align_corners=True)
-            if "seg_feat" in extra:
-                extra_dict["seg_feat"] = F.interpolate(extra["seg_feat"], size=img.shape[-2:], mode="bilinear", align_corners=True)
-            if "box_feat" in extra:
-                extra_dict["box_feat"] = F.interpolate(extra["box_feat"], size=img.shape[-2:], mode="bilinear", align_corners=True)
-            if "img_feat" in extra:
-                extra_dict["img_feat"] = F.interpolate(extra["img_feat"], size=img.shape[-2:], mode="bilinear", align_corners=True)
+            pred_bbox_2_tmp, pred_mask_2_tmp, extra = self.UIM(pred_bbox, pred_mask, img_feat, lan_feat, lan_mask, with_extra=with_extra)
         else:
             pred_bbox_2_tmp, pred_mask_2_tmp = query_feat, img_feat
+        tic("uim")
 
         # ! decoder upsample
         if self.decoder_upsample_type == "fpn":
@@ -137,14 +172,39 @@ class UniHeadCoarseToFine(nn.Module):
             pred_mask_up4 = self.neck(pred_mask_2_tmp)
         else:
             pred_mask_up4 = pred_mask_2_tmp
+        tic("decoder")
 
         # ! pixel level cons
         if self.loss_weight["clip"]["pixel"]:
-            pred_mask_2 = self.proj_pixel_level_cons(pred_mask_up4, lan_pool)
+            outputs["pred_mask"] = self.proj_pixel_level_cons(pred_mask_up4, lan_pool)
         else:
-            pred_mask_2 = self.seg_branch_second(pred_mask_up4)
-        pred_bbox_second = self.box_branch_second(pred_bbox_2_tmp)
-        pred_mask_second = F.interpolate(pred_mask_2, size=img.shape[-2:], mode="bilinear", align_corners=True)
+            outputs["pred_mask"] = self.seg_branch_second(pred_mask_up4)
+        outputs["pred_bbox"] = self.box_branch_second(pred_bbox_2_tmp)
+        tic("second_stage")
+        return outputs, extra
+
+    def forward_train(self, x, targets, cls_feat=None, lan_feat=None, lan_mask=None, img=None, with_extra=False):
+        device = x.device
+        tic = self._stage_timer(x)
+        target_mask = targets.get("mask_seg", None)
+        if target_mask is None:
+            target_mask = torch.from_numpy(np.concatenate([maskUtils.decode(target)[None] for target in targets["mask"]])).to(device)
+        outputs, extra = self._forward_stages(x, cls_feat, lan_feat, lan_mask, with_extra=with_extra, tic=tic)
+        extra_dict = {name: self._upsample(feat, img) for name, feat in extra.items()}
+        pred_bbox_first, pred_bbox_second = outputs["pred_bbox_first"], outputs["pred_bbox"]
+        pred_mask_second = self._upsample(outputs["pred_mask"], img)
+        if self.first_stage_loss_at_stride:
+            pred_mask_first = outputs["pred_mask_first"]
+            target_mask_first = targets.get("mask_down", None)
+            if target_mask_first is None:
+                target_mask_first = F.interpolate(target_mask[:, None].float(), size=pred_mask_first.shape[-2:], mode="area")[:, 0]
+        else:
+            pred_mask_first = self._upsample(outputs["pred_mask_first"], img)
+            target_mask_first = target_mask
+        # the losses run in fp32 under autocast
+        pred_bbox_first, pred_bbox_second = pred_bbox_first.float(), pred_bbox_second.float()
+        pred_mask_first, pred_mask_second = pred_mask_first.float(), pred_mask_second.float()
+        tic("upsample")
 
         # ! loss func
         loss_mask_first = seg_loss(pred_mask_first, target_mask_first, self.loss_weight["mask"]) * self.loss_weight["stage"]["first"]
@@ -163,12 +223,12 @@ class UniHeadCoarseToFine(nn.Module):
                 pred_bbox_second, pred_mask_second, B2Sthr=self.threshold["B2S"], S2Bthr=self.threshold["S2B"], box_func=self.box_loss
             )
             loss_cons_first = (
-                sum(loss_S2B_first) / len(loss_S2B_first) * self.loss_weight["boxsegcc"]["S2B"]
-                + sum(loss_B2S_first) / len(loss_B2S_first) * self.loss_weight["boxsegcc"]["B2S"]
+                loss_S2B_first.mean() * self.loss_weight["boxsegcc"]["S2B"]
+                + loss_B2S_first.mean() * self.loss_weight["boxsegcc"]["B2S"]
             ) * self.loss_weight["stage"]["first"] * 0.1
             loss_cons_second = (
-                sum(loss_S2B_second) / len(loss_S2B_second) * self.loss_weight["boxsegcc"]["S2B"]
-                + sum(loss_B2S_second) / len(loss_B2S_second) * self.loss_weight["boxsegcc"]["B2S"]
+                loss_S2B_second.mean() * self.loss_weight["boxsegcc"]["S2B"]
+                + loss_B2S_second.mean() * self.loss_weight["boxsegcc"]["B2S"]
             ) * self.loss_weight["stage"]["second"] * 0.1
 
         loss_mask = loss_mask_first + loss_mask_second
@@ -185,73 +245,35 @@ class UniHeadCoarseToFine(nn.Module):
             "loss_cons_first": loss_cons_first,
             "loss_cons_second": loss_cons_second,
         }
+        if self.first_stage_loss_at_stride:
+            # only the predictions need the full resolution, no graph is kept for them
+            with torch.no_grad():
+                pred_mask_first = self._upsample(pred_mask_first, img)
         pred_dict = {"pred_mask": pred_mask_second, "pred_bbox": pred_bbox_second, "pred_mask_first": pred_mask_first, "pred_bbox_first": pred_bbox_first}
+        tic("loss")
         return loss_dict, pred_dict, extra_dict
 
-    def forward_test(self, x, cls_feat=None, lan_feat=None, lan_mask=None, img=None, targets=None):
-        img_feat = self.img_embedding(x)
-        query_feat = self.query_embedding(cls_feat)
-        lan_feat = self.lan_embedding(lan_feat)
-        lan_pool = self.text_pooler(lan_feat, lan_mask)
-        # ! query augment
-        if self.query_augment_module is not None:
-            query_feat = self.query_augment_module(query_feat, img_feat, lan_feat, lan_mask)
-        # ! stage 1
-        pred_bbox = self.box_branch_first(query_feat)
-        if self.loss_weight["clip"]["pixel"]:
-            pred_mask = self.proj_pixel_level_cons(img_feat, lan_pool)
-        else:
-            pred_mask = self.seg_branch_first(img_feat)
-        pred_mask_first = F.interpolate(pred_mask, size=img.shape[-2:], mode="bilinear", align_corners=True)
-        pred_bbox_first = pred_bbox
-
-        # # * first stage -- box seg pooling -> box_feat(B,C) seg_feat(B,C)
-        # # ! box seg pooling
-        # box_feat_first, [seg_feat_pos_first, seg_feat_neg_first] = self.boxsegpooler(
-        #     pred_bbox,
-        #     pred_mask,
-        #     img_feat,
-        #     gt=False,
-        #     img_pool=False,
-        # )
-
-        # ! stage 2
-        # ! unified interaction
-        extra_dict = {}
-        if self.unified_interaction_module:
-            # pred_bbox_2_tmp, pred_mask_2_tmp = self.boxsegattn(box_feat_first, seg_feat_pos_first, img_feat, lan_feat, lan_mask)
-            pred_bbox_2_tmp, pred_mask_2_tmp, extra = self.UIM(pred_bbox, pred_mask, img_feat, lan_feat, lan_mask)
-            if "unified_img_feat" in extra:
-                extra_dict["unified_img_feat"] = F.interpolate(extra["unified_img_feat"], size=img.shape[-2:], mode="bilinear", align_corners=True)
-            if "seg_feat" in extra:
-                extra_dict["seg_feat"] = F.interpolate(extra["seg_feat"], size=img.shape[-2:], mode="bilinear", align_corners=True)
-            if "box_feat" in extra:
-                extra_dict["box_feat"] = F.interpolate(extra["box_feat"], size=img.shape[-2:], mode="bilinear", align_corners=True)
-            if "img_feat" in extra:
-                extra_dict["img_feat"] = F.interpolate(extra["img_feat"], size=img.shape[-2:], mode="bilinear", align_corners=True)
+    def forward_test(self, x, cls_feat=None, lan_feat=None, lan_mask=None, img=None, targets=None, with_extra=False):
+        """With `test_stages=1` the coarse first-stage box and mask are
+        returned as the final predictions and UIM and the decoder are skipped.
+        The first-stage outputs of a two-stage run are only upsampled when
+        `return_first_stage`."""
+        tic = self._stage_timer(x)
+        outputs, extra = self._forward_stages(x, cls_feat, lan_feat, lan_mask, num_stages=self.test_stages, with_extra=with_extra, tic=tic)
+        extra_dict = {name: self._upsample(feat, img) for name, feat in extra.items()}
+        if self.test_stages == 1:
+            pred_mask_first = self._upsample(outputs["pred_mask_first"], img)
+            pred_dict = {"pred_mask": pred_mask_first, "pred_bbox": outputs["pred_bbox_first"]}
         else:
-            pred_bbox_2_tmp, pred_mask_2_tmp = query_feat, img_feat
-
-        # ! decoder upsample
-        if self.decoder_upsample_type == "fpn":
-            x_c1, x_c2, x_c3, x_c4 = self.neck(pred_mask_2_tmp)
-            pred_mask_up4 = self.fpn_decoder(x_c4, x_c3, x_c2, x_c1)
-        elif self.decoder_upsample_type == "tranposeconv":
-            pred_mask_up4 = self.neck(pred_mask_2_tmp)
-        else:
-            pred_mask_up4 = pred_mask_2_tmp
-
-        # ! pixel level cons
-        if self.loss_weight["clip"]["pixel"]:
-            pred_mask_2 = self.proj_pixel_level_cons(pred_mask_up4, lan_pool)
-        else:
-            pred_mask_2 = self.seg_branch_second(pred_mask_up4)
-        pred_bbox_second = self.box_branch_second(pred_bbox_2_tmp)
-        pred_mask_second = F.interpolate(pred_mask_2, size=img.shape[-2:], mode="bilinear", align_corners=True)
-
-        pred_dict = {"pred_mask": pred_mask_second, "pred_bbox": pred_bbox_second, "pred_mask_first": pred_mask_first, "pred_bbox_first": pred_bbox_first}
+            pred_dict = {"pred_mask": self._upsample(outputs["pred_mask"], img), "pred_bbox": outputs["pred_bbox"]}
+        if self.return_first_stage:
+            pred_dict["pred_mask_first"] = pred_mask_first if self.test_stages == 1 else self._upsample(outputs["pred_mask_first"], img)
+            pred_dict["pred_bbox_first"] = outputs["pred_bbox_first"]
+        pred_dict = {name: pred.float() for name, pred in pred_dict.items()}
+        tic("upsample")
         return pred_dict, extra_dict
 
+
 def dice_loss(inputs, targets):
     """
     Compute the DICE loss, similar to generalized IOU for masks
@@ -476,21 +498,60 @@ def boxseg_iouloss(box, mask, B2Sthr=0.5, S2Bthr=0.5, box_func=None):
 
 
 def boxseg_iouloss2(box, mask, B2Sthr=0.5, S2Bthr=0.5, box_func=BoxLoss()):
-    # xywh_to_x1y1x2y2
+    """Batched box/segmentation consistency losses.
+
+    S2B: 1 - the fraction of the binarized mask inside the predicted box,
+    read from an integral image of the mask. B2S: the box loss (5 * L1 + 2 *
+    GIoU, as :class:`BoxLoss`) between the outer box of the mask and the
+    predicted box.
+
+    Args:
+        box (tensor): [B, 4], normalized xywh.
+        mask (tensor): [B, 1, H, W], logits.
+
+    Returns:
+        tuple: per-sample loss_S2B and loss_B2S, [B] tensors, and two Nones.
+    """
     box_x1y1x2y2 = xywh_to_x1y1x2y2(box)
     mask = mask.sigmoid().squeeze(1)
     B, H, W = mask.shape
-    loss_S2B, loss_B2S = [], []
-    for b in range(B):
-        x1, y1, x2, y2 = (box_x1y1x2y2[b] * torch.tensor([W, H, W, H], device=box.device)).to(torch.int)
-        x1, x2 = torch.clamp(x1, 0, W), torch.clamp(x2, 0, W)
-        y1, y2 = torch.clamp(y1, 0, H), torch.clamp(y2, 0, H)
-        box_pred = torch.tensor([x1, y1, x2, y2], device=box.device)
-        S2B_iou = compute_segboxiou(mask[b], box_pred, threshold=S2Bthr)
-        maskouterbbox = get_maskouterbox(mask[b].unsqueeze(0), threshold=B2Sthr).squeeze(0)
-        maskouterbbox_norm = maskouterbbox / torch.tensor([W, H, W, H], device=box.device)
-        B2S_loss = compute_boxloss(maskouterbbox_norm.unsqueeze(0), box_x1y1x2y2[b].unsqueeze(0), loss_func=box_func)
-        loss_S2B.append(1 - S2B_iou)
-        loss_B2S.append(B2S_loss)
+    batch_inds = torch.arange(B, device=mask.device)
+
+    # S2B
+    x1, y1, x2, y2 = (box_x1y1x2y2 * box.new_tensor([W, H, W, H])).to(torch.int).long().unbind(-1)
+    x1, x2 = torch.clamp(x1, 0, W), torch.clamp(x2, 0, W)
+    y1, y2 = torch.clamp(y1, 0, H), torch.clamp(y2, 0, H)
+    seg = (mask > S2Bthr).int()
+    integral = F.pad(seg.cumsum(1).cumsum(2), (1, 0, 1, 0))
+    intersection = (
+        integral[batch_inds, y2, x2] - integral[batch_inds, y1, x2] - integral[batch_inds, y2, x1] + integral[batch_inds, y1, x1]
+    )
+    intersection = torch.where((x2 > x1) & (y2 > y1), intersection, torch.zeros_like(intersection))
+    mask_area = integral[:, H, W]
+    S2B_iou = torch.where(mask_area > 0, intersection.float() / mask_area.float().clamp(min=1), torch.zeros_like(mask_area, dtype=torch.float))
+    loss_S2B = 1 - S2B_iou
+
+    # B2S, the outer box of the mask from the first/last non-empty row and column
+    seg = mask > B2Sthr
+    rows, cols = seg.any(2), seg.any(1)
+    nonempty = rows.any(1, keepdim=True)
+    rows, cols = rows.int(), cols.int()
+    maskouterbbox = torch.stack(
+        [cols.argmax(1), rows.argmax(1), W - 1 - cols.flip(1).argmax(1), H - 1 - rows.flip(1).argmax(1)], dim=1
+    )
+    maskouterbbox = torch.where(nonempty, maskouterbbox, torch.zeros_like(maskouterbbox))
+    maskouterbbox_norm = maskouterbbox / torch.tensor([W, H, W, H], device=box.device)
+
+    pred, gt = x1y1x2y2_to_xywh(maskouterbbox_norm), x1y1x2y2_to_xywh(box_x1y1x2y2)
+    loss_bbox = F.l1_loss(pred, gt, reduction="none").sum(-1)
+    boxes1, boxes2 = box_func.box_cxcywh_to_xyxy(pred), box_func.box_cxcywh_to_xyxy(gt)
+    assert (boxes1[:, 2:] >= boxes1[:, :2]).all()
+    assert (boxes2[:, 2:] >= boxes2[:, :2]).all()
+    wh = (torch.min(boxes1[:, 2:], boxes2[:, 2:]) - torch.max(boxes1[:, :2], boxes2[:, :2])).clamp(min=0)
+    union = box_func.box_area(boxes1) + box_func.box_area(boxes2) - wh[:, 0] * wh[:, 1]
+    iou = wh[:, 0] * wh[:, 1] / union
+    wh = (torch.max(boxes1[:, 2:], boxes2[:, 2:]) - torch.min(boxes1[:, :2], boxes2[:, :2])).clamp(min=0)
+    area = wh[:, 0] * wh[:, 1]
+    loss_B2S = 5 * loss_bbox + (1 - (iou - (area - union) / area)) * 2
 
     return loss_S2B, loss_B2S, None, None
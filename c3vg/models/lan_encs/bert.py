@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from c3vg.models import LAN_ENCODERS
+from ..utils import masked_pool
 from transformers import RobertaModel, RobertaTokenizerFast
 from transformers import AutoModel, AutoTokenizer
 
@@ -73,10 +74,9 @@ class ALBERTA(nn.Module):
         # Resize the encoder hidden states to be of the same d_model as the decoder
         # text_memory = self.resizer(text_memory)
 
-        if self.output_type == "mean":
-            y = torch.cat(list(map(lambda feat, mask: torch.mean(feat[mask, :], dim=0, keepdim=True), text_memory, ~text_attention_mask))).unsqueeze(1)
-        elif self.output_type == "max":
-            y = torch.cat(list(map(lambda feat, mask: torch.max(feat[mask, :], dim=0, keepdim=True)[0], text_memory, ~text_attention_mask))).unsqueeze(1)
+        if self.output_type in ("mean", "max", "cls"):
+            # huggingface marks the valid tokens with 1
+            y = masked_pool(text_memory, text_attention_mask == 0, mode=self.output_type, keepdim=True)
         elif self.output_type == "default":
             h = h.transpose(0, 1)
             y = h.flatten(1).unsqueeze(1)
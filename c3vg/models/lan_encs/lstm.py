@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from c3vg.models import LAN_ENCODERS
 from .rnn import PhraseAttention
+from ..utils import masked_pool
 
 @LAN_ENCODERS.register_module()
 class LSTM(nn.Module):
@@ -57,10 +58,8 @@ class LSTM(nn.Module):
 
         y_word, h = self.lstm(y_word)
 
-        if self.output_type == "mean":
-            y = torch.cat(list(map(lambda feat, mask: torch.mean(feat[mask, :], dim=0, keepdim=True), y_word, ~y_mask))).unsqueeze(1)
-        elif self.output_type == "max":
-            y = torch.cat(list(map(lambda feat, mask: torch.max(feat[mask, :], dim=0, keepdim=True)[0], y_word, ~y_mask))).unsqueeze(1)
+        if self.output_type in ("mean", "max"):
+            y = masked_pool(y_word, y_mask, mode=self.output_type, keepdim=True)
         elif self.output_type == "default":
             h = h.transpose(0, 1)
             y = h.flatten(1).unsqueeze(1)
@@ -2,6 +2,8 @@ import torch
 import numpy
 import cv2
 import numpy as np
+import torch.nn.functional as F
+import pycocotools.mask as maskUtils
 
 # 可视化每个样本的热力图
 def visualize_heatmaps_cv2(tensor_np, save_path):
@@ -144,59 +146,214 @@ class ExponentialMovingAverage(object):
     """
         Be cautious of where ema is initialized in the sequence model initialization,
         gpu assignment and distributed dataparallel wrappers.
+
+        Holds direct references to the parameters and buffers of the model
+        (the state_dict entries) and updates the shadow with one
+        `torch._foreach_lerp_` every `interval` optimizer steps, the decay
+        being raised to `interval`. With `device="cpu"` the shadow lives on
+        the host and the model is staged through pinned buffers.
+
+        `apply_shadow`/`restore` swap the shadow and the model weights in
+        place, or copy through the staging buffers for a host shadow, no
+        state_dict is cloned.
     """
 
-    def __init__(self, model, alpha, buffer_ema=True):
+    def __init__(self, model, alpha, buffer_ema=True, interval=1, device=None):
         self.step = 0
         self.model = model
         self.alpha = alpha
         self.buffer_ema = buffer_ema
-        self.shadow = self.get_model_state()
-        self.backup = {}
-        self.param_keys = [k for k, _ in self.model.named_parameters()]
-        self.buffer_keys = [k for k, _ in self.model.named_buffers()]
-
+        self.interval = interval
+        self.device = torch.device(device) if device is not None else None
+        self.applied = False
+        self._staging = None
+        self._shadow = {
+            k: v.detach().to(self.device or v.device, copy=True)
+            for k, v in self.model.state_dict().items()
+        }
+        self._bind()
+
+    @property
+    def shadow(self):
+        return self._shadow
+
+    @shadow.setter
+    def shadow(self, state):
+        """Loads a saved shadow in place, keeping the references."""
+        assert not self.applied, "restore the model before loading the shadow"
+        with torch.no_grad():
+            for name, value in state.items():
+                if name in self._shadow:
+                    self._shadow[name].copy_(value)
+
+    def _bind(self):
+        tensors, names = {}, {}
+        for name, tensor in self.model.state_dict(keep_vars=True).items():
+            if id(tensor) in names:
+                # tied weights share one shadow tensor
+                self._shadow[name] = self._shadow[names[id(tensor)]]
+                continue
+            names[id(tensor)] = name
+            tensors[name] = tensor
+        self.lerp_names = [
+            name for name, tensor in tensors.items()
+            if tensor.is_floating_point() and (isinstance(tensor, torch.nn.Parameter) or self.buffer_ema)
+        ]
+        self.copy_names = [name for name in tensors if name not in self.lerp_names]
+        self.model_tensors = [tensors[name] for name in self.lerp_names + self.copy_names]
+        self.shadow_tensors = [self._shadow[name] for name in self.lerp_names + self.copy_names]
+        self.offload = any(s.device != t.device for s, t in zip(self.shadow_tensors, self.model_tensors))
+
+    def _sources(self):
+        """The model tensors, on the shadow device."""
+        if not self.offload:
+            return self.model_tensors
+        if self._staging is None:
+            pin = torch.cuda.is_available()
+            self._staging = [torch.empty_like(s, pin_memory=pin) for s in self.shadow_tensors]
+        for staging, tensor in zip(self._staging, self.model_tensors):
+            staging.copy_(tensor.detach(), non_blocking=True)
+        if torch.cuda.is_available():
+            torch.cuda.current_stream().synchronize()
+        return self._staging
+
+    @torch.no_grad()
     def update_params(self):
-        decay = min(self.alpha, (self.step + 1) / (self.step + 10))
-        state = self.model.state_dict()
-        for name in self.param_keys:
-            if name not in self.shadow:
-                self.shadow[name] = state[name]
-            else:
-                self.shadow[name].copy_(
-                    decay * self.shadow[name]
-                    + (1 - decay) * state[name]
-                )
-        for name in self.buffer_keys:
-            if self.buffer_ema:
-                if name not in self.shadow:
-                    self.shadow[name] = state[name]
-                else:
-                    self.shadow[name].copy_(
-                        decay * self.shadow[name]
-                        + (1 - decay) * state[name]
-                    )
-            else:
-                if name not in self.shadow:
-                    self.shadow[name] = state[name]
-                else:
-                    self.shadow[name].copy_(state[name])
         self.step += 1
+        if self.step % self.interval != 0:
+            return
+        decay = min(self.alpha, self.step / (self.step + 9)) ** self.interval
+        sources = self._sources()
+        num_lerp = len(self.lerp_names)
+        if num_lerp > 0:
+            if hasattr(torch, "_foreach_lerp_"):
+                torch._foreach_lerp_(self.shadow_tensors[:num_lerp], sources[:num_lerp], 1 - decay)
+            else:
+                torch._foreach_mul_(self.shadow_tensors[:num_lerp], decay)
+                torch._foreach_add_(self.shadow_tensors[:num_lerp], sources[:num_lerp], alpha=1 - decay)
+        for shadow, source in zip(self.shadow_tensors[num_lerp:], sources[num_lerp:]):
+            shadow.copy_(source)
 
+    @torch.no_grad()
     def apply_shadow(self):
-        self.backup = self.get_model_state()
-        self.model.load_state_dict(self.shadow, strict=True)
+        assert not self.applied, "shadow is already applied"
+        if self.offload:
+            self._sources()  # backs the model up into the staging buffers
+            for tensor, shadow in zip(self.model_tensors, self.shadow_tensors):
+                tensor.copy_(shadow)
+        else:
+            self._swap()
+        self.applied = True
 
+    @torch.no_grad()
     def restore(self):
-        self.model.load_state_dict(self.backup, strict=True)
+        assert self.applied, "shadow is not applied"
+        if self.offload:
+            for tensor, backup in zip(self.model_tensors, self._staging):
+                tensor.copy_(backup)
+        else:
+            self._swap()
+        self.applied = False
 
-    def get_model_state(self):
-        return {
-            k: v.clone().detach()
-            for k, v in self.model.state_dict().items()
-        }
+    def _swap(self):
+        for tensor, shadow in zip(self.model_tensors, self.shadow_tensors):
+            data = tensor.data
+            tensor.data = shadow.data
+            shadow.data = data
 
 
+class LazyMasks(object):
+    """Binarized masks of a batch, kept on device and encoded to RLE only
+    when a consumer asks for it.
+
+    Behaves as a list of RLEs: indexing or iterating encodes the whole batch
+    once and caches the result. ``tensor`` gives the [B, H, W] bool tensor,
+    which the metrics use directly.
+
+    Args:
+        masks (tensor | list[tensor]): [B, H, W] bool tensor, or a list of
+            [H, W] bool tensors when the masks differ in size.
+    """
+
+    def __init__(self, masks):
+        self.masks = masks
+        self._rles = None
+
+    @classmethod
+    def rescale(cls, masks, sizes):
+        """Resizes (nearest) every mask to its size, with one F.interpolate
+        per distinct size."""
+        resized = [None] * len(sizes)
+        for size in set(sizes):
+            inds = [i for i, s in enumerate(sizes) if s == size]
+            out = F.interpolate(masks[inds, None].float(), size=size, mode="nearest")[:, 0].bool()
+            if len(inds) == len(sizes):
+                return cls(out)
+            for i, mask in zip(inds, out):
+                resized[i] = mask
+        return cls(resized)
+
+    @property
+    def ragged(self):
+        """Whether the masks were rescaled to different sizes."""
+        return not isinstance(self.masks, torch.Tensor)
+
+    @property
+    def tensor(self):
+        if self.ragged:
+            raise ValueError(f"masks of different sizes {sorted(set(tuple(mask.shape) for mask in self.masks))} do not stack, use .masks")
+        return self.masks
+
+    def to_rle(self):
+        if self._rles is None:
+            if isinstance(self.masks, torch.Tensor):
+                # [H, W, B] fortran array, encoded in a single call
+                self._rles = maskUtils.encode(numpy.asfortranarray(self.masks.permute(1, 2, 0).cpu().numpy().astype(numpy.uint8)))
+            else:
+                self._rles = [maskUtils.encode(numpy.asfortranarray(mask.cpu().numpy().astype(numpy.uint8))) for mask in self.masks]
+        return self._rles
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __getitem__(self, index):
+        return self.to_rle()[index]
+
+    def __iter__(self):
+        return iter(self.to_rle())
+
+
+def masked_pool(feat, mask, mode="max", keepdim=False, fill_value=None):
+    """Pools the valid tokens of padded features in one batched op.
+
+    Same values and gradients as pooling `feat[b][~mask[b]]` sample by sample,
+    but without the boolean gathers, so the shapes stay static.
+
+    Args:
+        feat (tensor): [batch_size, max_token, C].
+        mask (tensor): [batch_size, max_token], dtype=torch.bool, True means
+            ignored position.
+        mode (str): "max", "mean" or "cls" (the first token).
+        keepdim (bool): return [batch_size, 1, C] instead of [batch_size, C].
+        fill_value (float, optional): written to the ignored positions before
+            the max, the lowest value of the dtype by default.
+
+    Returns:
+        tensor: [batch_size, C] or [batch_size, 1, C].
+    """
+    if mode == "max":
+        if fill_value is None:
+            fill_value = torch.finfo(feat.dtype).min
+        pooled = feat.masked_fill(mask.unsqueeze(-1), fill_value).max(dim=1)[0]
+    elif mode == "mean":
+        valid = (~mask).unsqueeze(-1).to(feat.dtype)
+        pooled = (feat * valid).sum(dim=1) / valid.sum(dim=1).clamp(min=1)
+    elif mode == "cls":
+        pooled = feat[:, 0]
+    else:
+        raise TypeError(f"Unknown pooling mode {mode}")
+    return pooled.unsqueeze(1) if keepdim else pooled
+
 
 def xywh_to_x1y1x2y2(boxes):
     """
@@ -1,3 +1,5 @@
 from .logger import get_root_logger
 from .distributed import is_main, init_dist, reduce_mean
-from .checkpoint import save_checkpoint, load_checkpoint, load_pretrained_checkpoint
+from .checkpoint import save_checkpoint, load_checkpoint, load_pretrained_checkpoint, load_checkpoint_file, export_inference_checkpoint, CheckpointWriter
+from .metric import MetricAccumulator
+from .precision import get_precision, autocast, build_grad_scaler
@@ -1,15 +1,17 @@
+import os
+import json
+import pickle
+import time
 import torch
 import shutil
+import inspect
+import threading
 import os.path as osp
+from collections import OrderedDict
 from c3vg.utils import is_main
 from .logger import get_root_logger
 import copy
 
-try:
-    import apex
-except:
-    pass
-
 
 def is_paral_model(model):
     from mmcv.parallel import MMDistributedDataParallel
@@ -50,14 +52,14 @@ def log_loaded_info(ckpt, load_file):
 
 
 # only for finetuning, if resume from pretraining, use load_checkpoint
-def load_pretrained_checkpoint(model, model_ema=None, finetune_from=None, amp=False):
+def load_pretrained_checkpoint(model, model_ema=None, finetune_from=None):
     assert model_ema is None, "We do not use EMA during finetuning."
     start_epoch, best_d_acc, best_miou = -1, 0.0, 0.0
-    ckpt = torch.load(finetune_from, map_location=lambda storage, loc: storage.cuda())
+    ckpt = load_checkpoint_file(finetune_from, sections=("state_dict",))
     state = ckpt["state_dict"]
     if is_paral_state(state) and not is_paral_model(model):
         state = de_parallel(state)
-    state_copy = copy.deepcopy(state)
+    state_copy = dict(state)
     # state_copy.pop("lan_enc.embedding.weight")
 
     # model_seq_embed_dim = model.head.transformer.seq_positional_encoding.embedding.weight.size(
@@ -72,20 +74,25 @@ def load_pretrained_checkpoint(model, model_ema=None, finetune_from=None, amp=Fa
         logger = get_root_logger()
         logger.info("missing keys:{}".format(missing_keys))
         logger.info("unexpected keys:{}".format(unexpected_keys))
-    if "amp" in ckpt and amp:
-        apex.amp.load_state_dict(ckpt["amp"])
     if is_main():
         best_d_acc, best_miou = log_loaded_info(ckpt, finetune_from)
     return start_epoch, best_d_acc, best_miou
 
 
-def load_checkpoint(model, model_ema=None, resume_from=None, load_from=None, amp=False, optimizer=None, scheduler=None):
+def load_checkpoint(model, model_ema=None, resume_from=None, load_from=None, optimizer=None, scheduler=None, scaler=None):
+    """Only the sections needed by the given objects are read, straight from
+    the memory-mapped file into their tensors."""
     start_epoch, best_d_acc, best_miou, best_oiou = -1, 0.0, 0.0, 0.0
     flag = True
     assert not (resume_from is not None and load_from is not None)
     load_file = resume_from or load_from
-    ckpt = torch.load(load_file, map_location=lambda storage, loc: storage.cuda())
+    sections = ["state_dict"]
+    for section, target in [("ema_state_dict", model_ema), ("optimizer", optimizer), ("scheduler", scheduler), ("scaler", scaler)]:
+        if target is not None:
+            sections.append(section)
+    ckpt = load_checkpoint_file(load_file, sections=sections)
     state = ckpt["state_dict"]
+    ema_state = None
     if "ema_state_dict" in ckpt:
         ema_state = ckpt["ema_state_dict"]
         if is_paral_state(ema_state) and not is_paral_model(model):
@@ -98,13 +105,16 @@ def load_checkpoint(model, model_ema=None, resume_from=None, load_from=None, amp
         model.load_state_dict(state, strict=False)
         flag = False
     if model_ema is not None:
+        if ema_state is None:
+            # e.g. an inference checkpoint, whose weights are the EMA ones already
+            ema_state = state
         model_ema.shadow = ema_state
     if optimizer is not None and "optimizer" in ckpt:
         optimizer.load_state_dict(ckpt["optimizer"])
     if scheduler is not None and "scheduler" in ckpt:
         scheduler.load_state_dict(ckpt["scheduler"])
-    if "amp" in ckpt and amp:
-        apex.amp.load_state_dict(ckpt["amp"])
+    if scaler is not None and "scaler" in ckpt:
+        scaler.load_state_dict(ckpt["scaler"])
 
     if "epoch" in ckpt:
         if load_from is None and resume_from is not None:
@@ -114,12 +124,248 @@ def load_checkpoint(model, model_ema=None, resume_from=None, load_from=None, amp
     return start_epoch, best_d_acc, best_miou, flag
 
 
-def save_checkpoint(work_dir, interval, model, model_ema, optimizer, scheduler, checkpoint):
+def _snapshot(obj, buffers, key=""):
+    """Copies the tensors of a nested checkpoint to the host, into `buffers`
+    (pinned for device tensors) that are reused from one save to the next."""
+    if isinstance(obj, torch.Tensor):
+        buffer = buffers.get(key, None)
+        if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+            buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+            buffers[key] = buffer
+        buffer.copy_(obj.detach(), non_blocking=True)
+        return buffer
+    elif isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v, buffers, f"{key}/{k}")) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v, buffers, f"{key}/{i}") for i, v in enumerate(obj))
+    return copy.deepcopy(obj)
+
+
+def _split_tensors(obj, tensors, key=""):
+    """Replaces the tensors of a nested checkpoint by {"__tensor__": key}."""
+    if isinstance(obj, torch.Tensor):
+        tensors[key] = obj
+        return {"__tensor__": key}
+    elif isinstance(obj, dict):
+        return type(obj)((k, _split_tensors(v, tensors, f"{key}/{k}")) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_split_tensors(v, tensors, f"{key}/{i}") for i, v in enumerate(obj))
+    return obj
+
+
+def _merge_tensors(obj, tensors):
+    if isinstance(obj, dict):
+        if "__tensor__" in obj:
+            return tensors[obj["__tensor__"]]
+        return type(obj)((k, _merge_tensors(v, tensors)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_merge_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _atomic_save(obj, path):
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _atomic_link(src, dst):
+    """Points dst at the file of src, a hard link when the filesystem has them."""
+    tmp_path = dst + ".tmp"
+    if osp.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+CHECKPOINT_SECTIONS = ("state_dict", "ema_state_dict", "optimizer", "scheduler", "scaler")
+
+_LOAD_ARGS = inspect.signature(torch.load).parameters
+
+
+def _torch_load(load_file):
+    """torch.load onto the CPU, memory-mapped and weights only where this torch
+    supports it, so storages are only read from disk when used."""
+    mmap = {"mmap": True} if "mmap" in _LOAD_ARGS else {}
+    if "weights_only" not in _LOAD_ARGS:
+        return torch.load(load_file, map_location="cpu", **mmap)
+    try:
+        return torch.load(load_file, map_location="cpu", weights_only=True, **mmap)
+    except pickle.UnpicklingError as e:
+        # objects beyond tensors and containers, still memory-mapped
+        get_root_logger().warning(f"{load_file} is not weights only, loading it with weights_only=False: {e}")
+        return torch.load(load_file, map_location="cpu", weights_only=False, **mmap)
+
+
+def _to_device(obj, device):
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device)
+    elif isinstance(obj, dict):
+        return type(obj)((k, _to_device(v, device)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_to_device(v, device) for v in obj)
+    return obj
+
+
+def load_checkpoint_file(load_file, sections=None, device=None):
+    """Loads a checkpoint written by :func:`save_checkpoint`, sharded or not.
+
+    Args:
+        sections (list[str], optional): the entries of CHECKPOINT_SECTIONS to
+            keep, e.g. ["state_dict"] for inference, all of them by default.
+            The scalar entries (epoch, metrics, ...) are always kept.
+        device (str, optional): move the tensors there. By default they stay
+            memory-mapped on the CPU, load_state_dict then copies them
+            straight into the model / optimizer tensors.
+    """
+    ckpt = _torch_load(load_file)
+    if sections is not None:
+        ckpt = {k: v for k, v in ckpt.items() if k not in CHECKPOINT_SECTIONS or k in sections}
+    if "__shards__" in ckpt:
+        tensors = {}
+        for shard in ckpt.pop("__shards__"):
+            # tensors of the other sections stay unread in the mapped shards
+            tensors.update(_torch_load(osp.join(osp.dirname(load_file), shard)))
+        ckpt = _merge_tensors(ckpt, tensors)
+    if device is not None:
+        ckpt = _to_device(ckpt, device)
+    return ckpt
+
+
+def export_inference_checkpoint(load_file, save_file, use_ema=True, half=False):
+    """Writes the weights of a training checkpoint without the optimizer,
+    scheduler and scaler states, the EMA weights replacing the model ones
+    when present and `use_ema`, floating point tensors in fp16 if `half`."""
+    ckpt = load_checkpoint_file(load_file, sections=("state_dict", "ema_state_dict"))
+    state = ckpt.pop("state_dict")
+    ema_state = ckpt.pop("ema_state_dict", None)
+    ema_applied = use_ema and ema_state is not None
+    if ema_applied:
+        state = OrderedDict((name, ema_state.get(name, value)) for name, value in state.items())
+    if half:
+        state = OrderedDict((name, value.half() if value.is_floating_point() else value) for name, value in state.items())
+    ckpt.update({"state_dict": state, "ema_applied": ema_applied})
+    _atomic_save(ckpt, save_file)
+    return ckpt
+
+
+class CheckpointWriter(object):
+    """Writes the checkpoints of :func:`save_checkpoint`.
+
+    Every file is written to a temporary path and renamed, so a crash never
+    leaves a truncated checkpoint. Copies of the latest checkpoint (best,
+    every `interval` epochs) are hard links, not second writes.
+
+    Args:
+        async_write (bool): snapshot the state to (pinned, reused) host
+            buffers and serialize on a background thread, training only
+            waits for the device to host copy. A save waits for the previous
+            one, call :meth:`wait` before exiting.
+        shard_size (int, optional): split the tensors into shard files of
+            about that many bytes under `shards/`, the .pth file is then a
+            manifest holding the rest of the checkpoint and the shard names.
+            Shards no longer referenced by a checkpoint are removed.
+    """
+
+    def __init__(self, async_write=False, shard_size=None):
+        self.async_write = async_write
+        self.shard_size = shard_size
+        self.buffers = {}
+        self.thread = None
+        self.error = None
+
+    def save(self, checkpoint, path, links=()):
+        self.wait()
+        if not self.async_write:
+            self._write(checkpoint, path, links)
+            return
+        snapshot = _snapshot(checkpoint, self.buffers)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.thread = threading.Thread(target=self._write_async, args=(snapshot, path, links))
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write_async(self, checkpoint, path, links):
+        try:
+            self._write(checkpoint, path, links)
+        except Exception as e:
+            self.error = e
+
+    def _write(self, checkpoint, path, links):
+        logger = get_root_logger()
+        if self.shard_size:
+            self._write_sharded(checkpoint, path, links)
+        else:
+            _atomic_save(checkpoint, path)
+            for link in links:
+                _atomic_link(path, link)
+        epoch = checkpoint["epoch"] + 1
+        for saved_path in (path,) + tuple(links):
+            logger.info(f"saved epoch {epoch} checkpoint at {saved_path}")
+
+    def _write_sharded(self, checkpoint, path, links):
+        work_dir = osp.dirname(path)
+        tag = time.strftime("%Y%m%d_%H%M%S") + f"_{int(time.time() * 1000) % 1000:03d}"
+        os.makedirs(osp.join(work_dir, "shards", tag))
+        tensors = {}
+        manifest = _split_tensors(checkpoint, tensors)
+        shards, shard, shard_bytes = [], {}, 0
+        for key, tensor in tensors.items():
+            shard[key] = tensor
+            shard_bytes += tensor.numel() * tensor.element_size()
+            if shard_bytes >= self.shard_size:
+                shards.append(self._write_shard(shard, work_dir, tag, len(shards)))
+                shard, shard_bytes = {}, 0
+        if len(shard) > 0 or len(shards) == 0:
+            shards.append(self._write_shard(shard, work_dir, tag, len(shards)))
+        manifest["__shards__"] = shards
+        _atomic_save(manifest, path)
+        for link in links:
+            _atomic_link(path, link)
+
+        # shard directories referenced by the checkpoints in work_dir
+        index_path = osp.join(work_dir, "shards", "index.json")
+        index = {}
+        if osp.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+        for saved_path in (path,) + tuple(links):
+            index[osp.basename(saved_path)] = tag
+        index = {name: tag for name, tag in index.items() if osp.exists(osp.join(work_dir, name))}
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+        for name in os.listdir(osp.join(work_dir, "shards")):
+            if osp.isdir(osp.join(work_dir, "shards", name)) and name not in index.values():
+                shutil.rmtree(osp.join(work_dir, "shards", name))
+
+    def _write_shard(self, shard, work_dir, tag, index):
+        name = osp.join("shards", tag, f"{index:05d}.pth")
+        _atomic_save(shard, osp.join(work_dir, name))
+        return name
+
+
+def save_checkpoint(work_dir, interval, model, model_ema, optimizer, scheduler, checkpoint, scaler=None, writer=None):
+    """Args:
+    writer (CheckpointWriter, optional): how to write, a synchronous
+        unsharded writer by default.
+    """
     epoch = checkpoint["epoch"] + 1
-    logger = get_root_logger()
-    use_fp16 = checkpoint.pop("use_fp16", False)
-    if use_fp16:
-        checkpoint.update({"amp": apex.amp.state_dict()})
+    if writer is None:
+        writer = CheckpointWriter()
+    if scaler is not None and scaler.is_enabled():
+        checkpoint.update({"scaler": scaler.state_dict()})
     checkpoint.update(
         {
             "state_dict": model.state_dict(),
@@ -133,16 +379,11 @@ def save_checkpoint(work_dir, interval, model, model_ema, optimizer, scheduler,
     latest_path = osp.join(work_dir, "latest.pth")
     det_best_path = osp.join(work_dir, "det_best.pth")
     segm_best_path = osp.join(work_dir, "segm_best.pth")
-    torch.save(checkpoint, latest_path)
-    if is_main():
-        logger.info(f"saved epoch {epoch} checkpoint at {latest_path}")
+    links = []
     if interval > 0 and epoch % interval == 0:
-        torch.save(checkpoint, osp.join(work_dir, f"epoch_{epoch}.pth"))
+        links.append(osp.join(work_dir, f"epoch_{epoch}.pth"))
     # if checkpoint["d_acc"] > checkpoint["best_d_acc"]:
-    #     shutil.copyfile(latest_path, det_best_path)
-    #     if is_main():
-    #         logger.info(f"saved epoch {epoch} checkpoint at {det_best_path}")
+    #     links.append(det_best_path)
     if checkpoint["miou"] > checkpoint["best_miou"]:
-        shutil.copyfile(latest_path, segm_best_path)
-        if is_main():
-            logger.info(f"saved epoch {epoch} checkpoint at {segm_best_path}")
+        links.append(segm_best_path)
+    writer.save(checkpoint, latest_path, links)
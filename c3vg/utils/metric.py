@@ -0,0 +1,50 @@
+import torch
+from .distributed import reduce_mean
+
+
+class MetricAccumulator(object):
+    """Running means of the train/validate metrics, kept on the device.
+
+    Sums are accumulated in float64 on the device of the values and counts on
+    the host, so :meth:`update` never synchronizes. :meth:`summarize`
+    averages all sums across ranks with a single flattened all-reduce and
+    copies them to the host once. Since the all-reduce is linear, this gives
+    the same numbers as reducing every batch before accumulating.
+
+    Must be summarized on every rank when distributed.
+    """
+
+    def __init__(self):
+        self.sums, self.counts = dict(), dict()
+
+    def update(self, per_sample=False, **metrics):
+        """Args:
+        per_sample (bool): the values are per-sample vectors of shape [B, ...],
+            averaged over all samples seen; otherwise each value is one
+            per-batch entry, averaged over batches.
+        """
+        for name, value in metrics.items():
+            value = value.detach().to(torch.float64)
+            count = 1
+            if per_sample:
+                value, count = value.sum(0), value.shape[0]
+            elif value.numel() == 1:
+                value = value.reshape(())
+            if name not in self.sums:
+                self.sums[name], self.counts[name] = torch.zeros_like(value), 0
+            self.sums[name] += value
+            self.counts[name] += count
+
+    def summarize(self):
+        """Returns a dict of name -> float, or list of floats for vector metrics."""
+        names = sorted(self.sums)
+        if len(names) == 0:
+            return dict()
+        flat = reduce_mean(torch.cat([self.sums[name].reshape(-1) for name in names])).tolist()
+        summary, start = dict(), 0
+        for name in names:
+            numel = self.sums[name].numel()
+            values = [value / self.counts[name] for value in flat[start : start + numel]]
+            summary[name] = values if self.sums[name].dim() > 0 else values[0]
+            start += numel
+        return summary
@@ -0,0 +1,31 @@
+import torch
+import contextlib
+
+PRECISIONS = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def get_precision(cfg):
+    """Returns cfg.precision, one of fp32/fp16/bf16, falling back to the
+    former `use_fp16` switch for older configs."""
+    precision = cfg.get("precision", None)
+    use_fp16 = cfg.get("use_fp16", None)
+    if precision is None:
+        precision = "fp16" if use_fp16 else "fp32"
+    assert use_fp16 is None or use_fp16 == (precision == "fp16"), f"use_fp16={use_fp16} contradicts precision={precision}, drop use_fp16"
+    assert precision in PRECISIONS, f"precision should be one of {list(PRECISIONS)}, found {precision}"
+    return precision
+
+
+def autocast(precision, device):
+    """torch.autocast for `precision` on the type of `device`, a no-op for fp32."""
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    device_type = torch.device(device).type
+    assert not (device_type == "cpu" and precision == "fp16"), "fp16 autocast needs a CUDA device, use bf16 on the CPU"
+    return torch.autocast(device_type=device_type, dtype=PRECISIONS[precision])
+
+
+def build_grad_scaler(precision):
+    """Loss scaling is only needed for fp16, the scaler is disabled (a
+    pass-through) otherwise."""
+    return torch.cuda.amp.GradScaler(enabled=precision == "fp16")
@@ -19,15 +19,15 @@ train_pipeline = [
         use_token_type="beit3",
     ),
     dict(type="LargeScaleJitter", out_max_size=img_size, jitter_min=0.3, jitter_max=1.4),
-    dict(type="Resize", img_scale=(img_size, img_size), keep_ratio=False),
-    dict(type="Normalize", **img_norm_cfg),
-    dict(type="Pad", size_divisor=32),
+    dict(type="ResizeNormalizePad", img_scale=(img_size, img_size), size_divisor=32, **img_norm_cfg),
+    # with head first_stage_loss_at_stride=True, also collect "gt_mask_down"
+    # dict(type="MaskDownsample", stride=patch_size),
     # dict(type='SampleMaskVertices', num_ray=18, center_sampling=False),
     # dict(type='Pad', pad_to_square=True),
     dict(type="DefaultFormatBundle"),
     dict(
         type="CollectData",
-        keys=["img", "ref_expr_inds", "text_attention_mask", "is_crowd", "gt_mask_rle", "gt_bbox"],
+        keys=["img", "ref_expr_inds", "text_attention_mask", "is_crowd", "gt_mask_rle", "gt_mask_seg", "gt_bbox"],
     ),
 ]
 
@@ -40,9 +40,7 @@ val_pipeline = [
         dataset=dataset,
         use_token_type="beit3",
     ),
-    dict(type="Resize", img_scale=(img_size, img_size), keep_ratio=False),
-    dict(type="Normalize", **img_norm_cfg),
-    dict(type="Pad", size_divisor=32),
+    dict(type="ResizeNormalizePad", img_scale=(img_size, img_size), size_divisor=32, **img_norm_cfg),
     # dict(type='Pad', pad_to_square=True),
     dict(type="DefaultFormatBundle"),
     dict(
@@ -119,7 +117,7 @@ model = dict(
 )
 
 grad_norm_clip = 0.15
-use_fp16 = False
+precision = "fp32"
 ema = False
 # work_dir = "work_dir/seqtr_det_refcoco-unc_pvtv2mmb1_mix_type1_detectionpretrain_nofreeze_fusionv3_lr0.0003_ema_ep30"
 # work_dir = "work_dir/paper_exp/decoder_ablation/ViTBaseP32-1.0decoder-40ep-512hw-refcocounc"
@@ -1,12 +1,25 @@
 ema = True
 ema_factor = 0.999
-use_fp16 = False
+# update the EMA every ema_interval optimizer steps, with the decay raised to that power
+ema_interval = 1
+# "cpu" keeps the EMA weights off the GPU
+ema_device = None
+# fp32, fp16 or bf16, autocast + GradScaler for fp16, None follows the former use_fp16 (fp32 without it)
+precision = None
+# batches whose gradients are averaged per optimizer step, effective batch = samples_per_gpu * world_size * accumulate_steps
+accumulate_steps = 1
+# e.g. dict(img_scale=(320, 320), out_max_size=320, jitter_min=0.3, jitter_max=1.4, size_divisor=32, **img_norm_cfg)
+device_augment = None
 seed = 6666
 evaluate_interval=1
 deterministic = True
 log_level = "INFO"
 log_interval = 50
 save_interval = -1
+# write checkpoints on a background thread from a pinned host snapshot
+async_checkpoint = False
+# bytes per tensor shard file, e.g. 1 << 30, None for a single file
+checkpoint_shard_size = None
 resume_from = None
 load_from = None
 finetune_from = None
@@ -0,0 +1,41 @@
+import json
+import argparse
+
+from c3vg.datasets.image_shard import write_image_shards
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pack the images of a dataset, pre-downscaled, into shard files for file_client_cfg=dict(backend='shard')")
+    parser.add_argument("img_dir", help="image directory, e.g. data/seqtr_type/images/mscoco/train2014")
+    parser.add_argument("shard_dir", help="output directory, e.g. data/seqtr_type/images/mscoco/train2014_shard448")
+    parser.add_argument("--max-side", type=int, default=448, help="longer side of the stored images, e.g. 1.4 x img_size.")
+    parser.add_argument("--encoding", default="jpg", choices=["jpg", "raw"], help="raw skips decoding at load time but takes more disk.")
+    parser.add_argument("--quality", type=int, default=95, help="jpg quality.")
+    parser.add_argument("--shard-size", type=int, default=1024, help="size of a shard file in MB.")
+    parser.add_argument("--annsfile", default=None, help="only pack the images referenced by this json annotation file.")
+    parser.add_argument("--name-format", default="COCO_train2014_%012d.jpg", help="image name of an image_id, used with --annsfile.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    names = None
+    if args.annsfile is not None:
+        anns_all = json.load(open(args.annsfile, "r"))
+        image_ids = set(ann["image_id"] for anns in anns_all.values() for ann in anns)
+        names = sorted(args.name_format % image_id for image_id in image_ids)
+    write_image_shards(
+        args.img_dir,
+        args.shard_dir,
+        names=names,
+        max_side=args.max_side,
+        encoding=args.encoding,
+        quality=args.quality,
+        shard_size=args.shard_size << 20,
+    )
+    print("saved image shards at {}".format(args.shard_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import json
+import argparse
+
+from c3vg.datasets.mask_cache import build_mask_cache
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pre-merge the polygon/RLE masks of instances.json into a binary mask cache")
+    parser.add_argument("annsfile", help="json annotation file, e.g. data/seqtr_type/annotations/mixed-seg/instances.json")
+    parser.add_argument("--splits", nargs="+", default=None, help="only build these splits.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    anns_all = json.load(open(args.annsfile, "r"))
+    for which_set, anns in anns_all.items():
+        if args.splits is not None and which_set not in args.splits:
+            continue
+        counts_file, _ = build_mask_cache(args.annsfile, which_set, anns)
+        print("saved mask cache of {} ({} annotations) at {}".format(which_set, len(anns), counts_file))
+
+
+if __name__ == "__main__":
+    main()
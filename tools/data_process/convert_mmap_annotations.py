@@ -0,0 +1,21 @@
+import argparse
+
+from c3vg.datasets.annotation_store import convert_annotations, default_store_dir
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert instances.json into a memory-mapped annotation store")
+    parser.add_argument("annsfile", help="json annotation file, e.g. data/seqtr_type/annotations/mixed-seg/instances.json")
+    parser.add_argument("--splits", nargs="+", default=None, help="only convert these splits.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    out_dir = convert_annotations(args.annsfile, default_store_dir(args.annsfile), splits=args.splits)
+    print("saved annotation store to {}".format(out_dir))
+
+
+if __name__ == "__main__":
+    main()
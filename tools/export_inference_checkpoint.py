@@ -0,0 +1,35 @@
+import os
+import argparse
+
+from c3vg.utils import export_inference_checkpoint
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="export-inference-checkpoint: the weights of a training checkpoint, without the optimizer state")
+    parser.add_argument("checkpoint", help="training checkpoint, e.g. work_dir/.../segm_best.pth")
+    parser.add_argument("output", help="inference checkpoint to write")
+    parser.add_argument("--no-ema", action="store_true", help="keep the model weights even if the checkpoint has EMA ones.")
+    parser.add_argument("--fp16", action="store_true", help="store the floating point weights in fp16.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    ckpt = export_inference_checkpoint(args.checkpoint, args.output, use_ema=not args.no_ema, half=args.fp16)
+    print(
+        "saved {} weights{}{} at {} ({:.1f} MB, from {:.1f} MB)".format(
+            len(ckpt["state_dict"]),
+            ", EMA applied" if ckpt["ema_applied"] else "",
+            ", fp16" if args.fp16 else "",
+            args.output,
+            os.path.getsize(args.output) / 2**20,
+            os.path.getsize(args.checkpoint) / 2**20,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Helpers shared by the parity checks and benchmarks of tools/misc, import
+them as ``from benchmark_utils import ...`` (the script directory is on
+sys.path when running ``python tools/misc/<script>.py``)."""
+import time
+import numpy
+import torch
+
+
+def timeit(fn, repeat, device):
+    """Average ms of `repeat` calls of fn after a warm-up call, synchronizing
+    CUDA devices around the timed loop."""
+    sync = torch.cuda.synchronize if "cuda" in str(device) else (lambda: None)
+    fn()
+    sync()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    sync()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def random_masks(batch_size, size, empty_first=False):
+    """[B, size, size] uint8 masks, a random box with 5% of its pixels flipped
+    each, the first one left empty if `empty_first`."""
+    masks = numpy.zeros((batch_size, size, size), dtype=numpy.uint8)
+    for mask in masks[1:] if empty_first else masks:
+        x1, y1 = numpy.random.randint(0, size - 1, 2)
+        x2, y2 = numpy.random.randint(x1 + 1, size + 1), numpy.random.randint(y1 + 1, size + 1)
+        mask[y1:y2, x1:x2] = 1
+        mask[numpy.random.rand(size, size) < 0.05] ^= 1
+    return masks
+
+
+def head_inputs(cfg, batch_size, device):
+    """Random (img, x, cls_feat, lan_feat, lan_mask) inputs of the head of
+    `cfg`, the second half of the tokens padded."""
+    input_channels, size = cfg.model.head.input_channels, cfg.img_size // cfg.patch_size
+    img = torch.zeros(batch_size, 3, cfg.img_size, cfg.img_size, device=device)
+    x = torch.randn(batch_size, input_channels, size, size, device=device)
+    cls_feat = torch.randn(batch_size, 1, input_channels, device=device)
+    lan_feat = torch.randn(batch_size, cfg.max_token, input_channels, device=device)
+    lan_mask = torch.zeros(batch_size, cfg.max_token, dtype=torch.bool, device=device)
+    lan_mask[:, cfg.max_token // 2 :] = True
+    return img, x, cls_feat, lan_feat, lan_mask
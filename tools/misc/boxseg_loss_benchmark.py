@@ -0,0 +1,59 @@
+import torch
+import argparse
+from c3vg.models.losses.boxloss import BoxLoss
+from c3vg.models.utils import xywh_to_x1y1x2y2
+from c3vg.models.heads.uni_head import boxseg_iouloss2, compute_segboxiou, get_maskouterbox, compute_boxloss
+from benchmark_utils import timeit
+
+parser = argparse.ArgumentParser(description="batched boxseg_iouloss2 vs per-sample loop benchmark")
+parser.add_argument("--batch_sizes", default=[8, 16, 32, 64, 128], nargs="+", type=int)
+parser.add_argument("--size", default=320, type=int, help="mask height and width")
+parser.add_argument("--repeat", default=20, type=int, help="number of timed calls")
+parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+
+def boxseg_iouloss2_loop(box, mask, B2Sthr=0.5, S2Bthr=0.5, box_func=BoxLoss()):
+    """The former per-sample implementation."""
+    box_x1y1x2y2 = xywh_to_x1y1x2y2(box)
+    mask = mask.sigmoid().squeeze(1)
+    B, H, W = mask.shape
+    loss_S2B, loss_B2S = [], []
+    for b in range(B):
+        x1, y1, x2, y2 = (box_x1y1x2y2[b] * torch.tensor([W, H, W, H], device=box.device)).to(torch.int)
+        x1, x2 = torch.clamp(x1, 0, W), torch.clamp(x2, 0, W)
+        y1, y2 = torch.clamp(y1, 0, H), torch.clamp(y2, 0, H)
+        box_pred = torch.tensor([x1, y1, x2, y2], device=box.device)
+        S2B_iou = compute_segboxiou(mask[b], box_pred, threshold=S2Bthr)
+        maskouterbbox = get_maskouterbox(mask[b].unsqueeze(0), threshold=B2Sthr).squeeze(0)
+        maskouterbbox_norm = maskouterbbox / torch.tensor([W, H, W, H], device=box.device)
+        B2S_loss = compute_boxloss(maskouterbbox_norm.unsqueeze(0), box_x1y1x2y2[b].unsqueeze(0), loss_func=box_func)
+        loss_S2B.append(1 - S2B_iou)
+        loss_B2S.append(B2S_loss)
+    return loss_S2B, loss_B2S, None, None
+
+
+def inputs(batch_size):
+    box = torch.rand(batch_size, 4, device=args.device) * 0.6 + 0.2
+    box[:, 2:] *= 0.5
+    mask = torch.randn(batch_size, 1, args.size, args.size, device=args.device) - 1.0
+    mask[0] = -10.0  # an empty mask
+    for b in range(1, batch_size):
+        y, x = torch.randint(0, args.size // 2, (2,)).tolist()
+        mask[b, :, y : y + args.size // 3, x : x + args.size // 4] += 4.0
+    return box.requires_grad_(), mask
+
+
+for batch_size in args.batch_sizes:
+    box, mask = inputs(batch_size)
+    ref_S2B, ref_B2S, _, _ = boxseg_iouloss2_loop(box, mask)
+    new_S2B, new_B2S, _, _ = boxseg_iouloss2(box, mask)
+    assert torch.allclose(torch.stack(ref_S2B), new_S2B, atol=1e-6), "loss_S2B differs"
+    assert torch.allclose(torch.stack(ref_B2S), new_B2S, atol=1e-5), "loss_B2S differs"
+    ref_grad = torch.autograd.grad(sum(ref_B2S) / len(ref_B2S), box)[0]
+    new_grad = torch.autograd.grad(new_B2S.mean(), box)[0]
+    assert torch.allclose(ref_grad, new_grad, atol=1e-5), "gradient differs"
+
+    loop = timeit(lambda: boxseg_iouloss2_loop(box, mask), args.repeat, args.device)
+    batched = timeit(lambda: boxseg_iouloss2(box, mask), args.repeat, args.device)
+    print("batch {}: loop {:.2f} ms, batched {:.2f} ms, x{:.1f}".format(batch_size, loop, batched, loop / batched))
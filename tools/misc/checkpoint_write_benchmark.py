@@ -0,0 +1,58 @@
+import time
+import torch
+import argparse
+import tempfile
+import os.path as osp
+from mmcv import Config
+from c3vg.models import build_head
+from c3vg.utils import CheckpointWriter, load_checkpoint_file
+
+parser = argparse.ArgumentParser(description="training-loop stall of save_checkpoint: synchronous torch.save vs CheckpointWriter")
+parser.add_argument("--config", default="configs/C3VG-Mix.py", type=str)
+parser.add_argument("--shard_size", default=64 << 20, type=int, help="bytes per shard for the sharded round trip")
+parser.add_argument("--repeat", default=3, type=int, help="number of timed saves")
+parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+model = build_head(Config.fromfile(args.config).model.head).to(args.device)
+optimizer = torch.optim.AdamW(model.parameters())
+for param in model.parameters():
+    param.grad = torch.zeros_like(param)
+optimizer.step()
+
+
+def checkpoint(epoch):
+    return {"epoch": epoch, "miou": float(epoch), "best_miou": float(epoch), "state_dict": model.state_dict(), "optimizer": optimizer.state_dict()}
+
+
+def stall(writer, work_dir):
+    """Seconds save() blocks the caller, the write of the previous save excluded."""
+    total = 0.0
+    for epoch in range(args.repeat):
+        writer.wait()
+        start = time.perf_counter()
+        writer.save(checkpoint(epoch), osp.join(work_dir, "latest.pth"), [osp.join(work_dir, "segm_best.pth")])
+        total += time.perf_counter() - start
+    writer.wait()
+    return total / args.repeat * 1000
+
+
+def check(work_dir):
+    for name in ["latest.pth", "segm_best.pth"]:
+        ckpt = load_checkpoint_file(osp.join(work_dir, name), device="cpu")
+        assert ckpt["epoch"] == args.repeat - 1, f"{name}: stale epoch"
+        for key, value in model.state_dict().items():
+            assert torch.equal(ckpt["state_dict"][key], value.cpu()), f"{name}: {key} differs"
+
+
+results = {}
+for name, writer in [
+    ("sync", CheckpointWriter()),
+    ("async", CheckpointWriter(async_write=True)),
+    ("async sharded", CheckpointWriter(async_write=True, shard_size=args.shard_size)),
+]:
+    with tempfile.TemporaryDirectory() as work_dir:
+        results[name] = stall(writer, work_dir)
+        check(work_dir)
+print("round trip ok")
+print(", ".join("{}: {:.1f} ms".format(name, ms) for name, ms in results.items()), "per save,", args.device)
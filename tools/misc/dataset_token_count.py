@@ -11,10 +11,6 @@ from mmcv.runner import get_dist_info
 from mmcv.utils import Config, DictAction
 from mmcv.parallel import MMDistributedDataParallel
 import os
-try:
-    import apex
-except:
-    pass
 
 import torch
 from c3vg.datasets import extract_data
@@ -63,12 +59,6 @@ def main_worker(cfg):
                         word_emb=datasets[0].word_emb,
                         num_token=datasets[0].num_token)
     model = model.cuda()
-    if cfg.use_fp16:
-        model = apex.amp.initialize(
-            model, opt_level="O1")
-        for m in model.modules():
-            if hasattr(m, "fp16_enabled"):
-                m.fp16_enabled = True
     if cfg.distributed:
         model = MMDistributedDataParallel(model, device_ids=[cfg.rank])
     model_ema = ExponentialMovingAverage(model, cfg.ema_factor) if cfg.ema else None
@@ -76,7 +66,7 @@ def main_worker(cfg):
         load_checkpoint(model, model_ema, load_from=cfg.load_from)
     elif cfg.finetune_from:
         # hacky way
-        load_pretrained_checkpoint(model, model_ema, cfg.finetune_from, amp=cfg.use_fp16)
+        load_pretrained_checkpoint(model, model_ema, cfg.finetune_from)
 
     for eval_loader, _prefix in zip(dataloaders, prefix):
         if is_main():
@@ -0,0 +1,73 @@
+import torch
+import argparse
+from mmcv import Config
+from c3vg.models import build_head, ExponentialMovingAverage
+from benchmark_utils import timeit
+
+parser = argparse.ArgumentParser(description="foreach ExponentialMovingAverage vs the former state_dict based update")
+parser.add_argument("--config", default="configs/C3VG-Mix.py", type=str)
+parser.add_argument("--alpha", default=0.999, type=float)
+parser.add_argument("--repeat", default=50, type=int, help="number of timed updates")
+parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+
+class StateDictEMA(object):
+    """The former implementation."""
+
+    def __init__(self, model, alpha):
+        self.step = 0
+        self.model = model
+        self.alpha = alpha
+        self.shadow = {k: v.clone().detach() for k, v in model.state_dict().items()}
+        self.keys = [k for k, _ in model.named_parameters()] + [k for k, _ in model.named_buffers()]
+
+    def update_params(self):
+        decay = min(self.alpha, (self.step + 1) / (self.step + 10))
+        state = self.model.state_dict()
+        for name in self.keys:
+            self.shadow[name].copy_(decay * self.shadow[name] + (1 - decay) * state[name])
+        self.step += 1
+
+    def apply_shadow(self):
+        self.backup = {k: v.clone().detach() for k, v in self.model.state_dict().items()}
+        self.model.load_state_dict(self.shadow, strict=True)
+
+    def restore(self):
+        self.model.load_state_dict(self.backup, strict=True)
+
+
+model = build_head(Config.fromfile(args.config).model.head).to(args.device)
+reference, ema = StateDictEMA(model, args.alpha), ExponentialMovingAverage(model, args.alpha)
+with torch.no_grad():
+    for _ in range(5):
+        for param in model.parameters():
+            param.add_(torch.randn_like(param) * 0.01)
+        reference.update_params()
+        ema.update_params()
+for name, value in reference.shadow.items():
+    if value.is_floating_point():
+        assert torch.allclose(value, ema.shadow[name], atol=1e-6), f"{name} differs"
+before = {k: v.clone() for k, v in model.state_dict().items()}
+ema.apply_shadow()
+for name, value in model.state_dict().items():
+    if value.is_floating_point():
+        assert torch.allclose(value, reference.shadow[name], atol=1e-6), f"{name} differs after apply_shadow"
+ema.restore()
+assert all(torch.equal(v, before[k]) for k, v in model.state_dict().items()), "restore differs"
+print("parity ok")
+
+
+def bench(fn):
+    return timeit(fn, args.repeat, args.device)
+
+
+numel = sum(v.numel() for v in model.state_dict().values())
+print("{} tensors, {:.1f}M elements, {}".format(len(model.state_dict()), numel / 1e6, args.device))
+print("update: state_dict {:.3f} ms, foreach {:.3f} ms".format(bench(reference.update_params), bench(ema.update_params)))
+print("apply + restore: clone {:.3f} ms, swap {:.3f} ms".format(
+    bench(lambda: (reference.apply_shadow(), reference.restore())), bench(lambda: (ema.apply_shadow(), ema.restore()))
+))
+if "cuda" in args.device:
+    offloaded = ExponentialMovingAverage(model, args.alpha, device="cpu")
+    print("update, cpu shadow: {:.3f} ms".format(bench(offloaded.update_params)))
@@ -0,0 +1,51 @@
+import torch
+import argparse
+from mmcv import Config
+from c3vg.models import build_head
+from benchmark_utils import timeit, head_inputs
+
+parser = argparse.ArgumentParser(
+    description="UniHeadCoarseToFine per-stage latency, full coarse-to-fine vs first stage only. "
+    "For the accuracy column evaluate the same checkpoint with tools/test.py --cfg-options model.head.test_stages=1"
+)
+parser.add_argument("--config", default="configs/C3VG-Mix.py", type=str)
+parser.add_argument("--batch_size", default=1, type=int)
+parser.add_argument("--repeat", default=50, type=int, help="number of timed forwards")
+parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+cfg = Config.fromfile(args.config)
+head = build_head(cfg.model.head).to(args.device).eval()
+size = cfg.img_size // cfg.patch_size
+
+B = args.batch_size
+img, x, cls_feat, lan_feat, lan_mask = head_inputs(cfg, B, args.device)
+
+
+@torch.no_grad()
+def profile(test_stages, return_first_stage):
+    head.test_stages, head.return_first_stage = test_stages, return_first_stage
+    head.profile_stages = False
+    total = timeit(lambda: head.forward_test(x, cls_feat, lan_feat, lan_mask, img), args.repeat, args.device)
+
+    head.profile_stages = True
+    stages = {}
+    for _ in range(args.repeat):
+        head.forward_test(x, cls_feat, lan_feat, lan_mask, img)
+        for name, ms in head.stage_times.items():
+            stages[name] = stages.get(name, 0.0) + ms / args.repeat
+    return total, stages
+
+
+print("{} tokens, batch {}, {}".format(size * size, B, args.device))
+names = ["embedding", "first_stage", "uim", "decoder", "second_stage", "upsample"]
+print("| mode | total (ms) | " + " | ".join(names) + " |")
+print("|" + " --- |" * (len(names) + 2))
+for mode, test_stages, return_first_stage in [
+    ("two stages + first-stage outputs", 2, True),
+    ("two stages", 2, False),
+    ("first stage only", 1, False),
+]:
+    total, stages = profile(test_stages, return_first_stage)
+    row = ["{:.2f}".format(stages[name]) if name in stages else "-" for name in names]
+    print("| {} | {:.2f} | ".format(mode, total) + " | ".join(row) + " |")
@@ -0,0 +1,67 @@
+import time
+import numpy
+import argparse
+from mmdet.core import BitmapMasks
+from c3vg.datasets.pipelines.transforms import LargeScaleJitter
+
+parser = argparse.ArgumentParser(description="LargeScaleJitter crop search benchmark")
+parser.add_argument("--img_size", default=640, type=int, help="rescaled image size before cropping")
+parser.add_argument("--out_size", default=448, type=int, help="crop size")
+parser.add_argument("--repeat", default=50, type=int, help="number of timed searches")
+args = parser.parse_args()
+
+
+def loop_bbox_overlaps(crop_bbox, gt_bbox):
+    lt = numpy.maximum(crop_bbox[:2], gt_bbox[:2])
+    rb = numpy.minimum(crop_bbox[2:], gt_bbox[2:])
+    wh = rb - lt
+    return wh[0] * wh[1] / ((gt_bbox[2] - gt_bbox[0]) * (gt_bbox[3] - gt_bbox[1]))
+
+
+def loop_mask_overlaps(crop_bbox, gt_mask):
+    crop_mask = numpy.zeros((gt_mask.height, gt_mask.width), dtype=numpy.uint8)
+    crop_mask[crop_bbox[1] : crop_bbox[3], crop_bbox[0] : crop_bbox[2]] = 1
+    return numpy.sum(numpy.logical_and(crop_mask, gt_mask.masks[0])) / gt_mask.areas
+
+
+def loop_search(crop_bboxes, with_bbox, gt_bbox, gt_mask):
+    # the worst case of the previous implementation: no threshold is reached, all proposals are scored
+    ious = []
+    for crop_bbox in crop_bboxes.reshape(-1, 4):
+        if with_bbox:
+            ious.append(loop_bbox_overlaps(crop_bbox, gt_bbox))
+        else:
+            ious.append(loop_mask_overlaps(crop_bbox.astype(numpy.uint32), gt_mask))
+    return numpy.array(ious, dtype=numpy.float64).reshape(crop_bboxes.shape[:-1])
+
+
+size, out = args.img_size, args.out_size
+lsj = LargeScaleJitter(out_max_size=out)
+gt_bbox = numpy.array([size * 0.6, size * 0.6, size * 0.95, size * 0.95])
+mask = numpy.zeros((size, size), dtype=numpy.uint8)
+mask[int(gt_bbox[1]) : int(gt_bbox[3]), int(gt_bbox[0]) : int(gt_bbox[2])] = 1
+gt_mask = BitmapMasks(mask[None], size, size)
+
+offsets = numpy.random.random((len(lsj.crop_iou_thr), lsj.jitter_times, 2)) * (size - out)
+crop_bboxes = numpy.concatenate([offsets, offsets + out], axis=-1)
+
+for name, with_bbox in [("bbox", True), ("mask", False)]:
+    ref = loop_search(crop_bboxes, with_bbox, gt_bbox, gt_mask)
+    if with_bbox:
+        new = lsj._bbox_overlaps(crop_bboxes, gt_bbox)
+    else:
+        new = lsj._mask_overlaps(crop_bboxes.astype(numpy.uint32), gt_mask)
+    assert numpy.allclose(ref, new), f"{name} overlaps differ"
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        loop_search(crop_bboxes, with_bbox, gt_bbox, gt_mask)
+    loop_time = (time.perf_counter() - start) / args.repeat
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        if with_bbox:
+            lsj._bbox_overlaps(crop_bboxes, gt_bbox)
+        else:
+            lsj._mask_overlaps(crop_bboxes.astype(numpy.uint32), gt_mask)
+    vec_time = (time.perf_counter() - start) / args.repeat
+    print("{}: loop {:.3f} ms, vectorized {:.3f} ms, {:.1f}x".format(name, loop_time * 1000, vec_time * 1000, loop_time / vec_time))
@@ -0,0 +1,50 @@
+import numpy
+import torch
+import argparse
+import pycocotools.mask as maskUtils
+from c3vg.apis.test import mask_overlaps_withIU
+from benchmark_utils import timeit, random_masks
+
+parser = argparse.ArgumentParser(description="batched mask IoU vs pycocotools parity check")
+parser.add_argument("--batch_size", default=64, type=int)
+parser.add_argument("--size", default=320, type=int, help="mask height and width")
+parser.add_argument("--repeat", default=20, type=int, help="number of timed batches")
+parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+
+def encode(masks):
+    return [maskUtils.encode(numpy.asfortranarray(mask)) for mask in masks]
+
+
+def decode_loop(gt_rles, pred_rles):
+    """The former per-sample decode + list comprehension."""
+    pred_mask = torch.concat([torch.from_numpy(maskUtils.decode(rle)[None]) for rle in pred_rles], dim=0)
+    gt_mask = torch.concat([torch.from_numpy(maskUtils.decode(rle)[None]) for rle in gt_rles], dim=0)
+    intersection = torch.sum(torch.mul(pred_mask, gt_mask).reshape(pred_mask.shape[0], -1), dim=-1).to(args.device)
+    union = torch.sum(torch.add(pred_mask, gt_mask).reshape(pred_mask.shape[0], -1), dim=1).to(args.device) - intersection
+    return torch.tensor([i / u if u >= 1 else 0 for i, u in zip(intersection, union)]).to(args.device)
+
+
+gt_masks, pred_masks = random_masks(args.batch_size, args.size, empty_first=True), random_masks(args.batch_size, args.size, empty_first=True)
+gt_rles, pred_rles = encode(gt_masks), encode(pred_masks)
+pred_tensor = torch.from_numpy(pred_masks).to(args.device).bool()
+
+for is_crowd in [[0] * args.batch_size, list(numpy.random.randint(0, 2, args.batch_size))]:
+    reference = numpy.diag(maskUtils.iou(pred_rles, gt_rles, is_crowd))
+    for name, preds in [("rle", pred_rles), ("tensor", pred_tensor)]:
+        iou, _, _ = mask_overlaps_withIU(gt_rles, preds, is_crowd=is_crowd, device=args.device)
+        assert numpy.allclose(iou.cpu().numpy(), reference, atol=1e-6), f"iou differs from pycocotools ({name}, is_crowd={is_crowd})"
+
+iou, I, U = mask_overlaps_withIU(gt_rles, pred_tensor, device=args.device)
+assert torch.allclose(iou, decode_loop(gt_rles, pred_rles)), "iou differs from the decode loop"
+print("parity ok")
+
+
+def bench(fn):
+    return timeit(fn, args.repeat, args.device)
+
+
+print("decode loop: {:.2f} ms/batch".format(bench(lambda: decode_loop(gt_rles, pred_rles))))
+print("batched, rle predictions: {:.2f} ms/batch".format(bench(lambda: mask_overlaps_withIU(gt_rles, pred_rles, device=args.device))))
+print("batched, tensor predictions: {:.2f} ms/batch".format(bench(lambda: mask_overlaps_withIU(gt_rles, pred_tensor, device=args.device))))
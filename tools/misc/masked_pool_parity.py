@@ -0,0 +1,39 @@
+import torch
+import argparse
+from c3vg.models.utils import masked_pool
+from benchmark_utils import timeit
+
+parser = argparse.ArgumentParser(description="batched masked_pool vs per-sample boolean gather parity check")
+parser.add_argument("--batch_size", default=64, type=int)
+parser.add_argument("--max_token", default=20, type=int)
+parser.add_argument("--channels", default=256, type=int)
+parser.add_argument("--repeat", default=100, type=int, help="number of timed calls")
+parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+
+def pool_loop(feat, mask, mode):
+    """The former per-sample implementation."""
+    if mode == "max":
+        return torch.cat(list(map(lambda feat, mask: torch.max(feat[mask, :], dim=0, keepdim=True)[0], feat, ~mask)))
+    return torch.cat(list(map(lambda feat, mask: torch.mean(feat[mask, :], dim=0, keepdim=True), feat, ~mask)))
+
+
+feat = torch.randn(args.batch_size, args.max_token, args.channels, device=args.device, requires_grad=True)
+lengths = torch.randint(1, args.max_token + 1, (args.batch_size,), device=args.device)
+mask = torch.arange(args.max_token, device=args.device)[None] >= lengths[:, None]
+grad_out = torch.randn(args.batch_size, args.channels, device=args.device)
+
+for mode in ["max", "mean"]:
+    ref = pool_loop(feat, mask, mode)
+    new = masked_pool(feat, mask, mode=mode)
+    assert torch.allclose(ref, new, atol=1e-6), f"{mode} pooling differs"
+    ref_grad = torch.autograd.grad(ref, feat, grad_out)[0]
+    new_grad = torch.autograd.grad(new, feat, grad_out)[0]
+    assert torch.allclose(ref_grad, new_grad, atol=1e-6), f"{mode} pooling gradient differs"
+print("parity ok")
+
+
+loop = timeit(lambda: pool_loop(feat, mask, "max"), args.repeat, args.device)
+batched = timeit(lambda: masked_pool(feat, mask, mode="max"), args.repeat, args.device)
+print("max pooling, batch {}: loop {:.3f} ms, batched {:.3f} ms, x{:.1f}".format(args.batch_size, loop, batched, loop / batched))
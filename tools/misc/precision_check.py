@@ -0,0 +1,51 @@
+import torch
+import argparse
+from mmcv import Config
+from c3vg.models import build_head
+from c3vg.utils import autocast, build_grad_scaler
+from benchmark_utils import head_inputs
+
+parser = argparse.ArgumentParser(description="UniHeadCoarseToFine train/test step under each precision, bf16 autocast on the CPU included")
+parser.add_argument("--config", default="configs/C3VG-Mix.py", type=str)
+parser.add_argument("--batch_size", default=4, type=int)
+parser.add_argument("--device", default="cpu")
+parser.add_argument("--precisions", default=["fp32", "bf16"], nargs="+", help="fp16 needs a CUDA device")
+parser.add_argument("--rtol", default=0.05, type=float, help="tolerated relative loss difference to fp32")
+args = parser.parse_args()
+
+cfg = Config.fromfile(args.config)
+torch.manual_seed(0)
+head = build_head(cfg.model.head).to(args.device)
+B = args.batch_size
+img, x, cls_feat, lan_feat, lan_mask = head_inputs(cfg, B, args.device)
+gt_mask_seg = torch.zeros(B, cfg.img_size, cfg.img_size, dtype=torch.uint8, device=args.device)
+gt_mask_seg[:, cfg.img_size // 4 : cfg.img_size // 2, cfg.img_size // 3 : cfg.img_size // 2] = 1
+gt_bbox = [torch.tensor([cfg.img_size / 3, cfg.img_size / 4, cfg.img_size / 2, cfg.img_size / 2], device=args.device)] * B
+targets = {"mask": None, "mask_seg": gt_mask_seg, "bbox": gt_bbox, "epoch": 0}
+
+
+def step(precision):
+    head.train()
+    head.zero_grad()
+    torch.manual_seed(0)  # same dropout masks for every precision
+    scaler = build_grad_scaler(precision)
+    with autocast(precision, args.device):
+        losses, pred_dict, _ = head.forward_train(x, targets, cls_feat, lan_feat, lan_mask, img)
+    loss = losses["loss_mask"] + losses["loss_det"] + losses["loss_cons"]
+    scaler.scale(loss).backward()
+    grads = [p.grad for p in head.parameters() if p.grad is not None]
+    assert all(torch.isfinite(grad).all() for grad in grads), f"{precision}: non-finite gradients"
+    assert all(pred.dtype == torch.float32 for pred in pred_dict.values()), f"{precision}: predictions are not fp32"
+
+    head.eval()
+    with torch.no_grad(), autocast(precision, args.device):
+        pred_dict, _ = head.forward_test(x, cls_feat, lan_feat, lan_mask, img)
+    assert all(torch.isfinite(pred).all() and pred.dtype == torch.float32 for pred in pred_dict.values()), f"{precision}: bad test outputs"
+    return loss.item()
+
+
+reference = step("fp32")
+for precision in args.precisions:
+    loss = step(precision)
+    assert abs(loss - reference) <= args.rtol * abs(reference), f"{precision}: loss {loss:.4f} vs fp32 {reference:.4f}"
+    print("{}: loss {:.4f} (fp32 {:.4f}) ok".format(precision, loss, reference))
@@ -0,0 +1,52 @@
+import copy
+import time
+import numpy
+import argparse
+from mmdet.core import BitmapMasks
+from c3vg.datasets.pipelines import Resize, Normalize, Pad, ResizeNormalizePad, DefaultFormatBundle
+
+parser = argparse.ArgumentParser(description="ResizeNormalizePad vs Resize + Normalize + Pad benchmark")
+parser.add_argument("--img_size", default=320, type=int, help="output size")
+parser.add_argument("--height", default=480, type=int, help="input height")
+parser.add_argument("--width", default=640, type=int, help="input width")
+parser.add_argument("--repeat", default=200, type=int, help="number of timed samples")
+args = parser.parse_args()
+
+img_norm_cfg = dict(mean=[123.675, 116.28, 103.53], std=[58.395, 57.12, 57.375])
+img_scale = (args.img_size, args.img_size)
+chain = [Resize(img_scale=img_scale, keep_ratio=False), Normalize(**img_norm_cfg), Pad(size_divisor=32), DefaultFormatBundle()]
+fused = [ResizeNormalizePad(img_scale=img_scale, size_divisor=32, **img_norm_cfg), DefaultFormatBundle()]
+
+img = numpy.random.randint(0, 256, (args.height, args.width, 3), dtype=numpy.uint8)
+mask = numpy.zeros((args.height, args.width), dtype=numpy.uint8)
+mask[args.height // 4 : args.height // 2, args.width // 3 : args.width // 2] = 1
+sample = dict(
+    img=img,
+    img_shape=img.shape,
+    ori_shape=img.shape,
+    with_bbox=True,
+    with_mask=True,
+    gt_bbox=numpy.array([args.width / 3, args.height / 4, args.width / 2, args.height / 2]),
+    gt_mask=BitmapMasks(mask[None], args.height, args.width),
+)
+
+
+def run(transforms, results):
+    for transform in transforms:
+        results = transform(results)
+    return results
+
+
+ref, new = run(chain, copy.deepcopy(sample)), run(fused, copy.deepcopy(sample))
+assert numpy.array_equal(ref["img"].data.numpy(), new["img"].data.numpy()), "img differs"
+assert numpy.array_equal(ref["gt_bbox"].data.numpy(), new["gt_bbox"].data.numpy()), "gt_bbox differs"
+assert ref["gt_mask_rle"].data == new["gt_mask_rle"].data, "gt_mask_rle differs"
+for key in ["img_shape", "pad_shape"]:
+    assert tuple(ref[key]) == tuple(new[key]), f"{key} differs"
+
+for name, transforms in [("Resize+Normalize+Pad", chain), ("ResizeNormalizePad", fused)]:
+    samples = [copy.deepcopy(sample) for _ in range(args.repeat)]
+    start = time.perf_counter()
+    for results in samples:
+        run(transforms, results)
+    print("{}: {:.3f} ms/sample".format(name, (time.perf_counter() - start) / args.repeat * 1000))
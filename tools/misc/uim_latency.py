@@ -0,0 +1,49 @@
+import time
+import torch
+import argparse
+from mmcv import Config
+from c3vg.models.heads.modules import UnifiedInteractionModule
+
+parser = argparse.ArgumentParser(description="UnifiedInteractionModule latency with and without the unused branches")
+parser.add_argument("--config", default="configs/C3VG-Mix.py", type=str)
+parser.add_argument("--batch_size", default=1, type=int)
+parser.add_argument("--repeat", default=50, type=int, help="number of timed forwards")
+parser.add_argument("--device", default="cpu")
+args = parser.parse_args()
+
+cfg = Config.fromfile(args.config)
+head, uim = cfg.model.head, cfg.model.head.uim
+channels, size = head.hidden_channels, cfg.img_size // cfg.patch_size
+module = UnifiedInteractionModule(
+    input_channels=channels,
+    box_weights=uim["box_weights"],
+    weighted_compose=uim["weighted_compose"],
+    enable_box_coorinate_embed=uim["enable_box_coorinate_embed"],
+).to(args.device).eval()
+
+B = args.batch_size
+pred_box = torch.rand(B, 4, device=args.device) * 0.5 + 0.25
+pred_mask = torch.randn(B, 1, size, size, device=args.device)
+img_feat = torch.randn(B, channels, size, size, device=args.device)
+lan_feat = torch.randn(B, cfg.max_token, channels, device=args.device)
+lan_mask = torch.zeros(B, cfg.max_token, dtype=torch.bool, device=args.device)
+lan_mask[:, cfg.max_token // 2 :] = True
+
+
+@torch.no_grad()
+def timeit(prune_unused, with_extra):
+    module.prune_unused = prune_unused
+    outputs = module(pred_box, pred_mask, img_feat, lan_feat, lan_mask, with_extra=with_extra)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        module(pred_box, pred_mask, img_feat, lan_feat, lan_mask, with_extra=with_extra)
+    return outputs, (time.perf_counter() - start) / args.repeat * 1000
+
+
+(ref_bbox, ref_mask, _), full = timeit(False, True)
+(bbox, mask, extra), pruned = timeit(True, False)
+assert torch.equal(ref_bbox, bbox) and torch.equal(ref_mask, mask), "outputs differ"
+assert len(extra) == 0
+print("{} tokens, batch {}".format(size * size, B))
+print("all branches + heatmaps: {:.2f} ms".format(full))
+print("pruned: {:.2f} ms, x{:.2f}".format(pruned, full / pruned))
@@ -12,11 +12,6 @@ from mmcv.parallel import MMDistributedDataParallel
 import os
 import pandas as pd
 
-try:
-    import apex
-except:
-    pass
-
 
 def main_worker(cfg):
     cfg.distributed = False
@@ -86,11 +81,6 @@ def main_worker(cfg):
     cfg.model.threshold = cfg.threshold
     model = build_model(cfg.model, word_emb=datasets[0].word_emb, num_token=datasets[0].num_token)
     model = model.cuda()
-    if cfg.use_fp16:
-        model = apex.amp.initialize(model, opt_level="O1")
-        for m in model.modules():
-            if hasattr(m, "fp16_enabled"):
-                m.fp16_enabled = True
     if cfg.distributed:
         model = MMDistributedDataParallel(model, device_ids=[cfg.rank])
     model_ema = ExponentialMovingAverage(model, cfg.ema_factor) if cfg.ema else None
@@ -98,7 +88,7 @@ def main_worker(cfg):
         load_checkpoint(model, model_ema, load_from=cfg.load_from)
     elif cfg.finetune_from:
         # hacky way
-        load_pretrained_checkpoint(model, model_ema, cfg.finetune_from, amp=cfg.use_fp16)
+        load_pretrained_checkpoint(model, model_ema, cfg.finetune_from)
 
     excel_results = {
         'DetAcc': [],
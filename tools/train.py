@@ -9,21 +9,16 @@ from mmcv.runner import get_dist_info
 from mmcv.parallel import MMDistributedDataParallel
 
 from c3vg.core import build_optimizer, build_scheduler
-from c3vg.datasets import build_dataset, build_dataloader
+from c3vg.datasets import build_dataset, build_dataloader, DeviceAugment
 from c3vg.models import build_model, ExponentialMovingAverage
 from c3vg.apis import set_random_seed, train_model, evaluate_model
-from c3vg.utils import get_root_logger, load_checkpoint, save_checkpoint, load_pretrained_checkpoint, is_main, init_dist
+from c3vg.utils import get_root_logger, load_checkpoint, save_checkpoint, load_pretrained_checkpoint, CheckpointWriter, is_main, init_dist, get_precision, build_grad_scaler
 import wandb
 
 import warnings
 
 warnings.filterwarnings("ignore")
 
-try:
-    import apex
-except:
-    pass
-
 
 def parse_args():
     parser = argparse.ArgumentParser(description="SeqTR-train")
@@ -68,6 +63,11 @@ def main_worker(cfg):
         logger.info(cfg.pretty_text)
         cfg.dump(osp.join(cfg.work_dir, f"{cfg.timestamp}_" + osp.basename(cfg.config)))
 
+    device_augment = None
+    if cfg.get("device_augment", None) is not None:
+        device_augment = DeviceAugment(**cfg.device_augment)
+        cfg.data.train.device_augment = True
+
     datasets_cfgs = [cfg.data.train]
     if cfg.dataset == "Mixed":
         items = ["val_refcoco_unc", "val_refcocoplus_unc", "val_refcocog_umd", "val_referitgame_berkeley", "val_flickr30k"]
@@ -107,33 +107,31 @@ def main_worker(cfg):
     optimizer = build_optimizer(cfg.optimizer_config, train_params)
     scheduler = build_scheduler(cfg.scheduler_config, optimizer)
 
-    if cfg.use_fp16:
-        model, optimizer = apex.amp.initialize(model, optimizer, opt_level="O1")
-        for m in model.modules():
-            if hasattr(m, "fp16_enabled"):
-                m.fp16_enabled = True
+    precision = get_precision(cfg)
+    scaler = build_grad_scaler(precision)
 
     if cfg.distributed:
         model = MMDistributedDataParallel(model, device_ids=[cfg.rank], find_unused_parameters=True)
-    model_ema = ExponentialMovingAverage(model, cfg.ema_factor) if cfg.ema else None
+    model_ema = ExponentialMovingAverage(model, cfg.ema_factor, interval=cfg.get("ema_interval", 1), device=cfg.get("ema_device", None)) if cfg.ema else None
     start_epoch, best_d_acc, best_miou, best_oiou = -1, 0.0, 0.0, 0.0
     if cfg.resume_from:
-        start_epoch, _, _, flag = load_checkpoint(model, model_ema, cfg.resume_from, amp=cfg.use_fp16, optimizer=optimizer, scheduler=scheduler)
+        start_epoch, _, _, flag = load_checkpoint(model, model_ema, cfg.resume_from, optimizer=optimizer, scheduler=scheduler, scaler=scaler)
         if not flag:
-            model_ema = ExponentialMovingAverage(model, cfg.ema_factor) if cfg.ema else None
+            model_ema = ExponentialMovingAverage(model, cfg.ema_factor, interval=cfg.get("ema_interval", 1), device=cfg.get("ema_device", None)) if cfg.ema else None
     elif cfg.finetune_from:
-        load_pretrained_checkpoint(model, model_ema, cfg.finetune_from, amp=cfg.use_fp16)
+        load_pretrained_checkpoint(model, model_ema, cfg.finetune_from)
     elif cfg.load_from:
         start_epoch, best_d_acc, best_miou, flag = load_checkpoint(model, model_ema, load_from=cfg.load_from)
         if not flag:
-            model_ema = ExponentialMovingAverage(model, cfg.ema_factor) if cfg.ema else None
+            model_ema = ExponentialMovingAverage(model, cfg.ema_factor, interval=cfg.get("ema_interval", 1), device=cfg.get("ema_device", None)) if cfg.ema else None
 
     import time
 
     begin_time = time.time()
+    checkpoint_writer = CheckpointWriter(async_write=cfg.get("async_checkpoint", False), shard_size=cfg.get("checkpoint_shard_size", None))
     for epoch in range(start_epoch + 1, cfg.scheduler_config.max_epoch):
         start_time = time.time()
-        train_model(epoch, cfg, model, model_ema, optimizer, dataloaders[0])
+        train_model(epoch, cfg, model, model_ema, optimizer, dataloaders[0], device_augment=device_augment, scaler=scaler)
         this_epoch_train_time = int(time.time() - start_time)
         if is_main():
             logger.info("this_epoch_train_time={}m-{}s".format(this_epoch_train_time // 60, this_epoch_train_time % 60))
@@ -188,7 +186,7 @@ def main_worker(cfg):
                     "best_d_acc": best_d_acc,
                     "best_miou": best_miou,
                     "best_oiou": best_oiou,
-                    "amp": cfg.use_fp16,
+                    "precision": precision,
                 }
                 save_checkpoint(
                     cfg.work_dir,
@@ -198,6 +196,8 @@ def main_worker(cfg):
                     optimizer,
                     scheduler,
                     saved_info,
+                    scaler=scaler,
+                    writer=checkpoint_writer,
                 )
             best_d_acc = max(d_acc, best_d_acc)
             best_miou = max(miou, best_miou)
@@ -218,6 +218,7 @@ def main_worker(cfg):
         if cfg.distributed:
             dist.barrier()
 
+    checkpoint_writer.wait()
     if cfg.distributed:
         dist.destroy_process_group()
 